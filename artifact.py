@@ -0,0 +1,153 @@
+'''
+Created on Oct 18, 2026
+
+Model files that store the params of a network by name, with a json header describing where they came from. Layout:
+
+    magic (8 bytes) | format version (uint32) | header length (uint32) | json header | arrays
+
+Every array starts at a multiple of 64 bytes and is stored uncompressed in C order, so the file is memory mapped and an
+array is only read when it is used
+'''
+import hashlib
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from fileio import atomicSave
+
+MAGIC = b'DCJCMODL'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+# Prefixes of the files saved by each training stage
+STAGE_PREFIXES = {'pretrain': '', 'kld': 'pc_', 'km': 'pc_km_'}
+# Name of the cluster centers of the clustering layer
+CLUSTER_CENTERS = 'clustering.W'
+
+
+def getArchitectureHash(network_description):
+    '''
+    :param network_description: python dictionary specifying the autoencoder architecture, as read from archs/*.json
+                                (before NetworkBuilder completes it)
+    :return: Hash of the architecture. The name is left out, renamed copies (e.g. the runs of a sweep) have the same hash
+    '''
+    return hashlib.sha1(json.dumps(dict((key, value) for key, value in network_description.items() if key != 'name'),
+                                   sort_keys=True)).hexdigest()
+
+
+def getArtifactPath(dataset_name, stage, arch_name, params_dir='saved_params'):
+    # e.g. saved_params/MNIST/pc_m_<arch>.model for the params after the KLD clustering
+    return '%s/%s/%sm_%s.model' % (params_dir, dataset_name, STAGE_PREFIXES[stage], arch_name)
+
+
+def alignOffset(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def saveArtifact(path, arrays, metadata):
+    '''
+    Writes a model file (see atomicSave), a crash while saving never leaves a truncated file behind
+    :param path: Location of the file
+    :param arrays: List of (name, array, attributes) - attributes is a json serializable dictionary stored with the
+                   array (e.g. its layer)
+    :param metadata: Json serializable dictionary describing the model (architecture hash, dataset, stage, epoch ...)
+    '''
+    entries = []
+    offset = 0
+    for name, array, attributes in arrays:
+        array = np.asarray(array)
+        entries.append(dict(attributes, name=name, dtype=array.dtype.str, shape=list(array.shape), offset=offset))
+        offset = alignOffset(offset + array.nbytes)
+    header = json.dumps(dict(metadata, timestamp=time.time(), arrays=entries), sort_keys=True).encode('utf-8')
+    data_start = alignOffset(PREAMBLE.size + len(header))
+
+    def writer(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for (name, array, attributes), entry in zip(arrays, entries):
+                f.seek(data_start + entry['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(data_start + offset)
+
+    atomicSave(path, writer)
+
+
+class ModelArtifact(object):
+    '''
+    Read access to a model file. Opening it only reads the header, the arrays are views of a memory map of the file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size:
+                raise ValueError('%s is not a model file' % path)
+            magic, version, header_length = PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise ValueError('%s is not a model file' % path)
+            if version > FORMAT_VERSION:
+                raise ValueError('%s has format version %d, this version reads up to %d' % (path, version, FORMAT_VERSION))
+            self.metadata = json.loads(f.read(header_length).decode('utf-8'))
+        self.entries = self.metadata.pop('arrays')
+        self.data_start = alignOffset(PREAMBLE.size + header_length)
+        end = max([self.data_start + entry['offset'] + self.getSize(entry) for entry in self.entries] + [0])
+        if os.path.getsize(path) < end:
+            raise ValueError('%s is truncated' % path)
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r') if end else None
+
+    def getSize(self, entry):
+        return int(np.prod(entry['shape'])) * np.dtype(str(entry['dtype'])).itemsize
+
+    def getNames(self):
+        return [entry['name'] for entry in self.entries]
+
+    def getArray(self, name):
+        '''
+        :return: Read only view of the array in the memory map, the file is read as the view is accessed
+        '''
+        for entry in self.entries:
+            if entry['name'] == name:
+                start = self.data_start + entry['offset']
+                return self.buffer[start:start + self.getSize(entry)].view(str(entry['dtype'])).reshape(entry['shape'])
+        raise KeyError('%s holds no array %s' % (self.path, name))
+
+    def getArrays(self, encoder_only=False, layer=None, trainable=None):
+        '''
+        :param encoder_only: Only the arrays of the encoder (the layers up to the encode layer)
+        :param layer: Only the arrays of the layer with this index in the architecture
+        :param trainable: Only the trainable (True) or non trainable (False) arrays, None for both
+        :return: List of (name, array) in the order they were saved
+        '''
+        arrays = []
+        for entry in self.entries:
+            if encoder_only and not entry.get('encoder', False):
+                continue
+            if layer is not None and entry.get('layer') != layer:
+                continue
+            if trainable is not None and entry.get('trainable', True) != trainable:
+                continue
+            arrays.append((entry['name'], self.getArray(entry['name'])))
+        return arrays
+
+    def validate(self, network_description=None, arch_hash=None, shapes=None):
+        '''
+        Checks that the file was saved for the given architecture
+        :param network_description: Architecture as read from archs/*.json, checked against the hash in the header
+        :param arch_hash: Hash of the architecture (see getArchitectureHash), alternatively to network_description
+        :param shapes: Dictionary of name -> expected shape, every name has to be in the file with this shape
+        '''
+        if network_description is not None:
+            arch_hash = getArchitectureHash(network_description)
+        if arch_hash is not None and self.metadata.get('arch_hash') != arch_hash:
+            raise ValueError('%s was saved for a different architecture (%s)' % (self.path, self.metadata.get('arch_name')))
+        saved_shapes = dict((entry['name'], tuple(entry['shape'])) for entry in self.entries)
+        for name, shape in (shapes or {}).items():
+            if name not in saved_shapes:
+                raise ValueError('%s does not hold %s' % (self.path, name))
+            if saved_shapes[name] != tuple(shape):
+                raise ValueError('%s does not match the network: %s has shape %s instead of %s' % (self.path, name, saved_shapes[name], tuple(shape)))
@@ -0,0 +1,565 @@
+'''
+Created on Oct 18, 2026
+'''
+import argparse
+import copy
+import glob
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import resource
+import socket
+import subprocess
+import time
+import traceback
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from customlayers import getSoftAssignments, getDistances
+from misc import DatasetHelper, cluster_acc, evaluateKMeans
+from network import DCJC
+from parallel import DataParallelTrainer
+from telemetry import EpochTelemetry, currentRSS
+
+logging.basicConfig(format="[%(asctime)s]  %(message)s", datefmt='%m/%d %I:%M:%S', level=logging.INFO)
+benchmarkLogger = logging.getLogger('benchmark')
+
+# Image shape and number of clusters of the real datasets, the synthetic datasets mimic them
+SYNTHETIC_SHAPES = {'MNIST': ((1, 28, 28), 10), 'COIL20': ((1, 128, 128), 20), 'STL': ((3, 96, 96), 10)}
+# Fields of a result record that are measurements or describe the run, all the other fields identify the benchmark case
+MEASUREMENT_FIELDS = ('seconds', 'samples_per_sec', 'peak_extra_mb', 'loss', 'speedup')
+# Memory budget of the explicit N x K x D tensor of the tiled distance cases, larger ones are skipped (their gradient
+# needs several copies of it)
+MAX_TILED_MB = 512
+RUN_FIELDS = ('run_id', 'timestamp', 'host', 'git_revision', 'theano_device', 'floatX')
+
+
+class SyntheticDataset(object):
+    '''
+    Stand-in for MNISTDataset, COIL20Dataset and STLDataset that generates clustered random images of the same
+    shape, so that the training and evaluation paths can be timed without the real dataset files
+    '''
+
+    def __init__(self, image_shape, num_samples, cluster_count, seed=0):
+        '''
+        :param image_shape: Shape of one sample (channels, height, width)
+        :param num_samples: Number of samples to generate
+        :param cluster_count: Number of clusters, each cluster is a random prototype image plus noise
+        :param seed: Seed of the random generator
+        '''
+        self.image_shape = tuple(image_shape)
+        self.num_samples = num_samples
+        self.cluster_count = cluster_count
+        self.seed = seed
+        self.source_files = []
+        # Stored as uint8 pixels like the real datasets
+        self.scale = 1 / 256.0
+
+    def loadDataset(self):
+        rng = np.random.RandomState(self.seed)
+        prototypes = rng.rand(self.cluster_count, *self.image_shape).astype(np.float32)
+        labels = rng.randint(self.cluster_count, size=self.num_samples)
+        inputs = prototypes[labels]
+        inputs += 0.1 * rng.randn(*inputs.shape).astype(np.float32)
+        np.clip(inputs, 0, 1 - self.scale, out=inputs)
+        inputs = np.rint(inputs / self.scale).astype(np.uint8)
+        return [inputs, labels, inputs.reshape((self.num_samples, -1))]
+
+
+def getSyntheticDataset(image_shape, num_samples, cluster_count, seed=0):
+    '''
+    :return: DatasetHelper serving a SyntheticDataset, usable wherever the helper of a real dataset is expected
+    '''
+    dataset = DatasetHelper('SYNTHETIC')
+    dataset.dataset = SyntheticDataset(image_shape, num_samples, cluster_count, seed)
+    dataset.loadDataset(use_cache=False)
+    return dataset
+
+
+def getSyntheticDatasetName(image_shape):
+    # Name of the real dataset with this image shape, used to pick the number of clusters and to label the results
+    for name, (shape, _) in SYNTHETIC_SHAPES.items():
+        if tuple(shape) == tuple(image_shape):
+            return name
+    return 'x'.join(str(dim) for dim in image_shape)
+
+
+def getSyntheticLatentSpace(num_samples, num_clusters, latent_space_dim, seed=0):
+    '''
+    :return: Clustered random points standing in for an encoded dataset, and their cluster labels
+    '''
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_clusters, latent_space_dim).astype(np.float32)
+    labels = rng.randint(num_clusters, size=num_samples)
+    return centers[labels] + 0.5 * rng.randn(num_samples, latent_space_dim).astype(np.float32), labels
+
+
+def tiledSoftAssignments(latent_space, cluster_centers, num_clusters, latent_space_dim, num_samples):
+    '''
+    Reference implementation of getSoftAssignments that builds the explicit N x K x D tensor, kept for comparison
+    '''
+    z_expanded = latent_space.reshape((num_samples, 1, latent_space_dim))
+    z_expanded = T.tile(z_expanded, (1, num_clusters, 1))
+    u_expanded = T.tile(cluster_centers, (num_samples, 1, 1))
+    distances_from_cluster_centers = (z_expanded - u_expanded).norm(2, axis=2)
+    qij_numerator = 1 + distances_from_cluster_centers * distances_from_cluster_centers
+    qij_numerator = 1 / qij_numerator
+    normalizer_q = qij_numerator.sum(axis=1).reshape((num_samples, 1))
+    return qij_numerator / normalizer_q
+
+
+def tiledDistances(latent_space, cluster_centers, num_clusters, latent_space_dim, num_samples):
+    '''
+    Reference implementation of the k-means loss distances that builds the explicit N x K x D tensor, kept for comparison
+    '''
+    z = latent_space.reshape((num_samples, 1, latent_space_dim))
+    z = T.tile(z, (1, num_clusters, 1))
+    u = cluster_centers.reshape((1, num_clusters, latent_space_dim))
+    u = T.tile(u, (num_samples, 1, 1))
+    return (z - u).norm(2, axis=2).reshape((num_samples, num_clusters))
+
+
+def timeFunction(function, args, repeats, warmup=True):
+    '''
+    :return: Mean wall time of a call in seconds, after one untimed warm up call unless warmup is False
+    '''
+    if warmup:
+        function(*args)
+    start_time = time.time()
+    for _ in range(repeats):
+        function(*args)
+    return (time.time() - start_time) / repeats
+
+
+def runInChild(case_function, case_args):
+    '''
+    Runs a benchmark case in a fresh process, so that the peak memory reported for it is not polluted by the
+    previous cases. A case that raises or whose process dies (e.g. killed when out of memory) is logged and skipped
+    :return: Result returned by case_function, None if the case failed
+    '''
+    results = multiprocessing.Queue()
+
+    def target():
+        try:
+            results.put((case_function(*case_args), None))
+        except BaseException:
+            results.put((None, traceback.format_exc()))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    result, error = None, None
+    while True:
+        try:
+            result, error = results.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not process.is_alive():
+                # Anything put just before the process exited is still in the pipe
+                try:
+                    result, error = results.get(timeout=1)
+                except Queue.Empty:
+                    error = 'Process exited with code %s' % process.exitcode
+                break
+    process.join()
+    if error is not None:
+        benchmarkLogger.error('%s%s failed: %s' % (case_function.__name__, case_args, error))
+    return result
+
+
+def distanceCase(implementation, expression, num_samples, num_clusters, latent_space_dim, repeats):
+    '''
+    Times the forward and backward pass of one distance based expression and measures the memory it needs on top
+    of the compiled function and its inputs
+    '''
+    rng = np.random.RandomState(0)
+    z = T.matrix('z')
+    centers = theano.shared(rng.randn(num_clusters, latent_space_dim).astype(theano.config.floatX), name='centers')
+    if expression == 'soft_assignments':
+        if implementation == 'tiled':
+            output = tiledSoftAssignments(z, centers, num_clusters, latent_space_dim, num_samples)
+        else:
+            output = getSoftAssignments(z, centers)
+    else:
+        if implementation == 'tiled':
+            output = tiledDistances(z, centers, num_clusters, latent_space_dim, num_samples)
+        else:
+            output = getDistances(z, centers)
+    cost = output.min(axis=1).mean()
+    function = theano.function([z], [cost] + T.grad(cost, [z, centers]))
+    data = rng.randn(num_samples, latent_space_dim).astype(theano.config.floatX)
+    rss_before = currentRSS()
+    seconds = timeFunction(function, [data], repeats)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'benchmark': 'distances', 'expression': expression, 'implementation': implementation,
+            'N': num_samples, 'K': num_clusters, 'D': latent_space_dim,
+            'seconds': seconds, 'peak_extra_mb': max(peak_rss - rss_before, 0.0)}
+
+
+def benchmarkDistances(sample_counts, cluster_counts, latent_dims, repeats, max_tiled_mb=MAX_TILED_MB):
+    '''
+    Compares the tiled N x K x D formulation with the GEMM based one for the soft assignments and the k-means loss
+    distances, forward and backward, across the given sizes
+    :param max_tiled_mb: Tiled cases whose N x K x D tensor is larger than this are skipped
+    :return: List of result dictionaries
+    '''
+    results = []
+    itemsize = np.dtype(theano.config.floatX).itemsize
+    for num_samples, num_clusters, latent_space_dim in itertools.product(sample_counts, cluster_counts, latent_dims):
+        tiled_mb = num_samples * num_clusters * latent_space_dim * itemsize / float(1024 ** 2)
+        for expression in ('soft_assignments', 'kmeans_distances'):
+            for implementation in ('tiled', 'gemm'):
+                if implementation == 'tiled' and tiled_mb > max_tiled_mb:
+                    benchmarkLogger.info('Skipping %s tiled N=%d K=%d D=%d, the tiled tensor needs %.0fMB' % (
+                        expression, num_samples, num_clusters, latent_space_dim, tiled_mb))
+                    continue
+                result = runInChild(distanceCase, (implementation, expression, num_samples, num_clusters, latent_space_dim, repeats))
+                if result is None:
+                    continue
+                benchmarkLogger.info('%-18s %-6s N=%-6d K=%-4d D=%-6d %10.5fs %10.1fMB' % (
+                    expression, implementation, num_samples, num_clusters, latent_space_dim, result['seconds'], result['peak_extra_mb']))
+                results.append(result)
+    return results
+
+
+def timeSteps(train_step, batches, repeats):
+    '''
+    Times a train step over a cycle of minibatches
+    :return: Mean wall time of a step in seconds, after one untimed warm up step
+    '''
+    batches = [(np.array(inputs), np.array(targets)) for inputs, targets in itertools.islice(batches, repeats)]
+    train_step(batches[0])
+    start_time = time.time()
+    for batch in itertools.islice(itertools.cycle(batches), repeats):
+        train_step(batch)
+    return (time.time() - start_time) / repeats
+
+
+def networkCase(arch_file, arch_index, sample_counts, cluster_counts, repeats):
+    '''
+    Times the train steps of the autoencoder and of the two clustering stages, and the encoding throughput, of one
+    architecture on a synthetic dataset with the input shape of the architecture. The network is compiled once
+    and shared by all the sizes
+    '''
+    with open(arch_file) as f:
+        arch = json.load(f)[arch_index]
+    # The network builder completes the description in place, keep the json untouched
+    dcjc = DCJC(copy.deepcopy(arch), prefetch=0)
+    image_shape = arch['layers'][0]['output_shape']
+    dataset_name = getSyntheticDatasetName(image_shape)
+    default_clusters = SYNTHETIC_SHAPES.get(dataset_name, (None, 10))[1]
+    case_info = {'benchmark': 'networks', 'arch': dcjc.name, 'arch_file': os.path.basename(arch_file), 'arch_index': arch_index,
+                 'dataset_shape': dataset_name, 'batch_size': dcjc.batch_size, 'D': dcjc.encode_size}
+    results = []
+
+    def addResult(case, num_samples, num_clusters, seconds, samples):
+        result = dict(case_info)
+        result.update({'case': case, 'N': num_samples, 'K': num_clusters, 'seconds': seconds, 'samples_per_sec': samples / seconds})
+        benchmarkLogger.info('%-18s %-50s N=%-6s K=%-4s %10.5fs %12.1f samples/s' % (
+            case, dcjc.name, num_samples, num_clusters, seconds, result['samples_per_sec']))
+        results.append(result)
+
+    dataset = getSyntheticDataset(image_shape, max(sample_counts), default_clusters)
+    batches = dataset.iterate_minibatches(dcjc.input_type, dcjc.batch_size, shuffle=True)
+    seconds = timeSteps(lambda batch: dcjc.trainAutoencoder(batch[0], batch[1]), batches, repeats)
+    addResult('autoencoder_train', None, None, seconds, dcjc.batch_size)
+    for num_samples in sample_counts:
+        dataset = getSyntheticDataset(image_shape, num_samples, default_clusters)
+        Z = np.zeros((num_samples, dcjc.encode_size), dtype=np.float32)
+        seconds = timeFunction(dcjc.encodeDataset, [dataset, Z], 1)
+        addResult('encode', num_samples, None, seconds, num_samples)
+    dataset = getSyntheticDataset(image_shape, max(sample_counts), default_clusters)
+    rng = np.random.RandomState(0)
+    for num_clusters in cluster_counts:
+        cluster_centers = rng.randn(num_clusters, dcjc.encode_size).astype(theano.config.floatX)
+        P = DCJC.calculateP(rng.dirichlet(np.ones(num_clusters), size=len(dataset.input)).astype(np.float32))
+        for combined_loss in (False, True):
+            _, trainStep, _, _ = dcjc.buildKLDivClustering(cluster_centers, combined_loss)
+            batches = dataset.iterate_minibatches(dcjc.input_type, dcjc.batch_size, P, shuffle=True)
+            seconds = timeSteps(trainStep, batches, repeats)
+            addResult('kld_train_combined' if combined_loss else 'kld_train', None, num_clusters, seconds, dcjc.batch_size)
+        _, trainStep, _ = dcjc.buildKMeansClustering(cluster_centers)
+        batches = dataset.iterate_minibatches(dcjc.input_type, dcjc.batch_size, shuffle=True)
+        seconds = timeSteps(trainStep, batches, repeats)
+        addResult('km_train', None, num_clusters, seconds, dcjc.batch_size)
+    return results
+
+
+def kernelCase(num_samples, num_clusters, latent_space_dim, repeats, kmeans_modes):
+    '''
+    Times the latent space computations of the clustering stages on a synthetic latent space - the theano soft
+    assignments, the target distribution P, the clustering accuracy and the kmeans evaluation
+    '''
+    case_info = {'benchmark': 'kernels', 'N': num_samples, 'K': num_clusters, 'D': latent_space_dim}
+    results = []
+
+    def addResult(case, seconds):
+        result = dict(case_info)
+        result.update({'case': case, 'seconds': seconds, 'samples_per_sec': num_samples / seconds})
+        benchmarkLogger.info('%-18s N=%-6d K=%-4d D=%-6d %10.5fs %12.1f samples/s' % (
+            case, num_samples, num_clusters, latent_space_dim, seconds, result['samples_per_sec']))
+        results.append(result)
+
+    Z, labels = getSyntheticLatentSpace(num_samples, num_clusters, latent_space_dim)
+    rng = np.random.RandomState(0)
+    cluster_centers = rng.randn(num_clusters, latent_space_dim).astype(theano.config.floatX)
+    z = T.matrix('z')
+    softAssignments = theano.function([z], getSoftAssignments(z, theano.shared(cluster_centers)))
+    addResult('soft_assignments', timeFunction(softAssignments, [Z], repeats))
+    Q = DCJC.calculateQ(Z, cluster_centers)
+    addResult('calculate_q', timeFunction(DCJC.calculateQ, [Z, cluster_centers], repeats))
+    addResult('calculate_p', timeFunction(DCJC.calculateP, [Q], repeats))
+    addResult('cluster_acc', timeFunction(cluster_acc, [labels, Q.argmax(axis=1)], repeats))
+    # A single timed call per kmeans mode, the warm started modes start from the centers of an untimed full run
+    _, init_centers = evaluateKMeans(Z, labels, num_clusters, 'init')
+    for mode in kmeans_modes:
+        seconds = timeFunction(evaluateKMeans, [Z, labels, num_clusters, mode, mode, init_centers], 1, warmup=False)
+        addResult('kmeans_' + mode, seconds)
+    return results
+
+
+def dataCase(dataset_name, num_samples, batch_size, prefetch, repeats, stream_cache_mb=None):
+    '''
+    Times one shuffled pass of the minibatch iterator over a synthetic dataset with the shape of a real dataset,
+    globally shuffled or block-shuffled within windows of stream_cache_mb megabytes
+    '''
+    image_shape, cluster_count = SYNTHETIC_SHAPES[dataset_name]
+    dataset = getSyntheticDataset(image_shape, num_samples, cluster_count)
+    dataset.stream_cache_mb = stream_cache_mb
+
+    def epoch():
+        for _ in dataset.iterate_minibatches('IMAGE', batch_size, shuffle=True, prefetch=prefetch):
+            pass
+
+    seconds = timeFunction(epoch, [], repeats)
+    case = 'minibatches_prefetch_%d' % prefetch + ('_stream_%dmb' % stream_cache_mb if stream_cache_mb else '')
+    result = {'benchmark': 'data', 'case': case, 'dataset_shape': dataset_name,
+              'N': num_samples, 'batch_size': batch_size, 'seconds': seconds, 'samples_per_sec': num_samples / seconds}
+    benchmarkLogger.info('%-36s %-8s N=%-6d %10.5fs %12.1f samples/s' % (
+        result['case'], dataset_name, num_samples, seconds, result['samples_per_sec']))
+    return [result]
+
+
+def scalingCase(arch_file, arch_index, num_samples, workers, sync_interval, epochs):
+    '''
+    Times pretraining epochs of one architecture on a synthetic dataset with the given number of data parallel workers,
+    a single worker trains in the case process itself like the serial pretraining
+    '''
+    with open(arch_file) as f:
+        arch = json.load(f)[arch_index]
+    dcjc = DCJC(copy.deepcopy(arch), workers=workers, sync_interval=sync_interval)
+    image_shape = arch['layers'][0]['output_shape']
+    dataset_name = getSyntheticDatasetName(image_shape)
+    dataset = getSyntheticDataset(image_shape, num_samples, SYNTHETIC_SHAPES.get(dataset_name, (None, 10))[1])
+    telemetry = EpochTelemetry(None, 'pretrain', {})
+    if workers == 1:
+        def epoch(_):
+            batches = dataset.iterate_minibatches(dcjc.input_type, dcjc.batch_size, shuffle=True, prefetch=dcjc.prefetch)
+            return dcjc.trainEpoch(batches, lambda batch: dcjc.trainAutoencoder(batch[0], batch[1]), telemetry)
+        trainer = None
+    else:
+        training_state = dcjc.getTrainingState([dcjc.network], dcjc.autoencoder_updates) + [dcjc.learning_rate]
+        trainer = DataParallelTrainer(dcjc.trainAutoencoder, training_state, dataset, dcjc.input_type, dcjc.batch_size,
+                                      workers, sync_interval, dcjc.prefetch)
+        trainer.start()
+        epoch = trainer.trainEpoch
+    # The first epoch warms up the caches and the workers
+    epoch(0)
+    start_time = time.time()
+    for i in range(epochs):
+        error, total_batches = epoch(i + 1)
+    seconds = (time.time() - start_time) / epochs
+    if trainer is not None:
+        trainer.close()
+    samples = total_batches * dcjc.batch_size
+    result = {'benchmark': 'scaling', 'case': 'pretrain_workers_%d' % workers, 'arch': dcjc.name, 'dataset_shape': dataset_name,
+              'N': num_samples, 'workers': workers, 'sync_interval': sync_interval, 'batch_size': dcjc.batch_size,
+              'seconds': seconds, 'samples_per_sec': samples / seconds, 'loss': float(error / total_batches)}
+    benchmarkLogger.info('%-22s %-50s N=%-6d %10.5fs %12.1f samples/s  loss %.4f' % (
+        result['case'], dcjc.name, num_samples, seconds, result['samples_per_sec'], result['loss']))
+    return [result]
+
+
+def benchmarkNetworks(arch_specs, sample_counts, cluster_counts, repeats):
+    '''
+    Runs networkCase for each architecture, each in its own process
+    :param arch_specs: List of architectures, either json files (all their architectures) or file:index
+    :return: List of result dictionaries
+    '''
+    results = []
+    for arch_file, arch_index in getArchitectures(arch_specs):
+        results.extend(runInChild(networkCase, (arch_file, arch_index, sample_counts, cluster_counts, repeats)) or [])
+    return results
+
+
+def benchmarkKernels(sample_counts, cluster_counts, latent_dims, repeats, kmeans_modes):
+    '''
+    Runs kernelCase across the given sizes, each size in its own process
+    :return: List of result dictionaries
+    '''
+    results = []
+    for num_samples, num_clusters, latent_space_dim in itertools.product(sample_counts, cluster_counts, latent_dims):
+        results.extend(runInChild(kernelCase, (num_samples, num_clusters, latent_space_dim, repeats, kmeans_modes)) or [])
+    return results
+
+
+def benchmarkData(sample_counts, batch_size, repeats):
+    '''
+    Runs dataCase for the shapes of all the datasets, with and without prefetching, and with block shuffling in
+    windows of 16MB
+    :return: List of result dictionaries
+    '''
+    results = []
+    for dataset_name, num_samples, prefetch, stream_cache_mb in itertools.product(sorted(SYNTHETIC_SHAPES), sample_counts, (0, 2), (None, 16)):
+        results.extend(runInChild(dataCase, (dataset_name, num_samples, batch_size, prefetch, repeats, stream_cache_mb)) or [])
+    return results
+
+
+def benchmarkScaling(arch_specs, sample_counts, worker_counts, sync_interval, epochs):
+    '''
+    Runs scalingCase for each architecture, dataset size and number of workers, and logs the speedup over one worker
+    :return: List of result dictionaries
+    '''
+    results = []
+    for arch_file, arch_index in getArchitectures(arch_specs):
+        with open(arch_file) as f:
+            batch_size = json.load(f)[arch_index]['batch_size']
+        for num_samples in sample_counts:
+            case_results = []
+            for workers in worker_counts:
+                if num_samples < workers * batch_size:
+                    benchmarkLogger.info('Skipping %d workers for N=%d, not one batch per worker' % (workers, num_samples))
+                    continue
+                case_results.extend(runInChild(scalingCase, (arch_file, arch_index, num_samples, workers, sync_interval, epochs)) or [])
+            serial = [result for result in case_results if result['workers'] == 1]
+            for result in case_results:
+                if serial:
+                    result['speedup'] = result['samples_per_sec'] / serial[0]['samples_per_sec']
+                    benchmarkLogger.info('%-22s %-50s N=%-6d speedup %6.2fx' % (result['case'], result['arch'], num_samples, result['speedup']))
+            results.extend(case_results)
+    return results
+
+
+def getArchitectures(arch_specs):
+    '''
+    :param arch_specs: List of json files (all the architectures in them) or file:index, e.g archs/mnist.json:1
+    :return: List of (json file, architecture index) pairs
+    '''
+    architectures = []
+    for spec in arch_specs:
+        arch_file, _, arch_index = spec.partition(':')
+        if arch_index:
+            architectures.append((arch_file, int(arch_index)))
+        else:
+            with open(arch_file) as f:
+                architectures.extend((arch_file, i) for i in range(len(json.load(f))))
+    return architectures
+
+
+def getRunInfo():
+    '''
+    :return: Fields identifying the benchmark run, added to every result record
+    '''
+    try:
+        git_revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_revision = None
+    return {'run_id': time.strftime('%Y%m%d_%H%M%S'), 'timestamp': time.time(), 'host': socket.gethostname(),
+            'git_revision': git_revision, 'theano_device': theano.config.device, 'floatX': theano.config.floatX}
+
+
+def loadResults(path):
+    '''
+    :return: Dictionary from the case key (all the fields identifying the case) to the last result of the case in the
+             json-lines file
+    '''
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                key = tuple(sorted((field, value) for field, value in result.items()
+                                   if field not in MEASUREMENT_FIELDS and field not in RUN_FIELDS))
+                results[key] = result
+    return results
+
+
+def compareResults(baseline_path, candidate_path):
+    '''
+    Logs the time of every case present in both result files and the speedup of the candidate over the baseline
+    :return: List of (case key, baseline seconds, candidate seconds, speedup)
+    '''
+    baseline = loadResults(baseline_path)
+    candidate = loadResults(candidate_path)
+    comparison = []
+    for key in sorted(set(baseline) & set(candidate)):
+        baseline_seconds = baseline[key]['seconds']
+        candidate_seconds = candidate[key]['seconds']
+        speedup = baseline_seconds / candidate_seconds if candidate_seconds > 0 else float('inf')
+        comparison.append((key, baseline_seconds, candidate_seconds, speedup))
+        benchmarkLogger.info('%-100s %10.5fs %10.5fs %7.2fx' % (
+            ' '.join('%s=%s' % (field, value) for field, value in key if value is not None), baseline_seconds, candidate_seconds, speedup))
+    benchmarkLogger.info('%d cases compared, %d only in %s, %d only in %s' % (
+        len(comparison), len(set(baseline) - set(candidate)), baseline_path, len(set(candidate) - set(baseline)), candidate_path))
+    return comparison
+
+
+if __name__ == '__main__':
+    '''
+    usage: benchmark.py [-h] [--N N [N ...]] [--K K [K ...]] [--D D [D ...]]
+                        [--repeats REPEATS] [--archs ARCHS [ARCHS ...]]
+                        [--kmeans-modes {full,warm,minibatch} [...]]
+                        [--batch-size BATCH_SIZE] [--output OUTPUT]
+                        [--workers WORKERS [WORKERS ...]]
+                        [--sync-every SYNC_EVERY] [--epochs EPOCHS]
+                        [--max-tiled-mb MAX_TILED_MB]
+                        [--baseline BASELINE] [--candidate CANDIDATE]
+                        {distances,kernels,networks,data,all,scaling,compare}
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suite", choices=['distances', 'kernels', 'networks', 'data', 'all', 'scaling', 'compare'],
+                        help="Benchmark to run (scaling is not part of all, it occupies all cores), or compare two result files")
+    parser.add_argument("--N", type=int, nargs='+', default=[100, 1000, 5000], help="Number of samples")
+    parser.add_argument("--K", type=int, nargs='+', default=[10, 20, 100], help="Number of clusters")
+    parser.add_argument("--D", type=int, nargs='+', default=[10, 120, 2000], help="Dimensionality of the latent space")
+    parser.add_argument("--repeats", type=int, default=10, help="Number of timed calls per case")
+    parser.add_argument("--archs", nargs='+', default=sorted(glob.glob('archs/*.json')),
+                        help="Architectures for the networks and scaling suites, json files or file:index (default all architectures in archs/)")
+    parser.add_argument("--kmeans-modes", nargs='+', choices=['full', 'warm', 'minibatch'], default=['full', 'warm', 'minibatch'],
+                        help="evaluateKMeans modes timed by the kernels suite")
+    parser.add_argument("--batch-size", type=int, default=100, help="Minibatch size for the data suite")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of data parallel workers for the scaling suite")
+    parser.add_argument("--sync-every", type=int, default=10, help="Train steps between two parameter averagings in the scaling suite")
+    parser.add_argument("--epochs", type=int, default=2, help="Number of timed epochs per case of the scaling suite")
+    parser.add_argument("--max-tiled-mb", type=float, default=MAX_TILED_MB,
+                        help="Skip the tiled distance cases whose N x K x D tensor is larger than this many MB")
+    parser.add_argument("--output", help="Append the results as json lines to this file")
+    parser.add_argument("--baseline", help="Result file of the reference run (compare)")
+    parser.add_argument("--candidate", help="Result file of the run compared against the baseline (compare)")
+    args = parser.parse_args()
+    if args.suite == 'compare':
+        if not args.baseline or not args.candidate:
+            parser.error('compare needs --baseline and --candidate')
+        compareResults(args.baseline, args.candidate)
+    else:
+        run_info = getRunInfo()
+        results = []
+        if args.suite in ('distances', 'all'):
+            results.extend(benchmarkDistances(args.N, args.K, args.D, args.repeats, args.max_tiled_mb))
+        if args.suite in ('kernels', 'all'):
+            results.extend(benchmarkKernels(args.N, args.K, args.D, args.repeats, args.kmeans_modes))
+        if args.suite in ('networks', 'all'):
+            results.extend(benchmarkNetworks(args.archs, args.N, args.K, args.repeats))
+        if args.suite in ('data', 'all'):
+            results.extend(benchmarkData(args.N, args.batch_size, args.repeats))
+        if args.suite == 'scaling':
+            results.extend(benchmarkScaling(args.archs, args.N, args.workers, args.sync_every, args.epochs))
+        if args.output:
+            with open(args.output, 'a') as f:
+                for result in results:
+                    result.update(run_info)
+                    f.write(json.dumps(result) + '\n')
@@ -0,0 +1,93 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import time
+
+import numpy as np
+
+from fileio import atomicSave
+
+
+class Checkpointer(object):
+    '''
+    Periodically saves the complete training state - the values of a list of theano shared variables (network
+    params, optimizer buffers, learning rate, cluster centers), the number of finished epochs and the numpy RNG
+    state - so that an interrupted training can continue exactly where it stopped. Checkpoints are written with
+    atomicSave, so a crash while saving never leaves a truncated checkpoint behind
+    '''
+
+    def __init__(self, path, every_epochs=None, every_minutes=None):
+        '''
+        :param path: Location of the checkpoint file (.npz)
+        :param every_epochs: Save after every every_epochs epochs, None to disable
+        :param every_minutes: Save after an epoch if at least every_minutes minutes passed since the last save, None to disable
+        '''
+        self.path = path
+        self.every_epochs = every_epochs
+        self.every_minutes = every_minutes
+        self.last_save_time = time.time()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def remove(self):
+        # Deletes the checkpoint, e.g. once the stage finished and saved its results
+        if self.exists():
+            os.remove(self.path)
+
+    def isDue(self, epoch):
+        '''
+        :param epoch: Zero based index of the epoch that just finished
+        :return: True if a checkpoint should be written after this epoch
+        '''
+        if self.every_epochs and (epoch + 1) % self.every_epochs == 0:
+            return True
+        if self.every_minutes and time.time() - self.last_save_time >= 60 * self.every_minutes:
+            return True
+        return False
+
+    def save(self, shared_variables, epochs_done, extras=None):
+        '''
+        :param shared_variables: Theano shared variables making up the training state, the same list (same order)
+                                 has to be passed when restoring
+        :param epochs_done: Number of finished epochs
+        :param extras: Dictionary of additional numpy arrays to be saved (e.g. evaluation state)
+        '''
+        arrays = {}
+        for i, variable in enumerate(shared_variables):
+            arrays['var_%d' % i] = variable.get_value()
+        for name, value in (extras or {}).items():
+            arrays['extra_' + name] = value
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        arrays['rng_keys'] = rng_keys
+        arrays['rng_params'] = np.array([rng_pos, rng_has_gauss, rng_cached_gaussian], dtype=np.float64)
+        arrays['epochs_done'] = np.array(epochs_done)
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        atomicSave(self.path, lambda tmp_path: np.savez(tmp_path, **arrays))
+        self.last_save_time = time.time()
+
+    def restore(self, shared_variables):
+        '''
+        Sets the shared variables and the numpy RNG to the state saved in the checkpoint
+        :param shared_variables: Theano shared variables making up the training state, in the order used for saving
+        :return: Number of finished epochs, dictionary of the extra arrays
+        '''
+        with np.load(self.path) as f:
+            num_saved = len([name for name in f.files if name.startswith('var_')])
+            if num_saved != len(shared_variables):
+                raise ValueError('Checkpoint %s holds %d variables, the training state has %d' % (self.path, num_saved, len(shared_variables)))
+            for i, variable in enumerate(shared_variables):
+                value = f['var_%d' % i]
+                if value.shape != variable.get_value(borrow=True).shape:
+                    raise ValueError('Checkpoint %s does not match the network: variable %d has shape %s instead of %s' % (
+                        self.path, i, value.shape, variable.get_value(borrow=True).shape))
+                variable.set_value(value)
+            rng_pos, rng_has_gauss, rng_cached_gaussian = f['rng_params']
+            np.random.set_state(('MT19937', f['rng_keys'], int(rng_pos), int(rng_has_gauss), float(rng_cached_gaussian)))
+            extras = dict((name[len('extra_'):], f[name]) for name in f.files if name.startswith('extra_'))
+            epochs_done = int(f['epochs_done'])
+        self.last_save_time = time.time()
+        return epochs_done, extras
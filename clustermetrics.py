@@ -0,0 +1,124 @@
+'''
+Created on Oct 18, 2026
+'''
+
+import numpy as np
+
+
+class ContingencyMatrix(object):
+    '''
+    Contingency matrix between predicted clusters and true labels, built with a single vectorized
+    bincount per batch so that it can be accumulated while streaming over the dataset. All the
+    clustering metrics (ACC, NMI, ARI, purity) are derived from this K x K table, so their cost
+    grows with the number of clusters rather than the number of samples
+    '''
+
+    def __init__(self, num_predicted=0, num_true=0):
+        '''
+        :param num_predicted: Initial number of predicted clusters (rows), grows if larger labels are seen
+        :param num_true: Initial number of true classes (columns), grows if larger labels are seen
+        '''
+        self.counts = np.zeros((num_predicted, num_true), dtype=np.int64)
+
+    def update(self, labels_true, labels_pred):
+        '''
+        Adds a batch of (true, predicted) label pairs to the table
+        :param labels_true: True label for each sample of the batch
+        :param labels_pred: Predicted label for each sample of the batch
+        :return: self, so that calls can be chained
+        '''
+        labels_true = np.asarray(labels_true).astype(np.int64, copy=False).ravel()
+        labels_pred = np.asarray(labels_pred).astype(np.int64, copy=False).ravel()
+        assert labels_true.size == labels_pred.size
+        if labels_true.size == 0:
+            return self
+        rows = max(self.counts.shape[0], int(labels_pred.max()) + 1)
+        cols = max(self.counts.shape[1], int(labels_true.max()) + 1)
+        if (rows, cols) != self.counts.shape:
+            grown = np.zeros((rows, cols), dtype=np.int64)
+            grown[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+            self.counts = grown
+        self.counts += np.bincount(labels_pred * cols + labels_true, minlength=rows * cols).reshape((rows, cols))
+        return self
+
+    def total(self):
+        return self.counts.sum()
+
+    def accuracy(self):
+        '''
+        Clustering accuracy - uses the hungarian algorithm to find the best one to one mapping between
+        predicted clusters and true labels, and reports the fraction of samples that agree with this mapping
+        '''
+        from sklearn.utils.linear_assignment_ import linear_assignment
+        size = max(self.counts.shape)
+        w = np.zeros((size, size), dtype=np.int64)
+        w[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+        ind = linear_assignment(w.max() - w)
+        return w[ind[:, 0], ind[:, 1]].sum() * 1.0 / self.total()
+
+    def purity(self):
+        '''
+        Fraction of samples that belong to the majority true label of their predicted cluster
+        '''
+        return self.counts.max(axis=1).sum() * 1.0 / self.total()
+
+    def nmi(self):
+        '''
+        Normalized mutual information, normalized by the geometric mean of the entropies (same as the
+        default of sklearn's normalized_mutual_info_score)
+        '''
+        n = float(self.total())
+        pred_sums = self.counts.sum(axis=1)
+        true_sums = self.counts.sum(axis=0)
+        h_pred = entropy(pred_sums)
+        h_true = entropy(true_sums)
+        if h_pred == 0 or h_true == 0:
+            # Either clustering is a single cluster, the score is only perfect when both are
+            return 1.0 if h_pred == h_true else 0.0
+        nz_rows, nz_cols = np.nonzero(self.counts)
+        nz = self.counts[nz_rows, nz_cols].astype(np.float64)
+        mi = (nz / n * (np.log(nz * n) - np.log(pred_sums[nz_rows] * true_sums[nz_cols].astype(np.float64)))).sum()
+        return max(mi, 0.0) / np.sqrt(h_pred * h_true)
+
+    def ari(self):
+        '''
+        Adjusted rand index
+        '''
+        n = self.total()
+        sum_comb = comb2(self.counts).sum()
+        sum_comb_pred = comb2(self.counts.sum(axis=1)).sum()
+        sum_comb_true = comb2(self.counts.sum(axis=0)).sum()
+        expected = sum_comb_pred * sum_comb_true / comb2(n)
+        maximum = (sum_comb_pred + sum_comb_true) / 2.0
+        if maximum == expected:
+            return 1.0
+        return (sum_comb - expected) / (maximum - expected)
+
+    def scores(self):
+        '''
+        :return: Dictionary with all the metrics derived from the table
+        '''
+        return {'acc': self.accuracy(), 'nmi': self.nmi(), 'ari': self.ari(), 'purity': self.purity()}
+
+
+def entropy(cluster_sizes):
+    # Entropy of a labelling given the size of each of its clusters
+    sizes = cluster_sizes[cluster_sizes > 0].astype(np.float64)
+    p = sizes / sizes.sum()
+    return -(p * np.log(p)).sum()
+
+
+def comb2(n):
+    # Number of pairs, n choose 2, computed in floating point to avoid overflow
+    n = np.asarray(n, dtype=np.float64)
+    return n * (n - 1) / 2.0
+
+
+def clusteringScores(labels_true, labels_pred):
+    '''
+    Builds the contingency matrix once and derives all the clustering metrics from it
+    :param labels_true: True label for each sample
+    :param labels_pred: Predicted label for each sample
+    :return: Dictionary with acc, nmi, ari and purity
+    '''
+    return ContingencyMatrix().update(labels_true, labels_pred).scores()
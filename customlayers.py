@@ -39,12 +39,10 @@ class ClusteringLayer(layers.Layer):
     while optimizing for loss
     '''
 
-    def __init__(self, incoming, num_clusters, initial_clusters, num_samples, latent_space_dim, **kwargs):
+    def __init__(self, incoming, num_clusters, initial_clusters, **kwargs):
         super(ClusteringLayer, self).__init__(incoming, **kwargs)
         self.num_clusters = num_clusters
         self.W = self.add_param(theano.shared(initial_clusters), initial_clusters.shape, 'W')
-        self.num_samples = num_samples
-        self.latent_space_dim = latent_space_dim
 
     def get_output_shape_for(self, input_shape):
         '''
@@ -54,26 +52,43 @@ class ClusteringLayer(layers.Layer):
         return (input_shape[0], self.num_clusters)
 
     def get_output_for(self, incoming, **kwargs):
-        return getSoftAssignments(incoming, self.W, self.num_clusters, self.latent_space_dim, self.num_samples)
+        return getSoftAssignments(incoming, self.W)
 
 
-def getSoftAssignments(latent_space, cluster_centers, num_clusters, latent_space_dim, num_samples):
+def getSoftAssignments(latent_space, cluster_centers):
     '''
-    Returns cluster membership distribution for each sample
+    Returns cluster membership distribution for each sample. The number of samples is taken from the symbolic
+    shape of latent_space, so the same compiled function works for any batch size
     :param latent_space: latent space representation of inputs
     :param cluster_centers: the coordinates of cluster centers in latent space
-    :param num_clusters: total number of clusters
-    :param latent_space_dim: dimensionality of latent space
-    :param num_samples: total number of input samples
     :return: soft assigment based on the equation qij = (1+|zi - uj|^2)^(-1)/sum_j'((1+|zi - uj'|^2)^(-1))
     '''
-    z_expanded = latent_space.reshape((num_samples, 1, latent_space_dim))
-    z_expanded = T.tile(z_expanded, (1, num_clusters, 1))
-    u_expanded = T.tile(cluster_centers, (num_samples, 1, 1))
-
-    distances_from_cluster_centers = (z_expanded - u_expanded).norm(2, axis=2)
-    qij_numerator = 1 + distances_from_cluster_centers * distances_from_cluster_centers
+    qij_numerator = 1 + getSquaredDistances(latent_space, cluster_centers)
     qij_numerator = 1 / qij_numerator
-    normalizer_q = qij_numerator.sum(axis=1).reshape((num_samples, 1))
+    normalizer_q = qij_numerator.sum(axis=1, keepdims=True)
 
     return qij_numerator / normalizer_q
+
+
+def getSquaredDistances(latent_space, cluster_centers):
+    '''
+    Squared euclidean distances between every sample and every cluster center, computed as
+    |z|^2 - 2 z.u^T + |u|^2 so that the only N x K x D work is a single matrix product and no N x K x D tensor is
+    ever built. Rounding can make the expansion slightly negative for points on top of a center, so it is clamped at 0
+    :param latent_space: latent space representation of inputs (N x D)
+    :param cluster_centers: the coordinates of cluster centers in latent space (K x D)
+    :return: N x K matrix of squared distances
+    '''
+    z_norms = T.sqr(latent_space).sum(axis=1).dimshuffle(0, 'x')
+    u_norms = T.sqr(cluster_centers).sum(axis=1).dimshuffle('x', 0)
+    distances = z_norms - 2 * T.dot(latent_space, cluster_centers.T) + u_norms
+    return T.maximum(distances, 0)
+
+
+def getDistances(latent_space, cluster_centers, epsilon=1e-12):
+    '''
+    Euclidean distances between every sample and every cluster center (N x K), see getSquaredDistances. The squared
+    distances are clamped at epsilon before the square root, so that the gradient stays finite for points lying
+    exactly on a center
+    '''
+    return T.sqrt(T.maximum(getSquaredDistances(latent_space, cluster_centers), epsilon))
@@ -0,0 +1,39 @@
+'''
+Created on Oct 18, 2026
+
+Locations of the architecture files and atomic writing of files. Must not import numpy, sweep.py uses it before the
+thread counts of its workers are set (see sweep.py)
+'''
+import json
+import os
+
+# Json file holding the autoencoder architectures of each dataset
+ARCH_FILES = {'MNIST': 'archs/mnist.json', 'COIL20': 'archs/coil.json'}
+
+
+def loadArchitectures(dataset_name):
+    '''
+    :return: List of the architectures (dictionaries) of the dataset, see ARCH_FILES
+    '''
+    with open(ARCH_FILES[dataset_name]) as archs_file:
+        return json.load(archs_file)
+
+
+def atomicSave(path, writer):
+    '''
+    Writes a file under a temporary name and renames it to path, so that concurrent readers never see a partial file
+    and a crash never leaves one behind. The temporary name is unique per process, so that processes saving the same
+    file do not write into each other's
+    :param path: Location of the file
+    :param writer: Function writing the file to the temporary path it is given. The temporary path ends with the
+                   extension of path, so that writers appending a missing extension (np.save, np.savez) keep it
+    '''
+    root, extension = os.path.splitext(path)
+    tmp_path = '%s.%d.tmp%s' % (root, os.getpid(), extension)
+    try:
+        writer(tmp_path)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,100 @@
+'''
+Created on Oct 18, 2026
+'''
+import cPickle
+import hashlib
+import json
+import os
+
+import lasagne
+import theano
+
+from fileio import atomicSave
+from logsetup import rootLogger
+
+# Sources whose changes can alter the compiled graphs, part of the cache key
+GRAPH_SOURCES = ('network.py', 'customlayers.py')
+
+
+class FunctionCache(object):
+    '''
+    On-disk cache of compiled theano functions, keyed by the architecture, the theano/lasagne versions and
+    configuration, and the sources that build the graphs. What is cached is the function maker holding the optimized
+    graph; loading it skips the graph optimization and only links the graph again (the C code comes from the theano
+    compile cache) against the storage of the current network's shared variables (params, optimizer buffers), so the
+    function trains and predicts with the live parameters. Any failure to load falls back to compiling the function
+    '''
+
+    def __init__(self, cache_dir, network_description):
+        '''
+        :param cache_dir: Folder of the pickled functions
+        :param network_description: Complete architecture dictionary of the network the functions belong to
+        '''
+        self.cache_dir = cache_dir
+        key = hashlib.sha1(json.dumps(network_description, sort_keys=True))
+        key.update(json.dumps([theano.__version__, lasagne.__version__, theano.config.floatX, theano.config.device,
+                               str(theano.config.mode), theano.config.optimizer]))
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for source in GRAPH_SOURCES:
+            with open(os.path.join(source_dir, source), 'rb') as f:
+                key.update(f.read())
+        self.key = key.hexdigest()[:16]
+
+    def compile(self, name, inputs, outputs, updates=None, shared_variables=()):
+        '''
+        Returns the cached function if there is one, otherwise compiles it and adds it to the cache
+        :param name: Name of the function, unique for the architecture
+        :param inputs: Same as for theano.function
+        :param outputs: Same as for theano.function
+        :param updates: Same as for theano.function
+        :param shared_variables: All the shared variables the function may use, in a stable order - the cached
+                                 function is rebound to them by position
+        :return: Compiled theano function
+        '''
+        path = os.path.join(self.cache_dir, '%s_%s.pkl' % (name, self.key))
+        function = self.load(path, shared_variables)
+        if function is None:
+            function = theano.function(inputs, outputs, updates=updates)
+            self.save(path, function, shared_variables)
+        return function
+
+    def load(self, path, shared_variables):
+        # Links the cached graph against the given shared variables, None if that is not possible
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                indices, maker = cPickle.load(f)
+            implicit_inputs = [function_input for function_input in maker.inputs if function_input.implicit]
+            if len(implicit_inputs) != len(indices) or max(indices + [-1]) >= len(shared_variables):
+                raise ValueError('shared variables do not match the network')
+            storage = dict((id(function_input), shared_variables[i].container) for function_input, i in zip(implicit_inputs, indices))
+            for function_input in implicit_inputs:
+                if function_input.variable.type != storage[id(function_input)].type:
+                    raise ValueError('type of %s does not match the network' % function_input.variable)
+            return maker.create([storage.get(id(function_input)) for function_input in maker.inputs])
+        except Exception as e:
+            rootLogger.warning("Could not load the compiled function %s, compiling it again (%s)" % (path, e))
+            return None
+
+    def save(self, path, function, shared_variables):
+        # Pickles the maker of the function with the position of each of its shared variables in shared_variables. Variables are
+        # matched by their storage, as some layers use memory-aliased clones of their params (e.g. the batch norm averages)
+        positions = dict((id(variable.container), i) for i, variable in enumerate(shared_variables))
+        function_shared = [function_input.variable for function_input in function.maker.inputs if function_input.implicit]
+        if any(id(variable.container) not in positions for variable in function_shared):
+            rootLogger.debug("Not caching %s, it uses shared variables outside of the network state" % path)
+            return
+        indices = [positions[id(variable.container)] for variable in function_shared]
+
+        def writer(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump((indices, function.maker), f, cPickle.HIGHEST_PROTOCOL)
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Parallel runs of the same architecture may save the same function, each writes its own temporary file
+            atomicSave(path, writer)
+        except Exception as e:
+            rootLogger.warning("Could not cache the compiled function %s (%s)" % (path, e))
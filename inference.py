@@ -0,0 +1,256 @@
+'''
+Created on Oct 18, 2026
+
+Runs the encoder of a trained autoencoder with numpy only - no theano or lasagne import, no compilation - so that new
+samples can be embedded and assigned to the learned clusters with a start up time of milliseconds
+'''
+import argparse
+import os
+import time
+
+import numpy as np
+
+from artifact import CLUSTER_CENTERS, STAGE_PREFIXES, ModelArtifact, getArtifactPath
+from fileio import ARCH_FILES, loadArchitectures
+
+# Upper bound of the im2col patch matrix of a convolution, larger batches are convolved in parts
+IM2COL_BYTES = 1 << 26
+
+
+def rectify(x):
+    return np.maximum(x, 0, out=x)
+
+
+def linear(x):
+    return x
+
+
+def elu(x):
+    return np.where(x > 0, x, np.expm1(x))
+
+
+NON_LINEARITIES = {'rectify': rectify, 'linear': linear, 'elu': elu}
+
+
+def getSoftAssignments(Z, cluster_centers):
+    '''
+    Numpy version of the ClusteringLayer output, with the same GEMM based distances
+    :param Z: Latent space representation of the inputs (N x D)
+    :param cluster_centers: The coordinates of cluster centers in latent space (K x D)
+    :return: qij = (1+|zi - uj|^2)^(-1)/sum_j'((1+|zi - uj'|^2)^(-1))
+    '''
+    distances = (Z * Z).sum(axis=1)[:, None] - 2 * np.dot(Z, cluster_centers.T) + (cluster_centers * cluster_centers).sum(axis=1)[None, :]
+    qij = 1 / (1 + np.maximum(distances, 0))
+    return qij / qij.sum(axis=1)[:, None]
+
+
+def conv2d(x, W, pad):
+    '''
+    Convolution of a batch of images as one matrix product over the im2col patch matrix. Lasagne flips the filters
+    (true convolution), so the filters are flipped here before the patches are correlated with them
+    :param x: Input batch (N x C x H x W)
+    :param W: Filters (F x C x h x w)
+    :param pad: Zero padding on each side of the two image dimensions
+    :return: Output batch (N x F x H' x W')
+    '''
+    num_filters, channels, filter_h, filter_w = W.shape
+    if pad:
+        x = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+    x = np.ascontiguousarray(x)
+    out_h = x.shape[2] - filter_h + 1
+    out_w = x.shape[3] - filter_w + 1
+    kernel = W[:, :, ::-1, ::-1].reshape((num_filters, -1)).T
+    out = np.empty((x.shape[0], out_h, out_w, num_filters), dtype=x.dtype)
+    rows = max(1, IM2COL_BYTES // (out_h * out_w * kernel.shape[0] * x.itemsize))
+    for start_idx in range(0, x.shape[0], rows):
+        part = x[start_idx:start_idx + rows]
+        strides = part.strides
+        patches = np.lib.stride_tricks.as_strided(part, shape=(part.shape[0], out_h, out_w, channels, filter_h, filter_w),
+                                                  strides=(strides[0], strides[2], strides[3], strides[1], strides[2], strides[3]))
+        np.dot(patches.reshape((-1, kernel.shape[0])), kernel, out=out[start_idx:start_idx + rows].reshape((-1, num_filters)))
+    return out.transpose((0, 3, 1, 2))
+
+
+def maxPool2d(x, pool_size):
+    # Non overlapping pooling that drops the border rows/columns, like lasagne's MaxPool2DLayer (ignore_border=True)
+    pool_h, pool_w = pool_size
+    out_h, out_w = x.shape[2] // pool_h, x.shape[3] // pool_w
+    x = x[:, :, :out_h * pool_h, :out_w * pool_w]
+    return x.reshape((x.shape[0], x.shape[1], out_h, pool_h, out_w, pool_w)).max(axis=(3, 5))
+
+
+class NumpyEncoder(object):
+    '''
+    Encoder half of an autoencoder built by NetworkBuilder, evaluated with numpy in inference mode (batch norm with the
+    saved statistics). Takes the same params as the theano network, in the order lasagne saved them
+    '''
+
+    def __init__(self, network_description, param_values, batch_norm_values=None, cluster_centers=None):
+        '''
+        :param network_description: python dictionary specifying the autoencoder architecture (archs/*.json)
+        :param param_values: Trainable params of the autoencoder in the order of lasagne - only the leading ones of the
+                             encoder are used
+        :param batch_norm_values: Batch norm statistics of the encoder (mean, inv_std per normalized layer), required if
+                                  the architecture uses batch norm
+        :param cluster_centers: Centers of the clustering layer, None if only the latent space is needed
+        '''
+        self.name = network_description['name']
+        if 'network_type' in network_description:
+            self.network_type = network_description['network_type']
+        else:
+            self.network_type = 'AE' if network_description['name'].split('_')[0].split('-')[0] == 'fc' else 'CAE'
+        self.batch_norm = bool(network_description.get('use_batch_norm', False))
+        self.inference_batch_size = network_description.get('inference_batch_size', max(500, network_description['batch_size']))
+        layer_descriptions = network_description['layers']
+        self.input_shape = tuple(layer_descriptions[0]['output_shape'])
+        if self.network_type == 'AE':
+            self.input_shape = self.input_shape[2:]
+        params = (np.asarray(value, dtype=np.float32) for value in param_values)
+        statistics = (np.asarray(value, dtype=np.float32) for value in batch_norm_values or [])
+        self.layers = []
+        for layer in layer_descriptions[1:]:
+            if layer['type'] == 'Conv2D':
+                # Batch norm replaces the bias of the convolution by its beta and gamma (see lasagne.layers.batch_norm)
+                W = next(params)
+                spec = {'type': 'Conv2D', 'W': W, 'non_linearity': layer['non_linearity'],
+                        'pad': W.shape[2] // 2 if layer.get('conv_mode', 'valid') == 'same' else 0}
+                if self.batch_norm:
+                    beta, gamma = next(params), next(params)
+                    try:
+                        mean, inv_std = next(statistics), next(statistics)
+                    except StopIteration:
+                        raise ValueError('Architecture %s uses batch norm, but no batch norm statistics were given' % self.name)
+                    # Inference mode: (x - mean) * inv_std * gamma + beta, folded into one scale and shift per channel
+                    spec['scale'] = (gamma * inv_std)[None, :, None, None]
+                    spec['shift'] = (beta - mean * gamma * inv_std)[None, :, None, None]
+                else:
+                    spec['shift'] = next(params)[None, :, None, None]
+            elif layer['type'] in ('MaxPool2D', 'MaxPool2D*'):
+                spec = {'type': 'MaxPool2D', 'pool_size': tuple(layer['filter_size'])}
+            elif layer['type'] == 'Dense':
+                spec = {'type': 'Dense', 'W': next(params), 'shift': next(params), 'non_linearity': layer['non_linearity']}
+            else:
+                raise ValueError('Layer type %s is not part of an encoder' % layer['type'])
+            self.layers.append(spec)
+        self.cluster_centers = None
+        if cluster_centers is not None:
+            self.cluster_centers = np.asarray(cluster_centers, dtype=np.float32)
+
+    @staticmethod
+    def load(network_description, dataset_name, stage='pretrain', params_dir='saved_params'):
+        '''
+        :param network_description: python dictionary specifying the autoencoder architecture
+        :param dataset_name: Dataset the network was trained on
+        :param stage: Training stage whose params are loaded - pretrain, kld or km (see STAGE_PREFIXES)
+        :param params_dir: Folder the stages saved their params to
+        :return: NumpyEncoder with the params, batch norm statistics and (for the clustering stages) cluster centers of the stage
+        '''
+        artifact_path = getArtifactPath(dataset_name, stage, network_description['name'], params_dir)
+        if os.path.exists(artifact_path):
+            # Only the arrays of the encoder are mapped, the decoder is never read
+            artifact = ModelArtifact(artifact_path)
+            artifact.validate(network_description)
+            param_values = [array for name, array in artifact.getArrays(encoder_only=True, trainable=True)]
+            batch_norm_values = [array for name, array in artifact.getArrays(encoder_only=True, trainable=False)]
+            cluster_centers = None
+            if CLUSTER_CENTERS in artifact.getNames():
+                cluster_centers = artifact.getArray(CLUSTER_CENTERS)
+            return NumpyEncoder(network_description, param_values, batch_norm_values, cluster_centers)
+        # Separate .npz/.npy files of the params, batch norm statistics and cluster centers saved before the model files
+        path = '%s/%s/%s%%s_%s.%%s' % (params_dir, dataset_name, STAGE_PREFIXES[stage], network_description['name'])
+        with np.load(path % ('m', 'npz')) as f:
+            param_values = [f['arr_%d' % i] for i in range(len(f.files))]
+        batch_norm_values = None
+        if network_description.get('use_batch_norm', False):
+            with np.load(path % ('bn', 'npz')) as f:
+                batch_norm_values = [f['arr_%d' % i] for i in range(len(f.files))]
+        cluster_centers = None
+        if stage != 'pretrain':
+            cluster_centers = np.load(path % ('c', 'npy'))
+        return NumpyEncoder(network_description, param_values, batch_norm_values, cluster_centers)
+
+    def encode(self, inputs):
+        '''
+        :param inputs: Batch of network inputs (float, scaled like the training batches), with one sample per row in
+                       any shape holding the pixels of the input layer
+        :return: Latent space representation of the batch, same as DCJC.predictEncoding
+        '''
+        x = np.asarray(inputs, dtype=np.float32).reshape((-1,) + self.input_shape)
+        for layer in self.layers:
+            if layer['type'] == 'MaxPool2D':
+                x = maxPool2d(x, layer['pool_size'])
+                continue
+            if layer['type'] == 'Conv2D':
+                x = conv2d(x, layer['W'], layer['pad'])
+                if 'scale' in layer:
+                    x = x * layer['scale']
+            else:
+                x = np.dot(x.reshape((x.shape[0], -1)), layer['W'])
+            x = NON_LINEARITIES[layer['non_linearity']](x + layer['shift'])
+        return x.reshape((x.shape[0], -1))
+
+    def predict(self, inputs, batch_size=None, scale=None):
+        '''
+        Encodes an array of samples batch by batch and assigns them to the clusters
+        :param inputs: Samples (array or memory map), one per row, e.g. the stored uint8 pixels of a dataset
+        :param batch_size: Number of samples encoded at a time, the inference batch size of the architecture by default
+        :param scale: Factor that converts the samples to network inputs (e.g. the scale of a dataset stored as uint8),
+                      None if they are network inputs already
+        :return: Latent space (N x D), hard assignments (N) and soft assignments (N x K) - the assignments are None if
+                 the encoder has no cluster centers
+        '''
+        batch_size = batch_size or self.inference_batch_size
+        Z = hard = soft = None
+        for start_idx in range(0, inputs.shape[0], batch_size):
+            batch = np.asarray(inputs[start_idx:start_idx + batch_size])
+            if scale is not None:
+                batch = np.multiply(batch, np.float32(scale), dtype=np.float32)
+            z = self.encode(batch)
+            if Z is None:
+                Z = np.empty((inputs.shape[0], z.shape[1]), dtype=np.float32)
+            Z[start_idx:start_idx + batch_size] = z
+            if self.cluster_centers is not None:
+                q = getSoftAssignments(z, self.cluster_centers)
+                if soft is None:
+                    soft = np.empty((inputs.shape[0], q.shape[1]), dtype=np.float32)
+                    hard = np.empty(inputs.shape[0], dtype=np.int64)
+                soft[start_idx:start_idx + batch_size] = q
+                hard[start_idx:start_idx + batch_size] = q.argmax(axis=1)
+        return Z, hard, soft
+
+
+if __name__ == '__main__':
+    '''
+    usage: inference.py [-h] -d {COIL20,MNIST} -a ARCHITECTURE
+                        [--stage {km,kld,pretrain}] [--input INPUT]
+                        [--scale SCALE] [--batch-size BATCH_SIZE] --output
+                        OUTPUT
+    '''
+    parser = argparse.ArgumentParser()
+    requiredArgs = parser.add_argument_group('required arguments')
+    requiredArgs.add_argument("-d", "--dataset", choices=sorted(ARCH_FILES), help="Dataset the network was trained on", required=True)
+    requiredArgs.add_argument("-a", "--architecture", type=int, help="Index of architecture of autoencoder in the json file (archs/)", required=True)
+    requiredArgs.add_argument("--output", help="Write the latent space and the hard and soft assignments to this .npz file", required=True)
+    parser.add_argument("--stage", choices=sorted(STAGE_PREFIXES), default='kld', help="Training stage whose params and cluster centers are used")
+    parser.add_argument("--input", help=".npy file of samples to encode (memory mapped), the whole dataset by default")
+    parser.add_argument("--scale", type=float, help="Factor converting the samples of --input to network inputs, e.g. 0.00390625 for uint8 pixels")
+    parser.add_argument("--batch-size", type=int, help="Samples encoded at a time (default: inference batch size of the architecture)")
+    args = parser.parse_args()
+    arch = loadArchitectures(args.dataset)[args.architecture]
+    start_time = time.time()
+    encoder = NumpyEncoder.load(arch, args.dataset, args.stage)
+    print("Loaded %s (%s) in %.1fms" % (arch['name'], args.stage, 1000 * (time.time() - start_time)))
+    if args.input:
+        inputs, scale = np.load(args.input, mmap_mode='r'), args.scale
+    else:
+        from misc import DatasetHelper
+        dataset = DatasetHelper(args.dataset)
+        dataset.loadDataset()
+        inputs, scale = dataset.input, dataset.scale
+    start_time = time.time()
+    Z, hard, soft = encoder.predict(inputs, args.batch_size, scale)
+    print("Encoded %d samples in %.2fs" % (inputs.shape[0], time.time() - start_time))
+    results = {'Z': Z}
+    if hard is not None:
+        results.update(hard=hard, soft=soft)
+    np.savez(args.output, **results)
@@ -0,0 +1,43 @@
+'''
+Created on Oct 18, 2026
+'''
+from datetime import datetime
+import logging
+import os
+
+# Logging utilities - logs get saved in folder logs named by date and time, and also output
+# at standard output
+
+logFormatter = logging.Formatter("[%(asctime)s]  %(message)s", datefmt='%m/%d %I:%M:%S')
+
+rootLogger = logging.getLogger()
+
+logFileName = None
+# Process that set up the handlers, a forked child (e.g a sweep worker) sets up its own log file
+loggingPid = None
+logHandlers = []
+
+
+def setupLogging(run_name=None):
+    '''
+    Opens the log file of the run and adds the console output. Called by the entry points instead of at import time,
+    so that importing a module never creates a log file; only the first call of a process has an effect
+    :param run_name: Appended to the log file name, to keep apart the logs of runs started at the same time
+    :return: Name of the log file
+    '''
+    global logFileName, loggingPid
+    if logFileName is None or loggingPid != os.getpid():
+        # Handlers inherited from the parent process would write to the parent's log file
+        for handler in logHandlers:
+            rootLogger.removeHandler(handler)
+        del logHandlers[:]
+        logFileName = datetime.now().strftime('logs/dcjc_%H_%M_%d_%m') + ('_' + run_name if run_name else '') + '.log'
+        loggingPid = os.getpid()
+        rootLogger.setLevel(logging.DEBUG)
+        fileHandler = logging.FileHandler(logFileName)
+        consoleHandler = logging.StreamHandler()
+        for handler in (fileHandler, consoleHandler):
+            handler.setFormatter(logFormatter)
+            rootLogger.addHandler(handler)
+            logHandlers.append(handler)
+    return logFileName
@@ -2,32 +2,37 @@
 Created on Jul 9, 2017
 '''
 import numpy
-import json
-from misc import DatasetHelper, evaluateKMeans, visualizeData
-from network import DCJC, rootLogger
+from fileio import loadArchitectures
+from logsetup import rootLogger, setupLogging
+from misc import DatasetHelper, evaluateKMeansCached, getTSNEEmbeddings, plotEmbedding
 import argparse
 
 
-def testOnlyClusterInitialization(dataset_name, arch, epochs):
+def testOnlyClusterInitialization(dataset_name, arch, epochs, dcjc_options=None, resume=False, stream_cache_mb=None):
     '''
     Train an autoencoder defined by architecture arch and trains it with the dataset defined
     :param dataset_name: Name of the dataset with which the network will be trained [MNIST, COIL20]
     :param arch: Architecture of the network as a dictionary. Specification for architecture can be found in readme.md
     :param epochs: Number of train epochs
+    :param dcjc_options: Keyword arguments for the DCJC constructor (data pipeline and training loop options)
+    :param resume: Continue from the last pretraining checkpoint if there is one
+    :param stream_cache_mb: Shuffle the minibatches within windows of this many megabytes (see DatasetHelper), None to shuffle globally
     :return: None - (side effect) saves the latent space and params of trained network in an appropriate location in saved_params folder
     '''
     rootLogger.info("Loading dataset")
-    dataset = DatasetHelper(dataset_name)
+    dataset = DatasetHelper(dataset_name, stream_cache_mb)
     dataset.loadDataset()
     rootLogger.info("Done loading dataset")
     rootLogger.info("Creating network")
-    dcjc = DCJC(arch)
+    # Theano and lasagne are only imported by the stages that build a network
+    from network import DCJC
+    dcjc = DCJC(arch, **(dcjc_options or {}))
     rootLogger.info("Done creating network")
     rootLogger.info("Starting training")
-    dcjc.pretrainWithData(dataset, epochs, False);
+    dcjc.pretrainWithData(dataset, epochs, False, resume)
 
 
-def testOnlyClusterImprovement(dataset_name, arch, epochs, method):
+def testOnlyClusterImprovement(dataset_name, arch, epochs, method, dcjc_options=None, resume=False, stream_cache_mb=None):
     '''
     Use an initialized autoencoder and train it along with clustering loss. Assumed that pretrained autoencoder params
     are available, i.e. testOnlyClusterInitialization has been run already with the given params
@@ -35,28 +40,35 @@ def testOnlyClusterImprovement(dataset_name, arch, epochs, method):
     :param arch: Architecture of the network as a dictionary. Specification for architecture can be found in readme.md
     :param epochs: Number of train epochs
     :param method: Can be KM or KLD - depending on whether the clustering loss is KLDivergence loss between the current KMeans distribution(Q) and a more desired one(Q^2), or if the clustering loss is just the Kmeans loss
+    :param dcjc_options: Keyword arguments for the DCJC constructor (data pipeline and training loop options)
+    :param resume: Continue from the last checkpoint of the clustering stage if there is one
+    :param stream_cache_mb: Shuffle the minibatches within windows of this many megabytes (see DatasetHelper), None to shuffle globally
     :return: None - (side effect) saves latent space and params of the trained network
     '''
     rootLogger.info("Loading dataset")
-    dataset = DatasetHelper(dataset_name)
+    dataset = DatasetHelper(dataset_name, stream_cache_mb)
     dataset.loadDataset()
     rootLogger.info("Done loading dataset")
     rootLogger.info("Creating network")
-    dcjc = DCJC(arch)
+    # Theano and lasagne are only imported by the stages that build a network
+    from network import DCJC
+    dcjc = DCJC(arch, **(dcjc_options or {}))
     rootLogger.info("Starting cluster improvement")
     if method == 'KM':
-        dcjc.doClusteringWithKMeansLoss(dataset, epochs)
+        dcjc.doClusteringWithKMeansLoss(dataset, epochs, resume)
     elif method == 'KLD':
-        dcjc.doClusteringWithKLdivLoss(dataset, True, epochs)
+        dcjc.doClusteringWithKLdivLoss(dataset, True, epochs, resume)
 
 
-def testKMeans(dataset_name, archs):
+def testKMeans(dataset_name, archs, n_jobs=-1):
     '''
     Performs kMeans clustering, and report metrics on the output latent space produced by the networks defined in archs,
     with given dataset. Assumes that testOnlyClusterInitialization and testOnlyClusterImprovement have been run before
-    this for the specified archs/datasets, as the results saved by them are used for clustering
+    this for the specified archs/datasets, as the results saved by them are used for clustering. The kmeans results are
+    cached, only spaces that were not clustered before are clustered again
     :param dataset_name: Name of dataset [MNIST, COIL20]
     :param archs: Architectures as a dictionary
+    :param n_jobs: Number of processes the kmeans restarts are spread over, -1 for all cores
     :return: None - reports the accuracy and nmi clustering metrics
     '''
     rootLogger.info('Initial Cluster Quality Comparison')
@@ -65,22 +77,23 @@ def testKMeans(dataset_name, archs):
     rootLogger.info(80 * '_')
     dataset = DatasetHelper(dataset_name)
     dataset.loadDataset()
-    rootLogger.info(evaluateKMeans(dataset.input_flat, dataset.labels, dataset.getClusterCount(), 'image')[0])
+    rootLogger.info(evaluateKMeansCached(dataset.input_flat, dataset.labels, dataset.getClusterCount(), 'image', n_jobs=n_jobs,
+                                         scale=dataset.scale)[0])
     for arch in archs:
-        Z = numpy.load('saved_params/' + dataset.name + '/z_' + arch['name'] + '.npy')
-        rootLogger.info(evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), arch['name'])[0])
-        Z = numpy.load('saved_params/' + dataset.name + '/pc_z_' + arch['name'] + '.npy')
-        rootLogger.info(evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), arch['name'])[0])
-        Z = numpy.load('saved_params/' + dataset.name + '/pc_km_z_' + arch['name'] + '.npy')
-        rootLogger.info(evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), arch['name'])[0])
+        for prefix in ('z_', 'pc_z_', 'pc_km_z_'):
+            Z = numpy.load('saved_params/' + dataset.name + '/' + prefix + arch['name'] + '.npy', mmap_mode='r')
+            rootLogger.info(evaluateKMeansCached(Z, dataset.labels, dataset.getClusterCount(), arch['name'], n_jobs=n_jobs)[0])
     rootLogger.info(80 * '_')
 
 
-def visualizeLatentSpace(dataset_name, arch):
+def visualizeLatentSpace(dataset_name, arch, max_points=5000, pca_dims=None, processes=4):
     '''
     Plots and saves graphs for visualized images space, autoencoder latent space, and the final clustering latent space
     :param dataset_name: Name of dataset [MNIST, COIL20]
     :param arch: Architectures as a dictionary
+    :param max_points: Number of points plotted, from the start of the dataset
+    :param pca_dims: Reduce the points to this many dimensions with PCA before TSNE, None to use all dimensions
+    :param processes: Number of TSNE embeddings computed at the same time
     :return: None - (side effect) saved graphs in plots/ folder
     '''
     rootLogger.info("Loading dataset")
@@ -88,18 +101,14 @@ def visualizeLatentSpace(dataset_name, arch):
     dataset.loadDataset()
     rootLogger.info("Done loading dataset")
     # We consider only the first 5000 point or less for better visualization
-    max_points = min(dataset.input_flat.shape[0], 5000)
-    # Image space
-    visualizeData(dataset.input_flat[0:max_points], dataset.labels[0:max_points], dataset.getClusterCount(), "plots/%s/raw.png" % dataset.name)
-    # Latent space - autoencoder
-    Z = numpy.load('saved_params/' + dataset.name + '/z_' + arch['name'] + '.npy')
-    visualizeData(Z[0:max_points], dataset.labels[0:max_points], dataset.getClusterCount(), "plots/%s/autoencoder.png" % dataset.name)
-    # Latent space - kl div clustering network
-    Z = numpy.load('saved_params/' + dataset.name + '/pc_z_' + arch['name'] + '.npy')
-    visualizeData(Z[0:max_points], dataset.labels[0:max_points], dataset.getClusterCount(), "plots/%s/clustered_kld.png" % dataset.name)
-    # Latent space - kmeans clustering network
-    Z = numpy.load('saved_params/' + dataset.name + '/pc_km_z_' + arch['name'] + '.npy')
-    visualizeData(Z[0:max_points], dataset.labels[0:max_points], dataset.getClusterCount(), "plots/%s/clustered_km.png" % dataset.name)
+    max_points = min(dataset.input_flat.shape[0], max_points)
+    # Image space, latent space - autoencoder, latent space - kl div clustering network, latent space - kmeans clustering network
+    plots = ['raw', 'autoencoder', 'clustered_kld', 'clustered_km']
+    latent_spaces = [dataset.input_flat] + [numpy.load('saved_params/%s/%s%s.npy' % (dataset.name, prefix, arch['name']), mmap_mode='r')
+                                            for prefix in ('z_', 'pc_z_', 'pc_km_z_')]
+    embeddings = getTSNEEmbeddings(latent_spaces, max_points, pca_dims, processes, scales=[dataset.scale, None, None, None])
+    for plot, embedding in zip(plots, embeddings):
+        plotEmbedding(embedding, dataset.labels[0:max_points], dataset.getClusterCount(), "plots/%s/%s.png" % (dataset.name, plot))
 
 
 if __name__ == '__main__':
@@ -128,14 +137,75 @@ if __name__ == '__main__':
                             Visualize the image space and latent space, assumes
                             pretraining and cluster based training have been
                             performed
+      --prefetch PREFETCH   Number of training minibatches prepared ahead on a
+                            background thread, 0 disables prefetching
+      --report-data-wait    Log the time spent waiting for minibatches in every
+                            training epoch
+      --eval-mode {full,warm,minibatch,chunked}
+                            KMeans used for monitoring the latent space while
+                            training
+      --eval-every EVAL_EVERY
+                            Evaluate the latent space every EVAL_EVERY epochs
+                            while training
+      --resume              Continue the pretraining/clustering from their last
+                            checkpoint
+      --checkpoint-every CHECKPOINT_EVERY
+                            Checkpoint the full training state every
+                            CHECKPOINT_EVERY epochs
+      --checkpoint-minutes CHECKPOINT_MINUTES
+                            Checkpoint the full training state every
+                            CHECKPOINT_MINUTES minutes (default 15)
+      --no-function-cache   Always compile the theano functions instead of loading
+                            them from the compiled function cache
+      --kmeans-jobs KMEANS_JOBS
+                            Number of processes the kmeans restarts of the
+                            reports are spread over (default -1, all cores)
+      --tsne-points TSNE_POINTS
+                            Number of points plotted by --visualize (default 5000)
+      --tsne-pca TSNE_PCA   Reduce the points to TSNE_PCA dimensions with PCA
+                            before TSNE
+      --tsne-jobs TSNE_JOBS
+                            Number of TSNE embeddings computed in parallel
+                            (default 4)
+      --stream-cache STREAM_CACHE
+                            Shuffle the training minibatches within windows of
+                            STREAM_CACHE megabytes of block-shuffled samples, for
+                            datasets larger than the memory
+      --out-of-core         Keep the latent space and the Q/P distributions in
+                            memory mapped files and cluster with chunked kmeans,
+                            for latent spaces larger than the memory
+      --update-interval UPDATE_INTERVAL
+                            Refresh the target distribution of the clustering
+                            every UPDATE_INTERVAL iterations (default once per
+                            epoch)
+      --tol TOL             Stop the clustering once less than TOL of the
+                            samples changed their cluster assignment between two
+                            refreshes of the target distribution
+      --lr-schedule {decay,plateau}
+                            Learning rate schedule of the pretraining
+      --lr-patience LR_PATIENCE
+                            Epochs without improvement after which the plateau
+                            schedule reduces the learning rate (default 5)
+      --lr-factor LR_FACTOR
+                            Factor by which the plateau schedule reduces the
+                            learning rate (default 0.5)
+      --stop-patience STOP_PATIENCE
+                            Stop the pretraining after STOP_PATIENCE epochs
+                            without improvement of the loss
+      --time-budget TIME_BUDGET
+                            Stop the pretraining before it runs longer than
+                            TIME_BUDGET minutes
+      --target-loss TARGET_LOSS
+                            Stop the pretraining once the training loss is at
+                            most TARGET_LOSS
+      --workers WORKERS     Number of processes the pretraining is spread over
+                            (data parallel, default 1)
+      --sync-every SYNC_EVERY
+                            Number of train steps of each worker between two
+                            averagings of the parameters (default 10)
+      --async-eval          Monitor the latent space in a background process
+                            while training continues
     '''
-    # Load architectures from the json files
-    mnist_archs = []
-    coil_archs = []
-    with open("archs/coil.json") as archs_file:
-        coil_archs = json.load(archs_file)
-    with open("archs/mnist.json") as archs_file:
-        mnist_archs = json.load(archs_file)
     # Argument parsing
     parser = argparse.ArgumentParser()
     requiredArgs = parser.add_argument_group('required arguments')
@@ -145,19 +215,55 @@ if __name__ == '__main__':
     parser.add_argument("--cluster", type=int, help="Refine the autoencoder for specified #epochs with clustering loss, assumes that pretraining results are available")
     parser.add_argument("--metrics", action='store_true', help="Report k-means clustering metrics on the clustered latent space, assumes pretrain and cluster based training have been performed")
     parser.add_argument("--visualize", action='store_true', help="Visualize the image space and latent space, assumes pretraining and cluster based training have been performed")
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of training minibatches prepared ahead on a background thread, 0 disables prefetching")
+    parser.add_argument("--report-data-wait", action='store_true', help="Log the time spent waiting for minibatches in every training epoch")
+    parser.add_argument("--eval-mode", choices=['full', 'warm', 'minibatch', 'chunked'], default='full', help="KMeans used for monitoring the latent space while training: full restarts, warm started from the previous centers, warm started MiniBatchKMeans, or MiniBatchKMeans fed chunk by chunk")
+    parser.add_argument("--eval-every", type=int, help="Evaluate the latent space every EVAL_EVERY epochs while training (default 2 for pretraining, 10 for clustering)")
+    parser.add_argument("--resume", action='store_true', help="Continue the pretraining/clustering from their last checkpoint")
+    parser.add_argument("--checkpoint-every", type=int, help="Checkpoint the full training state every CHECKPOINT_EVERY epochs")
+    parser.add_argument("--checkpoint-minutes", type=float, default=15, help="Checkpoint the full training state after an epoch if CHECKPOINT_MINUTES minutes passed since the last checkpoint (default 15)")
+    parser.add_argument("--no-function-cache", action='store_true', help="Always compile the theano functions instead of loading them from the compiled function cache (cache/functions)")
+    parser.add_argument("--kmeans-jobs", type=int, default=-1, help="Number of processes the kmeans restarts of the reports are spread over (default -1, all cores)")
+    parser.add_argument("--tsne-points", type=int, default=5000, help="Number of points plotted by --visualize (default 5000)")
+    parser.add_argument("--tsne-pca", type=int, help="Reduce the points to TSNE_PCA dimensions with PCA before TSNE")
+    parser.add_argument("--tsne-jobs", type=int, default=4, help="Number of TSNE embeddings computed in parallel (default 4)")
+    parser.add_argument("--stream-cache", type=int, help="Shuffle the training minibatches within windows of STREAM_CACHE megabytes of block-shuffled samples, for datasets larger than the memory")
+    parser.add_argument("--out-of-core", action='store_true', help="Keep the latent space and the Q/P distributions in memory mapped files and cluster with chunked kmeans, for latent spaces larger than the memory")
+    parser.add_argument("--update-interval", type=int, help="Refresh the target distribution of the clustering every UPDATE_INTERVAL iterations (default once per epoch)")
+    parser.add_argument("--tol", type=float, help="Stop the clustering once less than TOL of the samples changed their cluster assignment between two refreshes of the target distribution (e.g. 0.001), instead of always training for --cluster epochs")
+    parser.add_argument("--lr-schedule", choices=['decay', 'plateau'], default='decay', help="Learning rate schedule of the pretraining: decay by 0.9999 per epoch, or reduce on plateaus of the loss")
+    parser.add_argument("--lr-patience", type=int, default=5, help="Epochs without improvement after which the plateau schedule reduces the learning rate (default 5)")
+    parser.add_argument("--lr-factor", type=float, default=0.5, help="Factor by which the plateau schedule reduces the learning rate (default 0.5)")
+    parser.add_argument("--stop-patience", type=int, help="Stop the pretraining after STOP_PATIENCE epochs without improvement of the loss")
+    parser.add_argument("--time-budget", type=float, help="Stop the pretraining before it runs longer than TIME_BUDGET minutes")
+    parser.add_argument("--target-loss", type=float, help="Stop the pretraining once the training loss is at most TARGET_LOSS")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes the pretraining is spread over (data parallel, default 1)")
+    parser.add_argument("--sync-every", type=int, default=10, help="Number of train steps of each worker between two averagings of the parameters and momentum (default 10)")
+    parser.add_argument("--async-eval", action='store_true', help="Monitor the latent space in a background process while training continues, metrics are logged when ready")
     args = parser.parse_args()
+    if args.update_interval is not None and args.update_interval < 1:
+        parser.error('--update-interval must be at least 1')
+    setupLogging()
     # Train/Visualize as per the arguments
     dataset_name = args.dataset
     arch_index = args.architecture
-    if dataset_name == 'MNIST':
-        archs = mnist_archs
-    elif dataset_name == 'COIL20':
-        archs = coil_archs
+    # Load architectures from the json file of the dataset
+    archs = loadArchitectures(dataset_name)
+    dcjc_options = {'prefetch': args.prefetch, 'report_data_wait': args.report_data_wait,
+                    'eval_mode': args.eval_mode, 'eval_interval': args.eval_every,
+                    'checkpoint_epochs': args.checkpoint_every, 'checkpoint_minutes': args.checkpoint_minutes,
+                    'kmeans_jobs': args.kmeans_jobs, 'out_of_core': args.out_of_core,
+                    'update_interval': args.update_interval, 'tol': args.tol,
+                    'lr_schedule': args.lr_schedule, 'lr_patience': args.lr_patience, 'lr_factor': args.lr_factor,
+                    'stop_patience': args.stop_patience, 'time_budget': args.time_budget, 'target_loss': args.target_loss,
+                    'workers': args.workers, 'sync_interval': args.sync_every, 'async_eval': args.async_eval}
+    if args.no_function_cache:
+        dcjc_options['function_cache_dir'] = None
     if args.pretrain:
-        testOnlyClusterInitialization(dataset_name, archs[arch_index], args.pretrain)
+        testOnlyClusterInitialization(dataset_name, archs[arch_index], args.pretrain, dcjc_options, args.resume, args.stream_cache)
     if args.cluster:
-        testOnlyClusterImprovement(dataset_name, archs[arch_index], args.cluster, "KLD")
+        testOnlyClusterImprovement(dataset_name, archs[arch_index], args.cluster, "KLD", dcjc_options, args.resume, args.stream_cache)
     if args.metrics:
-        testKMeans(dataset_name, [archs[arch_index]])
+        testKMeans(dataset_name, [archs[arch_index]], args.kmeans_jobs)
     if args.visualize:
-        visualizeLatentSpace(dataset_name, archs[arch_index])
+        visualizeLatentSpace(dataset_name, archs[arch_index], args.tsne_points, args.tsne_pca, args.tsne_jobs)
@@ -4,34 +4,41 @@ Created on Jul 11, 2017
 
 import cPickle
 import gzip
+import json
+import multiprocessing
+import os
+import Queue
+import signal
+import threading
+import time
+import traceback
 
 import numpy as np
-from PIL import Image
-import matplotlib
-
-# For plotting graphs via ssh with no display
-# Ref: https://stackoverflow.com/questions/2801882/generating-a-png-with-matplotlib-when-display-is-undefined
-matplotlib.use('Agg')
-
-from matplotlib import pyplot as plt
 from numpy import float32
-from sklearn import metrics
-from sklearn.cluster.k_means_ import KMeans
-from sklearn import manifold
-from sklearn.utils.linear_assignment_ import linear_assignment
 
+from clustermetrics import ContingencyMatrix, clusteringScores
+from fileio import atomicSave
+from resultcache import ResultCache, arrayDigest, getCacheKey
+
+# Size of the contiguous blocks of samples that are shuffled as units when streaming, and of the chunks in which
+# large datasets are copied into the cache
+STREAM_BLOCK_BYTES = 1 << 20
 
 class DatasetHelper(object):
     '''
     Utility class for handling different datasets
     '''
 
-    def __init__(self, name):
+    def __init__(self, name, stream_cache_mb=None):
         '''
         A dataset instance keeps dataset name, the input set, the flat version of input set
         and the cluster labels
+        :param stream_cache_mb: If set, shuffled minibatches are drawn from windows of at most stream_cache_mb
+                                megabytes of block-shuffled contiguous samples instead of the whole dataset, so that a
+                                memory mapped dataset larger than the memory is read with a bounded working set
         '''
         self.name = name
+        self.stream_cache_mb = stream_cache_mb
         if name == 'MNIST':
             self.dataset = MNISTDataset()
         elif name == 'STL':
@@ -39,11 +46,27 @@ class DatasetHelper(object):
         elif name == 'COIL20':
             self.dataset = COIL20Dataset()
 
-    def loadDataset(self):
+    def loadDataset(self, use_cache=True):
         '''
         Load the appropriate dataset based on the dataset name
+        :param use_cache: Open the preprocessed arrays from the on-disk cache (memory mapped), building the cache
+                          from the original files the first time. If False, the original files are parsed in memory
+        '''
+        if use_cache:
+            self.input, self.labels, self.input_flat = loadCachedDataset(self.name, self.dataset)
+        else:
+            self.input, self.labels, self.input_flat = self.dataset.loadDataset()
+        # The inputs are kept in their compact stored form (uint8), batches are scaled to float32 when they are served
+        self.scale = self.dataset.scale
+
+    def normalize(self, batch):
+        '''
+        :param batch: Samples in the stored form of the dataset
+        :return: The samples as float32 network inputs
         '''
-        self.input, self.labels, self.input_flat = self.dataset.loadDataset()
+        if self.scale is None:
+            return batch
+        return np.multiply(batch, np.float32(self.scale), dtype=np.float32)
 
     def getClusterCount(self):
         '''
@@ -51,34 +74,199 @@ class DatasetHelper(object):
         '''
         return self.dataset.cluster_count
 
-    def iterate_minibatches(self, set_type, batch_size, targets=None, shuffle=False):
+    def iterate_minibatches(self, set_type, batch_size, targets=None, shuffle=False, prefetch=0, indices=None):
         '''
         Utility method for getting batches out of a dataset
         :param set_type: IMAGE - suitable input for CNNs or FLAT - suitable for DNN
         :param batch_size: Size of minibatches
         :param targets: None if the output should be same as inputs (autoencoders), otherwise takes a target array from which batches can be extracted. Must have the same order as the dataset, e.g, dataset inputs nth sample has output at target's nth element
         :param shuffle: If the dataset needs to be shuffled or not
-        :return: generates a batches of size batch_size from the dataset, each batch is the pair (input, output)
+        :param prefetch: If > 0, the next prefetch batches are assembled on a background thread into reusable buffers (see MinibatchPrefetcher)
+        :param indices: Order in which the samples are visited (e.g. the shard of a worker), overrides shuffle
+        :return: generates a batches of size batch_size from the dataset, each batch is the pair (input, output). Inputs
+                 (and targets if they are the inputs) are normalized to float32
         '''
         inputs = None
         if set_type == 'IMAGE':
             inputs = self.input
-            if targets is None:
-                targets = self.input
         elif set_type == 'FLAT':
             inputs = self.input_flat
-            if targets is None:
-                targets = self.input_flat
+        if targets is None:
+            targets = inputs
         assert len(inputs) == len(targets)
-        if shuffle:
+        if indices is None and shuffle and self.stream_cache_mb:
+            row_bytes = inputs.itemsize * int(np.prod(inputs.shape[1:]))
+            block_rows = max(1, STREAM_BLOCK_BYTES // row_bytes)
+            indices = getBlockShuffledIndices(len(inputs), block_rows, self.stream_cache_mb * (1 << 20) // row_bytes)
+        elif indices is None and shuffle:
             indices = np.arange(len(inputs))
             np.random.shuffle(indices)
-        for start_idx in range(0, len(inputs) - batch_size + 1, batch_size):
-            if shuffle:
+        if prefetch > 0:
+            return MinibatchPrefetcher(inputs, targets, batch_size, indices, prefetch, self.scale)
+        return self.generateMinibatches(inputs, targets, batch_size, indices)
+
+    def iterate_sequential(self, set_type, batch_size):
+        '''
+        Iterates over the whole dataset in order, including the last incomplete batch - used for inference
+        :param set_type: IMAGE - suitable input for CNNs or FLAT - suitable for DNN
+        :param batch_size: Maximum size of the batches
+        :return: generates pairs (index of the first sample in the batch, batch normalized to float32)
+        '''
+        inputs = self.input if set_type == 'IMAGE' else self.input_flat
+        for start_idx in range(0, len(inputs), batch_size):
+            yield start_idx, self.normalize(inputs[start_idx:start_idx + batch_size])
+
+    def generateMinibatches(self, inputs, targets, batch_size, indices):
+        # Plain generator over the minibatches, gathers and normalizes on the calling thread
+        num_samples = len(inputs) if indices is None else len(indices)
+        for start_idx in range(0, num_samples - batch_size + 1, batch_size):
+            if indices is not None:
                 excerpt = indices[start_idx:start_idx + batch_size]
             else:
                 excerpt = slice(start_idx, start_idx + batch_size)
-            yield inputs[excerpt], targets[excerpt]
+            batch = self.normalize(inputs[excerpt])
+            yield batch, batch if targets is inputs else targets[excerpt]
+
+
+def getBlockShuffledIndices(num_samples, block_rows, window_rows):
+    '''
+    Visiting order for shuffling a dataset that is read from disk: the samples are split into blocks of block_rows
+    contiguous samples, the blocks are shuffled and grouped into windows of at most window_rows samples, and the
+    samples are shuffled within each window. Every window is a handful of sequential reads and only the current
+    window is touched, so the working set stays bounded while the order is still random across the whole dataset
+    :param num_samples: Number of samples in the dataset
+    :param block_rows: Number of contiguous samples read as a unit
+    :param window_rows: Maximum number of samples shuffled together (rounded down to whole blocks, at least one block)
+    :return: Permutation of the sample indices
+    '''
+    blocks = np.arange(0, num_samples, block_rows)
+    np.random.shuffle(blocks)
+    window_blocks = max(1, window_rows // block_rows)
+    indices = []
+    for start_block in range(0, len(blocks), window_blocks):
+        window = np.concatenate([np.arange(start, min(start + block_rows, num_samples))
+                                 for start in np.sort(blocks[start_block:start_block + window_blocks])])
+        np.random.shuffle(window)
+        indices.append(window)
+    return np.concatenate(indices)
+
+
+class MinibatchPrefetcher(object):
+    '''
+    Iterator over minibatches that assembles the upcoming batches on a worker thread while the training
+    thread is busy with the theano function. Batches are gathered into a ring of preallocated buffers
+    (prefetch + 1 slots) that are reused, so a yielded batch is only valid until the next batch is requested.
+    When the targets are the inputs (autoencoders) the batch is gathered once and returned as both elements
+    of the pair. Inputs stored in a compact form (uint8) are gathered into a scratch buffer and scaled into the float32
+    batch buffers on the worker thread. The time the training thread spent blocked on data is accumulated in wait_time
+    '''
+
+    def __init__(self, inputs, targets, batch_size, indices=None, prefetch=2, scale=None):
+        '''
+        :param inputs: Array from which the input batches are gathered
+        :param targets: Array from which the target batches are gathered, can be the inputs array itself
+        :param batch_size: Size of minibatches, the last incomplete batch is dropped
+        :param indices: Order in which samples are visited (shuffled, possibly a subset), or None for sequential order
+        :param prefetch: Number of batches that are prepared ahead of the consumer
+        :param scale: Factor that converts the stored inputs to float32 batches, None if the inputs are used as they are
+        '''
+        self.inputs = inputs
+        self.targets = targets
+        self.batch_size = batch_size
+        self.indices = indices
+        self.same_targets = targets is inputs
+        self.num_batches = (len(inputs) if indices is None else len(indices)) // batch_size
+        self.scale = scale
+        self.raw_buffer = None
+        input_dtype = inputs.dtype
+        if scale is not None:
+            self.raw_buffer = np.empty((batch_size,) + inputs.shape[1:], dtype=inputs.dtype)
+            input_dtype = np.float32
+        self.input_buffers = [np.empty((batch_size,) + inputs.shape[1:], dtype=input_dtype) for _ in range(prefetch + 1)]
+        self.target_buffers = self.input_buffers
+        if not self.same_targets:
+            self.target_buffers = [np.empty((batch_size,) + targets.shape[1:], dtype=targets.dtype) for _ in range(prefetch + 1)]
+        self.current_slot = None
+        # Number of batches handed out to the consumer
+        self.batches_done = 0
+        self.wait_time = 0.0
+        self.startWorker()
+
+    def startWorker(self):
+        # All the slots except the one held by the consumer are free, the worker continues after the last handed out batch
+        self.free_slots = Queue.Queue()
+        self.ready_slots = Queue.Queue()
+        for slot in range(len(self.input_buffers)):
+            if slot != self.current_slot:
+                self.free_slots.put(slot)
+        self.worker = threading.Thread(target=self.fillBuffers, args=(self.batches_done, self.free_slots, self.ready_slots))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def fillBuffers(self, first_batch, free_slots, ready_slots):
+        # Worker thread - gathers batches into free slots and hands them over to the consumer in order
+        try:
+            for batch_idx in range(first_batch, self.num_batches):
+                slot = free_slots.get()
+                if slot is None:
+                    return
+                start_idx = batch_idx * self.batch_size
+                gather_buffer = self.input_buffers[slot] if self.scale is None else self.raw_buffer
+                if self.indices is not None:
+                    excerpt = self.indices[start_idx:start_idx + self.batch_size]
+                    np.take(self.inputs, excerpt, axis=0, out=gather_buffer)
+                    if not self.same_targets:
+                        np.take(self.targets, excerpt, axis=0, out=self.target_buffers[slot])
+                else:
+                    excerpt = slice(start_idx, start_idx + self.batch_size)
+                    gather_buffer[...] = self.inputs[excerpt]
+                    if not self.same_targets:
+                        self.target_buffers[slot][...] = self.targets[excerpt]
+                if self.scale is not None:
+                    np.multiply(gather_buffer, np.float32(self.scale), out=self.input_buffers[slot], dtype=np.float32)
+                ready_slots.put(slot)
+            ready_slots.put(None)
+        except Exception as e:
+            ready_slots.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self.num_batches
+
+    def next(self):
+        # The buffers handed out with the previous batch can be refilled now
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+            self.current_slot = None
+        start_time = time.time()
+        slot = self.ready_slots.get()
+        self.wait_time += time.time() - start_time
+        if slot is None:
+            raise StopIteration
+        if isinstance(slot, Exception):
+            raise slot
+        self.current_slot = slot
+        self.batches_done += 1
+        return self.input_buffers[slot], self.target_buffers[slot]
+
+    __next__ = next
+
+    def close(self):
+        '''
+        Stops the worker thread and waits for it, needed when the consumer stops iterating before the end. The arrays
+        the batches are gathered from can be modified once it returned
+        '''
+        self.free_slots.put(None)
+        self.worker.join()
+
+    def restart(self):
+        '''
+        Restarts a closed iterator after the last batch handed out. The batches prefetched before closing are
+        discarded and gathered again, so they see the modifications made to the inputs or targets in the meantime
+        '''
+        self.startWorker()
 
 
 class MNISTDataset(object):
@@ -88,6 +276,9 @@ class MNISTDataset(object):
 
     def __init__(self):
         self.cluster_count = 10
+        self.source_files = ['mnist/mnist.pkl.gz']
+        # The pickled images hold pixel / 256, they are stored back as uint8 pixels
+        self.scale = 1 / 256.0
 
     def loadDataset(self):
         f = gzip.open('mnist/mnist.pkl.gz', 'rb')
@@ -103,7 +294,7 @@ class MNISTDataset(object):
         '''
         Returns the image, flat and labels as a tuple
         '''
-        X = inputs
+        X = np.rint(inputs / self.scale).astype(np.uint8)
         X = X.reshape((-1, 1, 28, 28))
         return (X, X.reshape((-1, 28 * 28)), targets)
 
@@ -115,20 +306,26 @@ class STLDataset(object):
 
     def __init__(self):
         self.cluster_count = 10
+        self.source_files = ['stl/train_X.bin', 'stl/train_y.bin', 'stl/test_X.bin', 'stl/test_y.bin']
+        self.scale = 1 / 256.0
+
+    def openParts(self):
+        '''
+        Memory maps the binary files, nothing is read until the samples are accessed
+        :return: List of (inputs, labels) pairs, for the train and the test set
+        '''
+        parts = []
+        for part in ('train', 'test'):
+            inputs = np.memmap('stl/%s_X.bin' % part, dtype=np.uint8, mode='r')
+            labels = np.fromfile('stl/%s_y.bin' % part, dtype=np.uint8)
+            parts.append((inputs.reshape((-1, 3, 96, 96)), labels))
+        return parts
 
     def loadDataset(self):
-        train_x = np.fromfile('stl/train_X.bin', dtype=np.uint8)
-        train_y = np.fromfile('stl/train_y.bin', dtype=np.uint8)
-        test_x = np.fromfile('stl/train_X.bin', dtype=np.uint8)
-        test_y = np.fromfile('stl/train_y.bin', dtype=np.uint8)
-        train_input = np.reshape(train_x, (-1, 3, 96, 96))
-        train_labels = train_y
-        train_input_flat = np.reshape(test_x, (-1, 1, 3 * 96 * 96))
-        test_input = np.reshape(test_x, (-1, 3, 96, 96))
-        test_labels = test_y
-        test_input_flat = np.reshape(test_x, (-1, 1, 3 * 96 * 96))
-        return [np.concatenate(train_input, test_input), np.concatenate(train_labels, test_labels),
-                np.concatenate(train_input_flat, test_input_flat)]
+        # combine test and train samples
+        parts = self.openParts()
+        inputs = np.concatenate([part_inputs for part_inputs, _ in parts])
+        return [inputs, np.concatenate([part_labels for _, part_labels in parts]), inputs.reshape((-1, 3 * 96 * 96))]
 
 
 class COIL20Dataset(object):
@@ -138,14 +335,91 @@ class COIL20Dataset(object):
 
     def __init__(self):
         self.cluster_count = 20
+        self.source_files = ['coil/coil_X.npy', 'coil/coil_y.npy']
+        self.scale = 1 / 256.0
 
     def loadDataset(self):
-        train_x = np.load('coil/coil_X.npy').astype(np.float32) / 256.0
+        train_x = np.load('coil/coil_X.npy').astype(np.uint8)
         train_y = np.load('coil/coil_y.npy')
         train_x_flat = np.reshape(train_x, (-1, 128 * 128))
         return [train_x, train_y, train_x_flat]
 
 
+# Version of the layout of the dataset cache, cache folders written with another version are rebuilt
+DATASET_CACHE_VERSION = 2
+
+
+def loadCachedDataset(name, dataset, cache_dir='cache'):
+    '''
+    Opens the preprocessed dataset from the on-disk cache, converting the original files into the cache
+    the first time (or whenever the original files change). The cache holds one contiguous .npy file for
+    the images and one for the labels, which are opened with mmap_mode so that startup does not parse or copy
+    anything, and several processes working on the same dataset share the same pages. Images are stored in their
+    compact uint8 form, the scale of the dataset converts them to network inputs
+    :param name: Name of the dataset, used as the cache folder name
+    :param dataset: Dataset instance (MNISTDataset, COIL20Dataset ...) used for the one time conversion
+    :param cache_dir: Root folder of the dataset cache
+    :return: input, labels and input_flat - input_flat is a zero-copy view of the input buffer
+    '''
+    folder = os.path.join(cache_dir, name)
+    meta_file = os.path.join(folder, 'meta.json')
+    source_stamp = getSourceStamp(dataset.source_files)
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    if meta is None or meta['version'] != DATASET_CACHE_VERSION or meta['source'] != source_stamp:
+        buildDatasetCache(folder, dataset, source_stamp)
+    inputs = np.load(os.path.join(folder, 'input.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(folder, 'labels.npy'), mmap_mode='r')
+    return inputs, labels, inputs.reshape((inputs.shape[0], -1))
+
+
+def buildDatasetCache(folder, dataset, source_stamp):
+    '''
+    One time conversion of the original dataset files into contiguous .npy arrays. Files are written with atomicSave
+    and the meta file is written last, so that an interrupted conversion is never picked up as a valid cache.
+    Datasets with memory mapped parts (openParts) are copied chunk by chunk, so they never have to fit in memory
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if hasattr(dataset, 'openParts'):
+        parts = dataset.openParts()
+        labels = np.concatenate([part_labels for _, part_labels in parts])
+
+        def copyParts(tmp_file):
+            first_inputs = parts[0][0]
+            inputs = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=first_inputs.dtype,
+                                               shape=(len(labels),) + first_inputs.shape[1:])
+            chunk_rows = max(1, STREAM_BLOCK_BYTES // (first_inputs.itemsize * int(np.prod(first_inputs.shape[1:]))))
+            offset = 0
+            for part_inputs, _ in parts:
+                for start_idx in range(0, len(part_inputs), chunk_rows):
+                    chunk = part_inputs[start_idx:start_idx + chunk_rows]
+                    inputs[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            inputs.flush()
+
+        atomicSave(os.path.join(folder, 'input.npy'), copyParts)
+        arrays = (('labels', labels),)
+    else:
+        inputs, labels, _ = dataset.loadDataset()
+        arrays = (('input', inputs), ('labels', labels))
+    for array_name, array in arrays:
+        atomicSave(os.path.join(folder, '%s.npy' % array_name), lambda tmp_file: np.save(tmp_file, np.ascontiguousarray(array)))
+
+    def writeMeta(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': DATASET_CACHE_VERSION, 'source': source_stamp}, f)
+
+    atomicSave(os.path.join(folder, 'meta.json'), writeMeta)
+
+
+def getSourceStamp(source_files):
+    # Size and modification time of each original file, used to detect stale caches
+    return [[path, os.path.getsize(path), int(os.path.getmtime(path))] for path in source_files]
+
+
 def rescaleReshapeAndSaveImage(image_sample, out_filename):
     '''
     For saving the reconstructed output as an image
@@ -156,6 +430,7 @@ def rescaleReshapeAndSaveImage(image_sample, out_filename):
     image_sample = ((image_sample - np.amin(image_sample)) / (np.amax(image_sample) - np.amin(image_sample))) * 255;
     image_sample = np.rint(image_sample).astype(int)
     image_sample = np.clip(image_sample, a_min=0, a_max=255).astype('uint8')
+    from PIL import Image
     img = Image.fromarray(image_sample, 'L')
     img.save(out_filename)
 
@@ -164,19 +439,12 @@ def cluster_acc(y_true, y_pred):
     '''
     Uses the hungarian algorithm to find the best permutation mapping and then calculates the accuracy wrt
     Implementation inpired from https://github.com/piiswrong/dec, since scikit does not implement this metric
-    this mapping and true labels
+    this mapping and true labels. The confusion matrix is built in one vectorized pass, see clustermetrics
     :param y_true: True cluster labels
     :param y_pred: Predicted cluster labels
     :return: accuracy score for the clustering
     '''
-    D = int(max(y_pred.max(), y_true.max()) + 1)
-    w = np.zeros((D, D), dtype=np.int32)
-    for i in range(y_pred.size):
-        idx1 = int(y_pred[i])
-        idx2 = int(y_true[i])
-        w[idx1, idx2] += 1
-    ind = linear_assignment(w.max() - w)
-    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
+    return ContingencyMatrix().update(y_true, y_pred).accuracy()
 
 
 def getClusterMetricString(method_name, labels_true, labels_pred):
@@ -187,38 +455,367 @@ def getClusterMetricString(method_name, labels_true, labels_pred):
     :param labels_pred: Predicted label for each sample
     :return: Formatted string containing metrics and method name
     '''
-    acc = cluster_acc(labels_true, labels_pred)
-    nmi = metrics.normalized_mutual_info_score(labels_true, labels_pred)
-    return '%-50s     %8.3f     %8.3f' % (method_name, acc, nmi)
+    scores = clusteringScores(labels_true, labels_pred)
+    return '%-50s     %8.3f     %8.3f' % (method_name, scores['acc'], scores['nmi'])
 
 
-def evaluateKMeans(data, labels, nclusters, method_name):
+def evaluateKMeans(data, labels, nclusters, method_name, mode='full', init_centers=None, n_init=20, batch_size=1000, n_jobs=1):
     '''
     Clusters data with kmeans algorithm and then returns the string containing method name and metrics, and also the evaluated cluster centers
     :param data: Points that need to be clustered as a numpy array
     :param labels: True labels for the given points
     :param nclusters: Total number of clusters
     :param method_name: Name of the method from which the clustering space originates (only used for printing)
+    :param mode: full - KMeans with n_init random restarts, warm - KMeans with a single init (init_centers if given),
+                 minibatch - MiniBatchKMeans with a single init (init_centers if given), chunked - MiniBatchKMeans fed
+                 chunk by chunk, for data that does not fit in memory (see fitKMeansChunked)
+    :param init_centers: Cluster centers to start from in warm and minibatch modes, k-means++ init is used if None
+    :param n_init: Number of restarts in full mode
+    :param batch_size: Minibatch size in minibatch mode
+    :param n_jobs: Number of processes the restarts of full mode are spread over, -1 for all cores
     :return: Formatted string containing metrics and method name, cluster centers
     '''
-    kmeans = KMeans(n_clusters=nclusters, n_init=20)
-    kmeans.fit(data)
+    kmeans = fitKMeans(data, nclusters, mode, init_centers, n_init, batch_size, n_jobs)
     return getClusterMetricString(method_name, labels, kmeans.labels_), kmeans.cluster_centers_
 
 
-def visualizeData(Z, labels, num_clusters, title):
+def evaluateKMeansCached(data, labels, nclusters, method_name, n_init=20, n_jobs=1, cache_dir='cache/kmeans', scale=None, mode='full'):
+    '''
+    Same as evaluateKMeans in full (or chunked) mode, but the kmeans result is memoized on disk keyed by the content
+    hash of data, the number of clusters and the kmeans settings - reports on data that was clustered before are instantaneous
+    :param n_jobs: Number of processes the restarts are spread over, -1 for all cores
+    :param cache_dir: Folder of the cached kmeans results
+    :param scale: Factor applied to data before clustering (e.g. the scale of a dataset stored as uint8), None for none
+    :param mode: full or chunked, see evaluateKMeans
+    :return: Formatted string containing metrics and method name, cluster centers
+    '''
+    import sklearn
+    cache = ResultCache(cache_dir)
+    key = getCacheKey('kmeans', arrayDigest(data), scale, nclusters, mode, n_init, sklearn.__version__)
+    result = cache.load(key)
+    if result is None:
+        if scale is not None:
+            data = np.multiply(data, np.float32(scale), dtype=np.float32)
+        kmeans = fitKMeans(data, nclusters, mode, n_init=n_init, n_jobs=n_jobs)
+        result = {'labels': kmeans.labels_, 'centers': kmeans.cluster_centers_}
+        cache.save(key, **result)
+    return getClusterMetricString(method_name, labels, result['labels']), result['centers']
+
+
+def fitKMeans(data, nclusters, mode='full', init_centers=None, n_init=20, batch_size=1000, n_jobs=1):
+    '''
+    Clusters data with the kmeans variant given by mode, see evaluateKMeans for the parameters
+    :return: The fitted sklearn estimator
+    '''
+    # sklearn is imported on first use, it dominates the import time of this module (clustermetrics defers it as well)
+    from sklearn.cluster.k_means_ import KMeans, MiniBatchKMeans
+    init = 'k-means++' if init_centers is None else init_centers
+    if mode == 'full':
+        kmeans = KMeans(n_clusters=nclusters, n_init=n_init, n_jobs=n_jobs)
+    elif mode == 'warm':
+        kmeans = KMeans(n_clusters=nclusters, init=init, n_init=1)
+    elif mode == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=nclusters, init=init, n_init=1, batch_size=batch_size)
+    elif mode == 'chunked':
+        return fitKMeansChunked(data, nclusters, init_centers, n_init, n_jobs=n_jobs)
+    else:
+        raise ValueError('Unknown kmeans evaluation mode %s' % mode)
+    kmeans.fit(data)
+    return kmeans
+
+
+def fitKMeansChunked(data, nclusters, init_centers=None, n_init=20, chunk_rows=10000, sample_rows=20000, passes=3, n_jobs=1):
+    '''
+    KMeans on data that does not fit in memory (e.g. a memory mapped latent space). The centers are initialized with
+    full KMeans on a random sample of the rows (unless init_centers are given), refined with MiniBatchKMeans partial_fit
+    over the chunks of the data in random order, and the labels are predicted chunk by chunk
+    :param data: Points that need to be clustered, only chunk_rows rows are read into memory at a time
+    :param init_centers: Cluster centers to start from, None to initialize from a sample
+    :param n_init: Number of restarts of the KMeans on the sample
+    :param chunk_rows: Number of rows per partial_fit call
+    :param sample_rows: Number of rows of the sample the centers are initialized from
+    :param passes: Number of passes over the data
+    :param n_jobs: Number of processes the restarts on the sample are spread over, -1 for all cores
+    :return: The fitted sklearn MiniBatchKMeans estimator, with the labels_ of all rows
+    '''
+    from sklearn.cluster.k_means_ import KMeans, MiniBatchKMeans
+    if init_centers is None:
+        sample = np.sort(np.random.choice(len(data), min(len(data), sample_rows), replace=False))
+        init_centers = KMeans(n_clusters=nclusters, n_init=n_init, n_jobs=n_jobs).fit(np.asarray(data[sample])).cluster_centers_
+    kmeans = MiniBatchKMeans(n_clusters=nclusters, init=init_centers, n_init=1, batch_size=chunk_rows)
+    chunk_starts = np.arange(0, len(data), chunk_rows)
+    for _ in range(passes):
+        np.random.shuffle(chunk_starts)
+        for start_idx in chunk_starts:
+            kmeans.partial_fit(np.asarray(data[start_idx:start_idx + chunk_rows]))
+    kmeans.labels_ = np.concatenate([kmeans.predict(np.asarray(data[start_idx:start_idx + chunk_rows]))
+                                     for start_idx in range(0, len(data), chunk_rows)])
+    return kmeans
+
+
+class KMeansEvaluator(object):
+    '''
+    Periodic kmeans evaluation of the latent space while training. In warm and minibatch modes every call starts
+    from the cluster centers found by the previous call, which is much cheaper than the full restarts and still a
+    good initialization as the latent space only changes a little between two calls
+    '''
+
+    def __init__(self, nclusters, mode='full', interval=None):
+        '''
+        :param nclusters: Total number of clusters
+        :param mode: full, warm or minibatch - see evaluateKMeans
+        :param interval: Evaluate every interval epochs, None to use the default of the training stage
+        '''
+        self.nclusters = nclusters
+        self.mode = mode
+        self.interval = interval
+        self.centers = None
+        self.results = []
+
+    def isDue(self, epoch, default_interval):
+        '''
+        :param epoch: Zero based index of the epoch that just finished
+        :param default_interval: Interval used if none was configured
+        :return: True if the latent space should be evaluated after this epoch
+        '''
+        return (epoch + 1) % (self.interval or default_interval) == 0
+
+    def setCenters(self, centers):
+        # Start the next evaluation from these centers (e.g the centers the clustering network was initialized with)
+        self.centers = centers
+
+    def evaluate(self, data, labels, method_name):
+        '''
+        :return: Formatted string containing metrics and method name, cluster centers
+        '''
+        quality_desc, self.centers = evaluateKMeans(data, labels, self.nclusters, method_name, self.mode, self.centers)
+        return quality_desc, self.centers
+
+    def submit(self, data, labels, method_name):
+        # Evaluates right away, the result is returned by the next poll
+        self.results.append(self.evaluate(data, labels, method_name))
+
+    def poll(self):
+        '''
+        :return: List of (formatted metrics, cluster centers) of the evaluations finished since the last poll
+        '''
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        # Results of the evaluations still pending at the end of the training stage
+        return self.poll()
+
+
+class AsyncKMeansEvaluator(KMeansEvaluator):
+    '''
+    KMeansEvaluator that evaluates in a background process, so that the training loop does not wait for kmeans and the
+    metrics. Submitting copies the latent space into one of two shared snapshot buffers: the background process
+    evaluates one while the other holds at most one waiting snapshot. A snapshot submitted while another one is still
+    waiting replaces it, so evaluation that falls behind skips stale snapshots instead of queueing them up
+    '''
+
+    def __init__(self, nclusters, shape, mode='full', interval=None, snapshots=None, chunk_rows=10000):
+        '''
+        :param nclusters: Total number of clusters
+        :param shape: Shape of the latent space (number of samples, encode size)
+        :param mode: full, warm, minibatch or chunked - see evaluateKMeans
+        :param interval: Evaluate every interval epochs, None to use the default of the training stage
+        :param snapshots: Two arrays of the given shape in memory shared with forked processes (e.g. memory maps of
+                          files), allocated in anonymous shared memory if not given
+        :param chunk_rows: Number of rows copied into a snapshot at a time
+        '''
+        super(AsyncKMeansEvaluator, self).__init__(nclusters, mode, interval)
+        if snapshots is None:
+            size = int(np.prod(shape))
+            snapshots = [np.frombuffer(multiprocessing.RawArray('f', size), dtype=np.float32).reshape(shape) for _ in range(2)]
+        self.snapshots = snapshots
+        self.chunk_rows = chunk_rows
+        self.method_names = [multiprocessing.RawArray('c', 256) for _ in range(2)]
+        self.condition = multiprocessing.Condition()
+        # Snapshot the background process evaluates and snapshot waiting for it, -1 for none
+        self.active = multiprocessing.RawValue('i', -1)
+        self.pending = multiprocessing.RawValue('i', -1)
+        self.stopping = multiprocessing.RawValue('i', 0)
+        self.result_queue = multiprocessing.Queue()
+        self.labels = None
+        self.process = None
+        self.coalesced = 0
+
+    def submit(self, data, labels, method_name):
+        '''
+        Hands a snapshot of data to the background process, which is started by the first call. Returns as soon as
+        data is copied
+        :param labels: True labels, the same for every call
+        '''
+        if self.process is None:
+            # Forked now, so that it starts from the centers set (or restored from a checkpoint) before training
+            self.labels = labels
+            self.process = multiprocessing.Process(target=self.runWorker)
+            self.process.daemon = True
+            self.process.start()
+        with self.condition:
+            slot = self.pending.value
+            if slot >= 0:
+                self.coalesced += 1
+            else:
+                slot = 1 if self.active.value == 0 else 0
+            # Withdrawn while it is written, the background process never reads a partial snapshot
+            self.pending.value = -1
+        for start_idx in range(0, len(data), self.chunk_rows):
+            self.snapshots[slot][start_idx:start_idx + self.chunk_rows] = data[start_idx:start_idx + self.chunk_rows]
+        self.method_names[slot].value = method_name[:255]
+        with self.condition:
+            self.pending.value = slot
+            self.condition.notify_all()
+
+    def poll(self):
+        '''
+        :return: List of (formatted metrics, cluster centers) of the evaluations finished since the last poll, the
+                 centers are None if an evaluation failed
+        '''
+        results = []
+        while True:
+            try:
+                results.append(self.result_queue.get_nowait())
+            except Queue.Empty:
+                return self.updateCenters(results)
+
+    def close(self):
+        # Waits for the evaluation of the last snapshot, then stops the background process
+        if self.process is None:
+            return []
+        with self.condition:
+            self.stopping.value = 1
+            self.condition.notify_all()
+        results = []
+        # The queue is drained while waiting, a process only exits once its results went through the pipe
+        while self.process.is_alive():
+            try:
+                results.append(self.result_queue.get(timeout=1.0))
+            except Queue.Empty:
+                pass
+        self.process.join()
+        self.process = None
+        return self.updateCenters(results) + self.poll()
+
+    def updateCenters(self, results):
+        # The next checkpoint saves the centers of the newest finished evaluation
+        for quality_desc, centers in results:
+            if centers is not None:
+                self.centers = centers
+        return results
+
+    def runWorker(self):
+        # Interrupts are handled by the training process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            with self.condition:
+                while self.pending.value < 0 and not self.stopping.value:
+                    self.condition.wait(1.0)
+                slot = self.pending.value
+                if slot < 0:
+                    return
+                self.active.value = slot
+                self.pending.value = -1
+                method_name = self.method_names[slot].value
+            try:
+                self.result_queue.put(self.evaluate(self.snapshots[slot], self.labels, method_name))
+            except Exception:
+                self.result_queue.put(('%s: evaluation failed\n%s' % (method_name, traceback.format_exc()), None))
+            with self.condition:
+                self.active.value = -1
+
+
+def visualizeData(Z, labels, num_clusters, title, pca_dims=None):
     '''
     TSNE visualization of the points in latent space Z
     :param Z: Numpy array containing points in latent space in which clustering was performed
     :param labels: True labels - used for coloring points
     :param num_clusters: Total number of clusters
     :param title: filename where the plot should be saved
+    :param pca_dims: Reduce Z to this many dimensions with PCA before TSNE, None to use all dimensions
     :return: None - (side effect) saves clustering visualization plot in specified location
     '''
-    labels = labels.astype(int)
+    plotEmbedding(computeTSNE((Z, pca_dims)), labels, num_clusters, title)
+
+
+def computeTSNE(args):
+    '''
+    2D TSNE embedding of the points in Z, optionally reduced with PCA first
+    :param args: Pair (Z, pca_dims) - a single argument so that the function can be mapped over a process pool
+    :return: Embedded points
+    '''
+    Z, pca_dims = args
+    from sklearn import manifold
+    if pca_dims and pca_dims < Z.shape[1]:
+        from sklearn.decomposition import PCA
+        Z = PCA(n_components=pca_dims, random_state=0).fit_transform(Z)
     tsne = manifold.TSNE(n_components=2, init='pca', random_state=0)
-    Z_tsne = tsne.fit_transform(Z)
+    return tsne.fit_transform(Z)
+
+
+def getTSNEEmbeddings(latent_spaces, num_points, pca_dims=None, processes=4, cache_dir='cache/tsne', scales=None):
+    '''
+    TSNE embeddings of the first num_points points of several latent spaces. The embeddings that are not cached yet are
+    computed concurrently in a process pool. Embeddings are cached keyed by the content hash of the whole latent space
+    and the TSNE settings, and an embedding of at least num_points points is reused by slicing its first rows, so
+    re-plotting never recomputes anything
+    :param latent_spaces: List of arrays (or memory maps) of points, one row per sample
+    :param num_points: Number of points to embed, from the start of each latent space
+    :param pca_dims: Reduce to this many dimensions with PCA before TSNE, None to use all dimensions
+    :param processes: Maximum number of embeddings computed at the same time
+    :param cache_dir: Folder of the cached embeddings
+    :param scales: Factor applied to the points of each latent space (e.g. the scale of a dataset stored as uint8), None for none
+    :return: List of embeddings, one per latent space
+    '''
+    import sklearn
+    cache = ResultCache(cache_dir)
+    scales = scales or [None] * len(latent_spaces)
+    keys = [getCacheKey('tsne', arrayDigest(Z), scale, pca_dims, sklearn.__version__) for Z, scale in zip(latent_spaces, scales)]
+    embeddings = []
+    for key in keys:
+        cached = cache.load(key)
+        if cached is not None and len(cached['embedding']) >= num_points:
+            embeddings.append(cached['embedding'][:num_points])
+        else:
+            embeddings.append(None)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    tasks = []
+    for i in missing:
+        Z = np.asarray(latent_spaces[i][:num_points])
+        if scales[i] is not None:
+            Z = np.multiply(Z, np.float32(scales[i]), dtype=np.float32)
+        tasks.append((Z, pca_dims))
+    if len(tasks) > 1 and processes > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        computed = pool.map(computeTSNE, tasks)
+        pool.close()
+        pool.join()
+    else:
+        computed = [computeTSNE(task) for task in tasks]
+    for i, embedding in zip(missing, computed):
+        cache.save(keys[i], embedding=embedding)
+        embeddings[i] = embedding
+    return embeddings
+
+
+def plotEmbedding(Z_tsne, labels, num_clusters, title):
+    '''
+    Scatter plot of 2D embedded points colored by their labels
+    :param Z_tsne: Embedded points
+    :param labels: True labels - used for coloring points
+    :param num_clusters: Total number of clusters
+    :param title: filename where the plot should be saved
+    '''
+    import matplotlib
+    # For plotting graphs via ssh with no display
+    # Ref: https://stackoverflow.com/questions/2801882/generating-a-png-with-matplotlib-when-display-is-undefined
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    labels = labels.astype(int)
     fig = plt.figure()
     plt.scatter(Z_tsne[:, 0], Z_tsne[:, 1], s=2, c=labels, cmap=plt.cm.get_cmap("jet", num_clusters))
     plt.colorbar(ticks=range(num_clusters))
     fig.savefig(title, dpi=fig.dpi)
+    plt.close(fig)
@@ -2,8 +2,9 @@
 Created on Jul 11, 2017
 '''
 
-from datetime import datetime
-import logging
+import os
+import tempfile
+import time
 
 from lasagne import layers
 import lasagne
@@ -11,44 +12,101 @@ from lasagne.layers.helper import get_all_layers
 import theano
 import signal
 
-from customlayers import ClusteringLayer, Unpool2DLayer, getSoftAssignments
-from misc import evaluateKMeans, visualizeData, rescaleReshapeAndSaveImage
+from artifact import CLUSTER_CENTERS, ModelArtifact, getArchitectureHash, getArtifactPath, saveArtifact
+from checkpoint import Checkpointer
+from customlayers import ClusteringLayer, Unpool2DLayer, getSoftAssignments, getDistances
+from functioncache import FunctionCache
+from logsetup import rootLogger, setupLogging
+from misc import evaluateKMeans, evaluateKMeansCached, visualizeData, rescaleReshapeAndSaveImage, MinibatchPrefetcher, KMeansEvaluator, AsyncKMeansEvaluator
+from parallel import DataParallelTrainer
+from schedules import EarlyStopping, ReduceLROnPlateau
+from telemetry import EpochTelemetry
 import numpy as np
 import theano.tensor as T
 
 from lasagne.layers import batch_norm
 
-# Logging utilities - logs get saved in folder logs named by date and time, and also output
-# at standard output
-
-logFormatter = logging.Formatter("[%(asctime)s]  %(message)s", datefmt='%m/%d %I:%M:%S')
-
-rootLogger = logging.getLogger()
-rootLogger.setLevel(logging.DEBUG)
-
-fileHandler = logging.FileHandler(datetime.now().strftime('logs/dcjc_%H_%M_%d_%m.log'))
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
+# Number of rows of the latent space and of the Q/P distributions processed at a time when training out of core
+OUT_OF_CORE_CHUNK_ROWS = 65536
 
 
 class DCJC(object):
     # Main class holding autoencoder network and training functions
-    def __init__(self, network_description):
+    def __init__(self, network_description, prefetch=2, report_data_wait=False, eval_mode='full', eval_interval=None,
+                 checkpoint_epochs=None, checkpoint_minutes=None, function_cache_dir='cache/functions', kmeans_jobs=1,
+                 out_of_core=False, update_interval=None, tol=None, lr_schedule='decay', lr_patience=5, lr_factor=0.5,
+                 stop_patience=None, time_budget=None, target_loss=None, workers=1, sync_interval=10, async_eval=False):
+        '''
+        :param network_description: python dictionary specifying the autoencoder architecture
+        :param prefetch: Number of training minibatches assembled ahead on a background thread, 0 to gather on the training thread
+        :param report_data_wait: Log the time the training loop spent waiting for minibatches every epoch
+        :param eval_mode: KMeans mode used for monitoring the latent space while training - full, warm or minibatch (see evaluateKMeans)
+        :param eval_interval: Evaluate the latent space every eval_interval epochs, None for the default of each training stage
+        :param checkpoint_epochs: Write a checkpoint of the full training state every checkpoint_epochs epochs, None to disable
+        :param checkpoint_minutes: Write a checkpoint after an epoch if checkpoint_minutes minutes passed since the last one, None to disable
+        :param function_cache_dir: Folder in which compiled theano functions are cached between runs, None to always compile
+        :param kmeans_jobs: Number of processes the restarts of the kmeans initializing the cluster centers are spread over
+        :param out_of_core: Keep the latent space and the Q/P distributions in memory mapped files, computed chunk by
+                            chunk, and cluster with chunked kmeans (overrides eval_mode), for datasets whose latent
+                            space does not fit in memory. The latent space files are written in place
+        :param update_interval: Number of train iterations between two refreshes of the target distribution P of the
+                                KL divergence clustering, None to refresh it once per epoch
+        :param tol: Stop the KL divergence clustering once less than this fraction of the samples changed their hard
+                    cluster assignment between two refreshes of P, None to always train for the given epochs
+        :param lr_schedule: Learning rate schedule of the pretraining - decay (by 0.9999 per epoch) or plateau (see ReduceLROnPlateau)
+        :param lr_patience: Epochs without improvement of the loss after which the plateau schedule reduces the learning rate
+        :param lr_factor: Factor by which the plateau schedule reduces the learning rate
+        :param stop_patience: Stop the pretraining after this many epochs without improvement of the loss, None to disable
+        :param time_budget: Stop the pretraining before it would run longer than this many minutes, None to disable
+        :param target_loss: Stop the pretraining once the training loss is at most this value, None to disable
+        :param workers: Number of processes the pretraining is spread over (see DataParallelTrainer), 1 to train in this process
+        :param sync_interval: Number of train steps of each worker between two averagings of the worker states
+        :param async_eval: Monitor the latent space in a background process (see AsyncKMeansEvaluator), the training
+                           continues while kmeans runs and the metrics are logged when they are ready
+        '''
 
         signal.signal(signal.SIGINT, self.signal_handler)
         self.name = network_description['name']
+        # Hashed before the network builder completes the description, so that it matches the json file
+        self.arch_hash = getArchitectureHash(network_description)
         netbuilder = NetworkBuilder(network_description)
         self.shouldStopNow  = False
+        self.prefetch = prefetch
+        self.report_data_wait = report_data_wait
+        self.eval_mode = eval_mode
+        self.eval_interval = eval_interval
+        self.checkpoint_epochs = checkpoint_epochs
+        self.checkpoint_minutes = checkpoint_minutes
+        self.kmeans_jobs = kmeans_jobs
+        self.out_of_core = out_of_core
+        self.update_interval = update_interval
+        self.tol = tol
+        self.lr_schedule = lr_schedule
+        self.lr_patience = lr_patience
+        self.lr_factor = lr_factor
+        self.stop_patience = stop_patience
+        self.time_budget = time_budget
+        self.target_loss = target_loss
+        self.workers = workers
+        self.sync_interval = sync_interval
+        self.async_eval = async_eval
+        self.kmeans_mode = 'full'
+        self.chunk_rows = None
+        if out_of_core:
+            self.eval_mode = self.kmeans_mode = 'chunked'
+            self.chunk_rows = OUT_OF_CORE_CHUNK_ROWS
         # Get the lasagne network using the network builder class that creates autoencoder with the specified architecture
         self.network = netbuilder.buildNetwork()
         self.encode_layer, self.encode_size = netbuilder.getEncodeLayerAndSize()
+        self.param_names = netbuilder.getParamNames(self.network)
         self.t_input, self.t_target = netbuilder.getInputAndTargetVars()
         self.input_type = netbuilder.getInputType()
         self.batch_size = netbuilder.getBatchSize()
+        self.inference_batch_size = netbuilder.getInferenceBatchSize()
+        self.function_cache = None
+        if function_cache_dir:
+            # The name of the architecture does not change the graphs, runs of renamed copies share the cache
+            self.function_cache = FunctionCache(function_cache_dir, dict((key, value) for key, value in netbuilder.network_description.items() if key != 'name'))
         rootLogger.info("Network: " + self.networkToStr())
         # Reconstruction is just output of the network
         recon_prediction_expression = layers.get_output(self.network)
@@ -61,11 +119,154 @@ class DCJC(object):
         params = lasagne.layers.get_all_params(self.network, trainable=True)
         # SGD with momentum + Decaying learning rate
         self.learning_rate = theano.shared(lasagne.utils.floatX(0.01))
-        updates = lasagne.updates.nesterov_momentum(loss, params, learning_rate=self.learning_rate)
-        # Theano functions for calculating loss, predicting reconstruction, encoding
-        self.trainAutoencoder = theano.function([self.t_input, self.t_target], loss, updates=updates)
-        self.predictReconstruction = theano.function([self.t_input], recon_prediction_expression)
-        self.predictEncoding = theano.function([self.t_input], encode_prediction_expression)
+        self.autoencoder_updates = lasagne.updates.nesterov_momentum(loss, params, learning_rate=self.learning_rate)
+        # Theano functions for calculating loss, predicting reconstruction, encoding - compiled on first use, the
+        # clustering stages only need the encoder
+        self.function_specs = {
+            'trainAutoencoder': ([self.t_input, self.t_target], loss, self.autoencoder_updates),
+            'predictReconstruction': ([self.t_input], recon_prediction_expression, None),
+            'predictEncoding': ([self.t_input], encode_prediction_expression, None)
+        }
+        self.functions = {}
+
+    @property
+    def trainAutoencoder(self):
+        return self.getFunction('trainAutoencoder')
+
+    @property
+    def predictReconstruction(self):
+        return self.getFunction('predictReconstruction')
+
+    @property
+    def predictEncoding(self):
+        return self.getFunction('predictEncoding')
+
+    def getFunction(self, name):
+        # Compiles one of the autoencoder functions the first time it is needed
+        if name not in self.functions:
+            inputs, outputs, updates = self.function_specs[name]
+            self.functions[name] = self.compileFunction(name, inputs, outputs, updates, [self.network])
+        return self.functions[name]
+
+    def compileFunction(self, name, inputs, outputs, updates, networks):
+        '''
+        Compiles a theano function, going through the on-disk function cache if it is enabled
+        :param name: Name of the function, unique for the architecture
+        :param networks: Lasagne networks whose params the function uses
+        :return: Compiled theano function
+        '''
+        if self.function_cache is None:
+            return theano.function(inputs, outputs, updates=updates)
+        shared_variables = self.getTrainingState(networks, updates or {}) + [self.learning_rate]
+        start_time = time.time()
+        function = self.function_cache.compile(name, inputs, outputs, updates, shared_variables)
+        rootLogger.debug("Function %s ready in %.2fs" % (name, time.time() - start_time))
+        return function
+
+    def encodeDataset(self, dataset, Z=None, batch_size=None):
+        '''
+        Encodes every sample of the dataset (including the last incomplete batch) into the latent space. Uses the
+        inference batch size, which is independent of the batch size used for training
+        :param dataset: Data to be encoded
+        :param Z: Output buffer of shape (number of samples, encode size), allocated if not given
+        :param batch_size: Overrides the inference batch size of the network
+        :return: Z - latent space representation of the dataset
+        '''
+        if Z is None:
+            Z = np.zeros((dataset.input.shape[0], self.encode_size), dtype=np.float32)
+        self.predictDataset(dataset, self.predictEncoding, [Z], batch_size or self.inference_batch_size)
+        return Z
+
+    def getLatentSpacePath(self, dataset, prefix):
+        # Latent spaces are saved next to the params, e.g. saved_params/MNIST/pc_z_<arch>.npy for prefix pc_z_
+        return 'saved_params/%s/%s%s.npy' % (dataset.name, prefix, self.name)
+
+    def openLatentSpace(self, dataset, prefix, initial_prefix=None):
+        '''
+        Buffer for the latent space of the dataset that is saved under prefix by saveLatentSpace. Out of core it is a .npy
+        memory map written in place under a temporary name, otherwise an in-memory array
+        :param dataset: Dataset whose samples are encoded
+        :param prefix: Prefix of the latent space file (z_, pc_z_, pc_km_z_)
+        :param initial_prefix: Initialize the buffer with the latent space saved under this prefix, None for zeros
+        :return: Array of shape (number of samples, encode size)
+        '''
+        shape = (dataset.input.shape[0], self.encode_size)
+        if not self.out_of_core:
+            if initial_prefix:
+                return np.load(self.getLatentSpacePath(dataset, initial_prefix))
+            return np.zeros(shape, dtype=np.float32)
+        Z = np.lib.format.open_memmap(self.getLatentSpacePath(dataset, prefix)[:-len('.npy')] + '.tmp.npy', mode='w+', dtype=np.float32, shape=shape)
+        if initial_prefix:
+            initial = np.load(self.getLatentSpacePath(dataset, initial_prefix), mmap_mode='r')
+            for start_idx in range(0, shape[0], self.chunk_rows):
+                Z[start_idx:start_idx + self.chunk_rows] = initial[start_idx:start_idx + self.chunk_rows]
+        return Z
+
+    def saveLatentSpace(self, dataset, prefix, Z):
+        # A memory mapped latent space is already on disk, it only has to be flushed and moved to its final name
+        if isinstance(Z, np.memmap):
+            Z.flush()
+            os.rename(Z.filename, self.getLatentSpacePath(dataset, prefix))
+        else:
+            np.save(self.getLatentSpacePath(dataset, prefix), Z)
+
+    def saveParams(self, dataset, stage, clustering_network=None, epoch=None):
+        '''
+        Saves all params of the autoencoder by name (see NetworkBuilder.getParamNames), including the non trainable
+        batch norm statistics, and the cluster centers of the clustering layer to the model file of the stage
+        (<prefix>m_<arch>.model, see artifact.py)
+        :param stage: Training stage - pretrain, kld or km
+        :param clustering_network: Clustering layer of the stage, None if it has none
+        :param epoch: Number of epochs the saved params were trained for in this stage
+        '''
+        arrays = [(name, param.get_value(), attributes) for param, name, attributes in self.param_names]
+        if clustering_network is not None:
+            arrays.append((CLUSTER_CENTERS, clustering_network.W.get_value(), {'trainable': True}))
+        saveArtifact(getArtifactPath(dataset.name, stage, self.name), arrays,
+                     {'arch_hash': self.arch_hash, 'arch_name': self.name, 'dataset': dataset.name, 'stage': stage, 'epoch': epoch})
+
+    def loadParams(self, dataset, stage):
+        '''
+        Sets the params of the autoencoder to the ones saved by a training stage, after checking that they were saved
+        for this architecture. Params saved before the model files (positional .npz of the trainable params) are loaded
+        as well, the batch norm statistics keep their values then
+        :param stage: Training stage - pretrain, kld or km
+        '''
+        path = getArtifactPath(dataset.name, stage, self.name)
+        if not os.path.exists(path):
+            with np.load(path[:-len('.model')] + '.npz') as f:
+                param_values = [f['arr_%d' % i] for i in range(len(f.files))]
+                lasagne.layers.set_all_param_values(self.network, param_values, trainable=True)
+            return
+        artifact = ModelArtifact(path)
+        artifact.validate(arch_hash=self.arch_hash,
+                          shapes=dict((name, param.get_value(borrow=True).shape) for param, name, attributes in self.param_names))
+        for param, name, attributes in self.param_names:
+            param.set_value(np.array(artifact.getArray(name), dtype=param.dtype))
+
+    def createScratchArray(self, dataset, shape):
+        '''
+        Working array of the training (e.g. Q and P), backed by an anonymous file next to the saved params when training
+        out of core - the file is removed by the system once the array is released
+        '''
+        if not self.out_of_core:
+            return np.zeros(shape, dtype=np.float32)
+        return np.memmap(tempfile.TemporaryFile(dir='saved_params/%s' % dataset.name), dtype=np.float32, mode='w+', shape=shape)
+
+    def predictDataset(self, dataset, predict_function, outputs, batch_size):
+        '''
+        Runs a prediction function over the whole dataset in order and writes its outputs into the given buffers
+        :param dataset: Data on which the function is evaluated
+        :param predict_function: Theano function of the input, returning one array per output buffer
+        :param outputs: List of output buffers, each with one row per sample of the dataset
+        :param batch_size: Size of the batches fed to the function
+        '''
+        for start_idx, inputs in dataset.iterate_sequential(self.input_type, batch_size):
+            results = predict_function(inputs)
+            if len(outputs) == 1:
+                results = [results]
+            for output, result in zip(outputs, results):
+                output[start_idx:start_idx + inputs.shape[0]] = result
 
     def getReconstructionLossExpression(self, prediction_expression, t_target):
         '''
@@ -83,76 +284,232 @@ class DCJC(object):
         else:
             exec(command)
 
-    def pretrainWithData(self, dataset, epochs, continue_training=False):
+    def pretrainWithData(self, dataset, epochs, continue_training=False, resume=False):
         '''
-        Pretrains the autoencoder on the given dataset
+        Pretrains the autoencoder on the given dataset. With a stopping policy (stop_patience, time_budget, target_loss)
+        or the plateau learning rate schedule, the weights of the epoch with the lowest loss are kept and saved
         :param dataset: Data on which the autoencoder is trained
         :param epochs: number of training epochs
         :param continue_training: Resume training if saved params available
+        :param resume: Continue from the last checkpoint of the pretraining (params, optimizer state, learning rate, epoch)
         :return: None - (side effect) saves the trained network params and latent space in appropriate location
         '''
         batch_size = self.batch_size
         # array for holding the latent space representation of input
-        Z = np.zeros((dataset.input.shape[0], self.encode_size), dtype=np.float32);
-        # in case we're continuing training load the network params
-        if continue_training:
-            with np.load('saved_params/%s/m_%s.npz' % (dataset.name, self.name)) as f:
-                param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-                lasagne.layers.set_all_param_values(self.network, param_values, trainable=True)
-        for epoch in range(epochs):
-            error = 0
-            total_batches = 0
-            for batch in dataset.iterate_minibatches(self.input_type, batch_size, shuffle=True):
-                inputs, targets = batch
-                error += self.trainAutoencoder(inputs, targets)
-                total_batches += 1
-            # learning rate decay
-            self.learning_rate.set_value(self.learning_rate.get_value() * lasagne.utils.floatX(0.9999))
-            # For every 20th iteration, print the clustering accuracy and nmi - for checking if the network
+        Z = self.openLatentSpace(dataset, 'z_')
+        evaluator = self.createEvaluator(dataset)
+        checkpointer = self.getCheckpointer(dataset, 'pretrain')
+        training_state = self.getTrainingState([self.network], self.autoencoder_updates) + [self.learning_rate]
+        telemetry = self.getTelemetry(dataset, 'pretrain')
+        lr_scheduler = ReduceLROnPlateau(self.learning_rate, self.lr_factor, self.lr_patience) if self.lr_schedule == 'plateau' else None
+        stopper = EarlyStopping(self.stop_patience, self.time_budget, self.target_loss)
+        best_param_values = None
+        num_params = len(lasagne.layers.get_all_params(self.network))
+        start_epoch = 0
+        if resume and checkpointer.exists():
+            # The schedule, the stopping policy and the snapshot of the best weights continue as well
+            start_epoch, extras = self.restoreCheckpoint(checkpointer, training_state, evaluator)
+            if lr_scheduler is not None:
+                lr_scheduler.setState(extras)
+            stopper.setState(extras)
+            if 'best_param_0' in extras:
+                best_param_values = [extras['best_param_%d' % i] for i in range(num_params)]
+        elif continue_training:
+            # in case we're continuing training load the network params
+            self.loadParams(dataset, 'pretrain')
+        trainer = None
+        epochs_done = start_epoch
+        if self.workers > 1:
+            # The workers are forked with the compiled train function and the state restored above
+            trainer = DataParallelTrainer(self.trainAutoencoder, training_state, dataset, self.input_type, batch_size,
+                                          self.workers, self.sync_interval, self.prefetch)
+            trainer.start()
+        for epoch in range(start_epoch, epochs):
+            if trainer is None:
+                batches = dataset.iterate_minibatches(self.input_type, batch_size, shuffle=True, prefetch=self.prefetch)
+                error, total_batches = self.trainEpoch(batches, lambda batch: self.trainAutoencoder(batch[0], batch[1]), telemetry)
+            else:
+                error, total_batches = trainer.trainEpoch(epoch, telemetry)
+            epochs_done = epoch + 1
+            if lr_scheduler is None:
+                # learning rate decay
+                self.learning_rate.set_value(self.learning_rate.get_value() * lasagne.utils.floatX(0.9999))
+            elif lr_scheduler.update(error / total_batches):
+                rootLogger.info("%-30s     %8.6f" % ("Learning rate reduced [%d]" % (epoch + 1), self.learning_rate.get_value()))
+            if stopper.update(epoch, error / total_batches) and (stopper.enabled or lr_scheduler is not None):
+                # Snapshot of all params, including the non trainable batch norm statistics
+                best_param_values = lasagne.layers.get_all_param_values(self.network)
+            # For every 2nd iteration (by default), print the clustering accuracy and nmi - for checking if the network
             # is actually doing something meaningful - the labels are never used for training
-            if (epoch + 1) % 2 == 0:
-                for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-                    Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
-                    # Uncomment the next two lines to create reconstruction outputs in folder dumps/ (may need to be created)
-                    #for i, x in enumerate(self.predictReconstruction(batch[0])):
-                    #	print('dump')
-                    #	rescaleReshapeAndSaveImage(x[0], "dumps/%02d%03d.jpg"%(epoch,i));
-                rootLogger.info(evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), "%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches))[0])
+            if evaluator.isDue(epoch, 2):
+                with telemetry.phase('encode'):
+                    self.encodeDataset(dataset, Z)
+                with telemetry.phase('kmeans'):
+                    evaluator.submit(Z, dataset.labels, "%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches))
             else:
                 # Just report the training loss
                 rootLogger.info("%-30s     %8s     %8s" % ("%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches), "", ""))
+            self.logEvaluations(evaluator.poll())
+            if checkpointer.isDue(epoch) or self.shouldStopNow:
+                extras = stopper.getState()
+                if lr_scheduler is not None:
+                    extras.update(lr_scheduler.getState())
+                if best_param_values is not None:
+                    extras.update(('best_param_%d' % i, value) for i, value in enumerate(best_param_values))
+                with telemetry.phase('checkpoint'):
+                    self.saveCheckpoint(checkpointer, training_state, epoch + 1, evaluator, extras)
+            telemetry.endEpoch(epoch, total_batches * batch_size, error / total_batches)
+            if stopper.enabled and stopper.reason:
+                rootLogger.info("Stopping the pretraining after %d epochs: %s" % (epoch + 1, stopper.reason))
+                break
             if self.shouldStopNow:
-            	break
+                break
+        if trainer is not None:
+            trainer.close()
+        self.logEvaluations(evaluator.close())
+        if best_param_values is not None and stopper.best_epoch != epochs_done - 1:
+            rootLogger.info("Keeping the weights of epoch %d [%.4f]" % (stopper.best_epoch + 1, stopper.best_loss))
+            lasagne.layers.set_all_param_values(self.network, best_param_values)
+            epochs_done = stopper.best_epoch + 1
         # The inputs in latent space after pretraining
-        for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-            Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
+        self.encodeDataset(dataset, Z)
         # Save network params and latent space
-        np.save('saved_params/%s/z_%s.npy' % (dataset.name, self.name), Z)
-        # Borrowed from mnist lasagne example
-        np.savez('saved_params/%s/m_%s.npz' % (dataset.name, self.name), *lasagne.layers.get_all_param_values(self.network, trainable=True))
+        self.saveLatentSpace(dataset, 'z_', Z)
+        self.saveParams(dataset, 'pretrain', epoch=epochs_done)
+        self.finishCheckpoints(checkpointer)
 
-    def doClusteringWithKLdivLoss(self, dataset, combined_loss, epochs):
+    def doClusteringWithKLdivLoss(self, dataset, combined_loss, epochs, resume=False):
         '''
         Trains the autoencoder with combined kldivergence loss and reconstruction loss, or just the kldivergence loss
         At the moment does not give good results
         :param dataset: Data on which the autoencoder is trained
         :param combined_loss: boolean - whether to use both reconstruction and kl divergence loss or just kldivergence loss
         :param epochs: Number of training epochs
+        :param resume: Continue from the last checkpoint of this clustering stage
         :return: None - (side effect) saves the trained network params and latent space in appropriate location
         '''
         batch_size = self.batch_size
+        checkpointer = self.getCheckpointer(dataset, 'kld')
+        resuming = resume and checkpointer.exists()
         # Load saved network params and inputs in latent space obtained after pretraining
-        with np.load('saved_params/%s/m_%s.npz' % (dataset.name, self.name)) as f:
-            param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-            lasagne.layers.set_all_param_values(self.network, param_values, trainable=True)
-        Z = np.load('saved_params/%s/z_%s.npy' % (dataset.name, self.name))
-        # Find initial cluster centers
-        quality_desc, cluster_centers = evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), 'Initial')
-        rootLogger.info(quality_desc)
+        self.loadParams(dataset, 'pretrain')
+        Z = self.openLatentSpace(dataset, 'pc_z_', 'z_')
+        evaluator = self.createEvaluator(dataset)
+        if resuming:
+            # The cluster centers are restored from the checkpoint
+            cluster_centers = np.zeros((dataset.getClusterCount(), self.encode_size), dtype=theano.config.floatX)
+        else:
+            # Find initial cluster centers
+            quality_desc, cluster_centers = evaluateKMeansCached(Z, dataset.labels, dataset.getClusterCount(), 'Initial',
+                                                                 n_jobs=self.kmeans_jobs, mode=self.kmeans_mode)
+            rootLogger.info(quality_desc)
+            evaluator.setCenters(cluster_centers)
+        clustering_network, trainStep, encodeWithSoftAssignments, updates = self.buildKLDivClustering(cluster_centers, combined_loss)
+        training_state = self.getTrainingState([self.network, clustering_network], updates)
+        telemetry = self.getTelemetry(dataset, 'kld')
+        start_epoch = 0
+        batches_per_epoch = dataset.input.shape[0] // batch_size
+        targets = TargetDistribution(self.createScratchArray(dataset, (Z.shape[0], dataset.getClusterCount())),
+                                     self.createScratchArray(dataset, (Z.shape[0], dataset.getClusterCount())),
+                                     self.update_interval or batches_per_epoch, self.tol, self.chunk_rows)
+        if resuming:
+            start_epoch, extras = self.restoreCheckpoint(checkpointer, training_state, evaluator)
+            if not targets.setState(extras):
+                # Checkpoints without the target distribution: P is derived from the restored params instead, training
+                # must not start on the all zero scratch array (the KL divergence of P = 0 is NaN)
+                targets.iteration = start_epoch * batches_per_epoch
+                self.refreshTargets(dataset, targets, encodeWithSoftAssignments, Z, telemetry)
+        else:
+            # The latent space from pretraining is up to date with the loaded params, so the current distribution
+            # can be derived from it directly. Afterwards Z and Q are refreshed together, at most once per refresh of P
+            with telemetry.phase('pq'):
+                self.calculateQ(Z, cluster_centers, targets.qij, self.chunk_rows)
+            targets.q_is_current = True
+
+        def beforeBatch():
+            # Refreshes P when it is due within the epoch, stops the epoch once the assignments are stable. It runs
+            # before the next batch is pulled, so that batch already holds the new P. P is modified in place, so the
+            # prefetching worker is stopped first - otherwise it could gather rows half old and half new - and restarted
+            # afterwards, gathering the prefetched batches again with the new P
+            if targets.isDue():
+                prefetching = isinstance(batches, MinibatchPrefetcher)
+                if prefetching:
+                    batches.close()
+                if self.refreshTargets(dataset, targets, encodeWithSoftAssignments, Z, telemetry):
+                    return True
+                if prefetching:
+                    batches.restart()
+            return False
+
+        def targetsStep(batch):
+            targets.step()
+            return trainStep(batch)
+
+        epochs_done = start_epoch
+        for epoch in range(start_epoch, epochs):
+            # Calculate the desired distribution from the current one. The assignments of a checkpoint can be stable
+            # already, P is refreshed at the end of an epoch when it is due there
+            if targets.converged or (targets.isDue() and self.refreshTargets(dataset, targets, encodeWithSoftAssignments, Z, telemetry)):
+                break
+            batches = dataset.iterate_minibatches(self.input_type, batch_size, targets.pij, shuffle=True, prefetch=self.prefetch)
+            error, total_batches = self.trainEpoch(batches, targetsStep, telemetry, beforeBatch)
+            epochs_done = epoch + 1
+            # For every 10th iteration, print the clustering accuracy and nmi - for checking if the network
+            # is actually doing something meaningful - the labels are never used for training
+            if evaluator.isDue(epoch, 10):
+                with telemetry.phase('encode'):
+                    self.predictDataset(dataset, encodeWithSoftAssignments, [Z, targets.qij], self.inference_batch_size)
+                targets.q_is_current = True
+                with telemetry.phase('kmeans'):
+                    evaluator.submit(Z, dataset.labels, "%d [%.4f]" % (epoch, error / total_batches))
+            self.logEvaluations(evaluator.poll())
+            if checkpointer.isDue(epoch) or self.shouldStopNow:
+                with telemetry.phase('checkpoint'):
+                    self.saveCheckpoint(checkpointer, training_state, epoch + 1, evaluator, targets.getState())
+            telemetry.endEpoch(epoch, total_batches * batch_size, error / total_batches)
+            if self.shouldStopNow or targets.converged:
+                break
+        self.logEvaluations(evaluator.close())
+        # Save the inputs in latent space and the network parameters
+        if not targets.q_is_current:
+            self.encodeDataset(dataset, Z)
+        self.saveLatentSpace(dataset, 'pc_z_', Z)
+        self.saveParams(dataset, 'kld', clustering_network, epochs_done)
+        self.finishCheckpoints(checkpointer)
+
+    def refreshTargets(self, dataset, targets, encodeWithSoftAssignments, Z, telemetry):
+        '''
+        Recomputes the target distribution from the soft assignments of the current network, the dataset is only
+        encoded again if Z and Q are not up to date with the params
+        :param targets: TargetDistribution of the clustering stage
+        :param encodeWithSoftAssignments: Function returning the latent space and the soft assignments of its input
+        :param Z: Buffer of the latent space, updated together with Q
+        :return: True if the hard assignments are stable (see TargetDistribution.refresh)
+        '''
+        if not targets.q_is_current:
+            with telemetry.phase('encode'):
+                self.predictDataset(dataset, encodeWithSoftAssignments, [Z, targets.qij], self.inference_batch_size)
+            targets.q_is_current = True
+        with telemetry.phase('pq'):
+            converged = targets.refresh()
+        if targets.changed is not None:
+            rootLogger.debug("%-30s     %8.4f" % ("Assignments changed [%d]" % targets.iteration, targets.changed))
+        if converged:
+            rootLogger.info("%-30s     %8.4f < %s" % ("Assignments stable [%d]" % targets.iteration, targets.changed, self.tol))
+        return converged
+
+    def buildKLDivClustering(self, cluster_centers, combined_loss):
+        '''
+        Extends the autoencoder with a clustering layer and compiles the functions for training with the kldivergence loss
+        :param cluster_centers: Initial cluster centers of the clustering layer
+        :param combined_loss: boolean - whether to use both reconstruction and kl divergence loss or just kldivergence loss
+        :return: clustering layer, train step (function of a (inputs, P) batch returning the loss), function returning the
+                 latent space and soft assignments of its input, updates of the train function
+        '''
         # P is the more pure target distribution we want to achieve
         P = T.matrix('P')
         # Extend the network so it calculates soft assignment cluster distribution for the inputs in latent space
-        clustering_network = ClusteringLayer(self.encode_layer, dataset.getClusterCount(), cluster_centers, batch_size,self.encode_size)
+        clustering_network = ClusteringLayer(self.encode_layer, cluster_centers.shape[0], cluster_centers)
         soft_assignments = layers.get_output(clustering_network)
         reconstructed_output_exp = layers.get_output(self.network)
         # Clustering loss = kl divergence between the pure distribution P and current distribution
@@ -169,57 +526,70 @@ class DCJC(object):
         all_params = params_dec
         if combined_loss:
             all_params.extend(params_ae)
-        # Parameters = unique parameters in the new network
-        all_params = list(set(all_params))
+        # Parameters = unique parameters in the new network, kept in a stable order so that checkpoints can be restored
+        all_params = [param for i, param in enumerate(all_params) if param not in all_params[:i]]
         # SGD with momentum, LR = 0.01, Momentum = 0.9
         updates = lasagne.updates.nesterov_momentum(total_loss, all_params, learning_rate=0.01)
-        # Function to calculate the soft assignment distribution
-        getSoftAssignments = theano.function([self.t_input], soft_assignments)
+        # Function to calculate the latent space and the soft assignment distribution in a single forward pass
+        encode_prediction_expression = layers.get_output(self.encode_layer, deterministic=True)
+        soft_assignments_prediction = layers.get_output(clustering_network, deterministic=True)
+        networks = [self.network, clustering_network]
+        encodeWithSoftAssignments = self.compileFunction('encodeWithSoftAssignments', [self.t_input],
+                                                         [encode_prediction_expression, soft_assignments_prediction], None, networks)
         # Train function - based on whether complete loss is used or not
-        trainFunction = None
         if combined_loss:
-            trainFunction = theano.function([self.t_input, self.t_target, P], total_loss, updates=updates)
+            trainFunction = self.compileFunction('trainKLDivCombined', [self.t_input, self.t_target, P], total_loss, updates, networks)
+            trainStep = lambda batch: trainFunction(batch[0], batch[0], batch[1])
         else:
-            trainFunction = theano.function([self.t_input, P], clustering_loss, updates=updates)
-        for epoch in range(epochs):
-            # Get the current distribution
-            qij = np.zeros((dataset.input.shape[0], dataset.getClusterCount()), dtype=np.float32)
-            for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-                qij[i * batch_size: (i + 1) * batch_size] = getSoftAssignments(batch[0])
-            # Calculate the desired distribution
-            pij = self.calculateP(qij)
-            error = 0
-            total_batches = 0
-            for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, pij, shuffle=True)):
-                if (combined_loss):
-                    error += trainFunction(batch[0], batch[0], batch[1])
-                else:
-                    error += trainFunction(batch[0], batch[1])
-                total_batches += 1
-            for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-                Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
-            # For every 10th iteration, print the clustering accuracy and nmi - for checking if the network
-            # is actually doing something meaningful - the labels are never used for training
-            if (epoch + 1) % 10 == 0:
-                rootLogger.info(evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), "%d [%.4f]" % (
-                    epoch, error / total_batches))[0])
-            if self.shouldStopNow:
-           	   break
-        # Save the inputs in latent space and the network parameters
-        for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-            Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
-        np.save('saved_params/%s/pc_z_%s.npy' % (dataset.name, self.name), Z)
-        np.savez('saved_params/%s/pc_m_%s.npz' % (dataset.name, self.name),
-                 *lasagne.layers.get_all_param_values(self.network, trainable=True))
-
-    def calculateP(self, Q):
-        # Function to calculate the desired distribution Q^2, for more details refer to DEC paper
-        f = Q.sum(axis=0)
-        pij_numerator = Q * Q
-        pij_numerator = pij_numerator / f
-        normalizer_p = pij_numerator.sum(axis=1).reshape((Q.shape[0], 1))
-        P = pij_numerator / normalizer_p
-        return P
+            trainFunction = self.compileFunction('trainKLDiv', [self.t_input, P], clustering_loss, updates, networks)
+            trainStep = lambda batch: trainFunction(batch[0], batch[1])
+        return clustering_network, trainStep, encodeWithSoftAssignments, updates
+
+    @staticmethod
+    def calculateQ(Z, cluster_centers, out=None, chunk_rows=None):
+        '''
+        Soft assignment distribution of the latent space Z, same as the output of the ClusteringLayer but computed
+        with numpy from an already encoded latent space
+        :param Z: Latent space representation of the inputs
+        :param cluster_centers: Coordinates of the cluster centers in latent space
+        :param out: Output array (e.g. a memory map), allocated if not given
+        :param chunk_rows: Compute the distribution chunk_rows rows at a time, None for all rows at once
+        :return: qij = (1+|zi - uj|^2)^(-1)/sum_j'((1+|zi - uj'|^2)^(-1))
+        '''
+        cluster_centers = cluster_centers.astype(Z.dtype)
+        if out is None:
+            out = np.empty((Z.shape[0], cluster_centers.shape[0]), dtype=Z.dtype)
+        chunk_rows = chunk_rows or max(Z.shape[0], 1)
+        centers_norm = (cluster_centers * cluster_centers).sum(axis=1)[None, :]
+        for start_idx in range(0, Z.shape[0], chunk_rows):
+            Z_chunk = np.asarray(Z[start_idx:start_idx + chunk_rows])
+            distances = (Z_chunk * Z_chunk).sum(axis=1)[:, None] - 2 * np.dot(Z_chunk, cluster_centers.T) + centers_norm
+            qij = 1 / (1 + np.maximum(distances, 0))
+            out[start_idx:start_idx + chunk_rows] = qij / qij.sum(axis=1)[:, None]
+        return out
+
+    @staticmethod
+    def calculateP(Q, out=None, chunk_rows=None):
+        '''
+        Function to calculate the desired distribution Q^2, for more details refer to DEC paper. Every row is normalized
+        by the column sums of the whole Q, so chunked it takes two passes - the column sums first, then the rows
+        :param Q: Current soft assignment distribution
+        :param out: Output array (e.g. a memory map), allocated if not given
+        :param chunk_rows: Compute the distribution chunk_rows rows at a time, None for all rows at once
+        :return: P
+        '''
+        if out is None:
+            out = np.empty(Q.shape, dtype=Q.dtype)
+        chunk_rows = chunk_rows or max(Q.shape[0], 1)
+        chunk_starts = range(0, Q.shape[0], chunk_rows)
+        f = np.sum([Q[start_idx:start_idx + chunk_rows].sum(axis=0) for start_idx in chunk_starts], axis=0)
+        for start_idx in chunk_starts:
+            Q_chunk = np.asarray(Q[start_idx:start_idx + chunk_rows])
+            pij_numerator = Q_chunk * Q_chunk
+            pij_numerator = pij_numerator / f
+            normalizer_p = pij_numerator.sum(axis=1).reshape((Q_chunk.shape[0], 1))
+            out[start_idx:start_idx + chunk_rows] = pij_numerator / normalizer_p
+        return out
 
     def getKLDivLossExpression(self, Q_expression, P_expression):
         # Loss = KL Divergence between the two distributions
@@ -229,72 +599,97 @@ class DCJC(object):
         loss = sum_arg.sum(axis=1).sum(axis=0)
         return loss
 
-    def doClusteringWithKMeansLoss(self, dataset, epochs):
+    def doClusteringWithKMeansLoss(self, dataset, epochs, resume=False):
         '''
         Trains the autoencoder with combined kMeans loss and reconstruction loss
         At the moment does not give good results
         :param dataset: Data on which the autoencoder is trained
         :param epochs: Number of training epochs
+        :param resume: Continue from the last checkpoint of this clustering stage
         :return: None - (side effect) saves the trained network params and latent space in appropriate location
         '''
         batch_size = self.batch_size
+        checkpointer = self.getCheckpointer(dataset, 'km')
+        resuming = resume and checkpointer.exists()
         # Load the inputs in latent space produced by the pretrained autoencoder and use it to initialize cluster centers
-        Z = np.load('saved_params/%s/z_%s.npy' % (dataset.name, self.name))
-        quality_desc, cluster_centers = evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), 'Initial')
-        rootLogger.info(quality_desc)
-        # Load network parameters - code borrowed from mnist lasagne example
-        with np.load('saved_params/%s/m_%s.npz' % (dataset.name, self.name)) as f:
-            param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-            lasagne.layers.set_all_param_values(self.network, param_values, trainable=True)
+        Z = self.openLatentSpace(dataset, 'pc_km_z_', 'z_')
+        evaluator = self.createEvaluator(dataset)
+        if resuming:
+            # The cluster centers are restored from the checkpoint
+            cluster_centers = np.zeros((dataset.getClusterCount(), self.encode_size), dtype=theano.config.floatX)
+        else:
+            quality_desc, cluster_centers = evaluateKMeansCached(Z, dataset.labels, dataset.getClusterCount(), 'Initial',
+                                                                 n_jobs=self.kmeans_jobs, mode=self.kmeans_mode)
+            rootLogger.info(quality_desc)
+            evaluator.setCenters(cluster_centers)
+        # Load network parameters
+        self.loadParams(dataset, 'pretrain')
+        clustering_network, trainStep, updates = self.buildKMeansClustering(cluster_centers)
+        training_state = self.getTrainingState([self.network, clustering_network], updates)
+        telemetry = self.getTelemetry(dataset, 'km')
+        start_epoch = 0
+        if resuming:
+            start_epoch, _ = self.restoreCheckpoint(checkpointer, training_state, evaluator)
+        epochs_done = start_epoch
+        for epoch in range(start_epoch, epochs):
+            batches = dataset.iterate_minibatches(self.input_type, batch_size, shuffle=True, prefetch=self.prefetch)
+            error, total_batches = self.trainEpoch(batches, trainStep, telemetry)
+            epochs_done = epoch + 1
+            # For every 10th epoch, update the cluster centers and print the clustering accuracy and nmi - for checking if the network
+            # is actually doing something meaningful - the labels are never used for training
+            if evaluator.isDue(epoch, 10):
+                with telemetry.phase('encode'):
+                    self.encodeDataset(dataset, Z)
+                with telemetry.phase('kmeans'):
+                    evaluator.submit(Z, dataset.labels, "%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches))
+            else:
+                # Just print the training loss
+                rootLogger.info("%-30s     %8s     %8s" % ("%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches), "", ""))
+            # The centers of an evaluation are applied as soon as it finished
+            cluster_centers = self.logEvaluations(evaluator.poll())
+            if cluster_centers is not None:
+                clustering_network.W.set_value(lasagne.utils.floatX(cluster_centers))
+            if checkpointer.isDue(epoch) or self.shouldStopNow:
+                with telemetry.phase('checkpoint'):
+                    self.saveCheckpoint(checkpointer, training_state, epoch + 1, evaluator)
+            telemetry.endEpoch(epoch, total_batches * batch_size, error / total_batches)
+            if self.shouldStopNow:
+                break
+        cluster_centers = self.logEvaluations(evaluator.close())
+        if cluster_centers is not None:
+            clustering_network.W.set_value(lasagne.utils.floatX(cluster_centers))
+        # Save the inputs in latent space and the network parameters
+        self.encodeDataset(dataset, Z)
+        self.saveLatentSpace(dataset, 'pc_km_z_', Z)
+        self.saveParams(dataset, 'km', clustering_network, epochs_done)
+        self.finishCheckpoints(checkpointer)
+
+    def buildKMeansClustering(self, cluster_centers):
+        '''
+        Extends the autoencoder with a clustering layer and compiles the function for training with the kmeans loss
+        :param cluster_centers: Initial cluster centers of the clustering layer
+        :return: clustering layer, train step (function of a (inputs, targets) batch returning the loss), updates of the train function
+        '''
         # reconstruction loss is just rms loss between input and reconstructed input
         reconstruction_loss = self.getReconstructionLossExpression(layers.get_output(self.network), self.t_target)
         # extent the network to do soft cluster assignments
-        clustering_network = ClusteringLayer(self.encode_layer, dataset.getClusterCount(), cluster_centers, batch_size, self.encode_size)
+        clustering_network = ClusteringLayer(self.encode_layer, cluster_centers.shape[0], cluster_centers)
         soft_assignments = layers.get_output(clustering_network)
         # k-means loss is the sum of distances from the cluster centers weighted by the soft assignments to the clusters
-        kmeansLoss = self.getKMeansLoss(layers.get_output(self.encode_layer), soft_assignments, clustering_network.W, dataset.getClusterCount(), self.encode_size, batch_size)
+        kmeansLoss = self.getKMeansLoss(layers.get_output(self.encode_layer), soft_assignments, clustering_network.W)
         params = lasagne.layers.get_all_params(self.network, trainable=True)
         # total loss = reconstruction loss + lambda * kmeans loss
         weight_reconstruction = 1
         weight_kmeans = 0.1
         total_loss = weight_kmeans * kmeansLoss + weight_reconstruction * reconstruction_loss
         updates = lasagne.updates.nesterov_momentum(total_loss, params, learning_rate=0.01)
-        trainKMeansWithAE = theano.function([self.t_input, self.t_target], total_loss, updates=updates)
-        for epoch in range(epochs):
-            error = 0
-            total_batches = 0
-            for batch in dataset.iterate_minibatches(self.input_type, batch_size, shuffle=True):
-                inputs, targets = batch
-                error += trainKMeansWithAE(inputs, targets)
-                total_batches += 1
-            # For every 10th epoch, update the cluster centers and print the clustering accuracy and nmi - for checking if the network
-            # is actually doing something meaningful - the labels are never used for training
-            if (epoch + 1) % 10 == 0:
-                for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-                    Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
-                quality_desc, cluster_centers = evaluateKMeans(Z, dataset.labels, dataset.getClusterCount(), "%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches))
-                rootLogger.info(quality_desc)
-            else:
-                # Just print the training loss
-                rootLogger.info("%-30s     %8s     %8s" % ("%d/%d [%.4f]" % (epoch + 1, epochs, error / total_batches), "", ""))
-            if self.shouldStopNow:
-            	break
-
-        # Save the inputs in latent space and the network parameters
-        for i, batch in enumerate(dataset.iterate_minibatches(self.input_type, batch_size, shuffle=False)):
-            Z[i * batch_size:(i + 1) * batch_size] = self.predictEncoding(batch[0])
-        np.save('saved_params/%s/pc_km_z_%s.npy' % (dataset.name, self.name), Z)
-        np.savez('saved_params/%s/pc_km_m_%s.npz' % (dataset.name, self.name),
-                 *lasagne.layers.get_all_param_values(self.network, trainable=True))
-
+        trainKMeansWithAE = self.compileFunction('trainKMeansWithAE', [self.t_input, self.t_target], total_loss, updates,
+                                                 [self.network, clustering_network])
+        return clustering_network, lambda batch: trainKMeansWithAE(batch[0], batch[1]), updates
 
-    def getKMeansLoss(self, latent_space_expression, soft_assignments, t_cluster_centers, num_clusters, latent_space_dim, num_samples, soft_loss=False):
+    def getKMeansLoss(self, latent_space_expression, soft_assignments, t_cluster_centers, soft_loss=False):
         # Kmeans loss = weighted sum of latent space representation of inputs from the cluster centers
-        z = latent_space_expression.reshape((num_samples, 1, latent_space_dim))
-        z = T.tile(z, (1, num_clusters, 1))
-        u = t_cluster_centers.reshape((1, num_clusters, latent_space_dim))
-        u = T.tile(u, (num_samples, 1, 1))
-        distances = (z - u).norm(2, axis=2).reshape((num_samples, num_clusters))
+        distances = getDistances(latent_space_expression, t_cluster_centers)
         if soft_loss:
             weighted_distances = distances * soft_assignments
             loss = weighted_distances.sum(axis=1).mean()
@@ -302,6 +697,124 @@ class DCJC(object):
             loss = distances.min(axis=1).mean()
         return loss
 
+    def trainEpoch(self, batches, train_step, telemetry, before_batch=None):
+        '''
+        Runs the train step on every batch of one epoch, timing the train calls and the time spent waiting for batches
+        :param batches: Iterator over the minibatches of the epoch
+        :param train_step: Function of a batch that calls the train function and returns the loss
+        :param telemetry: EpochTelemetry to which the train and data times are added
+        :param before_batch: Function called before every batch is pulled from batches (e.g. refreshing the targets the
+                             batches are gathered from), returning True to end the epoch early. It is called once more
+                             when batches is exhausted. It does its own telemetry, its time is not counted as train or data time
+        :return: Summed loss, number of batches
+        '''
+        error = 0
+        total_batches = 0
+        train_time = 0.0
+        hook_time = 0.0
+        start_time = time.time()
+        iterator = iter(batches)
+        while True:
+            if before_batch is not None:
+                hook_start_time = time.time()
+                stop = before_batch()
+                hook_time += time.time() - hook_start_time
+                if stop:
+                    if isinstance(batches, MinibatchPrefetcher):
+                        batches.close()
+                    break
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            call_start_time = time.time()
+            error += train_step(batch)
+            train_time += time.time() - call_start_time
+            total_batches += 1
+        data_time = time.time() - start_time - train_time - hook_time
+        telemetry.add('train', train_time)
+        telemetry.add('data', data_time)
+        self.logDataWait(batches, data_time)
+        return error, total_batches
+
+    def getTelemetry(self, dataset, stage):
+        # Per epoch performance records go to a json-lines file next to the log file of the run
+        return EpochTelemetry(os.path.splitext(setupLogging())[0] + '.jsonl', stage, {'arch': self.name, 'dataset': dataset.name})
+
+    def getCheckpointer(self, dataset, stage):
+        # Checkpoints are kept next to the saved params, one per training stage (pretrain, kld, km)
+        return Checkpointer('saved_params/%s/ckpt_%s_%s.npz' % (dataset.name, stage, self.name), self.checkpoint_epochs, self.checkpoint_minutes)
+
+    def getTrainingState(self, networks, updates):
+        '''
+        :param networks: Lasagne networks trained in the current stage
+        :param updates: Updates dictionary of the train function
+        :return: List of the shared variables that make up the training state - all params of the networks (also the
+                 non trainable ones like batch norm statistics) and the optimizer buffers (e.g. momentum)
+        '''
+        state = []
+        for network in networks:
+            state.extend([param for param in lasagne.layers.get_all_params(network) if param not in state])
+        state.extend([variable for variable in updates if variable not in state])
+        return state
+
+    def createEvaluator(self, dataset):
+        '''
+        :return: KMeansEvaluator monitoring the latent space of the dataset while training, an AsyncKMeansEvaluator
+                 with async_eval
+        '''
+        if not self.async_eval:
+            return KMeansEvaluator(dataset.getClusterCount(), self.eval_mode, self.eval_interval)
+        shape = (dataset.input.shape[0], self.encode_size)
+        snapshots = None
+        if self.out_of_core:
+            # Memory maps of files are shared with the background process as well
+            snapshots = [self.createScratchArray(dataset, shape) for _ in range(2)]
+        return AsyncKMeansEvaluator(dataset.getClusterCount(), shape, self.eval_mode, self.eval_interval, snapshots)
+
+    def logEvaluations(self, results):
+        '''
+        :param results: Finished evaluations of a KMeansEvaluator, see KMeansEvaluator.poll
+        :return: The cluster centers of the newest successful evaluation, None if there is none
+        '''
+        cluster_centers = None
+        for quality_desc, centers in results:
+            if centers is None:
+                rootLogger.error(quality_desc)
+            else:
+                rootLogger.info(quality_desc)
+                cluster_centers = centers
+        return cluster_centers
+
+    def saveCheckpoint(self, checkpointer, training_state, epochs_done, evaluator, extras=None):
+        # extras: Dictionary of additional arrays of the stage, returned again by restoreCheckpoint
+        extras = dict(extras or {})
+        if evaluator.centers is not None:
+            extras['evaluator_centers'] = evaluator.centers
+        checkpointer.save(training_state, epochs_done, extras)
+        rootLogger.info("%-30s     %s" % ("Checkpoint [%d]" % epochs_done, checkpointer.path))
+
+    def restoreCheckpoint(self, checkpointer, training_state, evaluator):
+        # Restores the training state and returns the epoch from which training continues and the extras of the stage
+        epochs_done, extras = checkpointer.restore(training_state)
+        if 'evaluator_centers' in extras:
+            evaluator.setCenters(extras['evaluator_centers'])
+        rootLogger.info("Resuming from %s after %d epochs" % (checkpointer.path, epochs_done))
+        return epochs_done, extras
+
+    def finishCheckpoints(self, checkpointer):
+        # Called once a stage saved its params and latent space. The checkpoint of a completed stage is removed, a later
+        # --resume would otherwise go back to it and overwrite the saved results. A stage stopped on command keeps it
+        if not self.shouldStopNow:
+            checkpointer.remove()
+
+    def logDataWait(self, batches, data_time):
+        # Reports how long the training loop was blocked waiting for minibatches. The prefetching iterator measures its
+        # own wait, for a plain generator it is the epoch time not spent in train calls (i.e. assembling the batches)
+        if self.report_data_wait:
+            wait_time = batches.wait_time if isinstance(batches, MinibatchPrefetcher) else data_time
+            rootLogger.info("%-30s     %8.3fs" % ("Waited on data", wait_time))
+
     def networkToStr(self):
         # Utility method for printing the network structure in a shortened form
         layers = lasagne.layers.get_all_layers(self.network)
@@ -315,6 +828,91 @@ class DCJC(object):
         return result.strip()
 
 
+class TargetDistribution(object):
+    '''
+    Target distribution P of the KL divergence clustering loss. P is derived from the soft assignments Q of the whole
+    dataset and refreshed every update_interval train iterations, as in the DEC paper. The fraction of the samples whose
+    hard assignment argmax(Q) changed between two refreshes is tracked, so that training can stop once the assignments
+    are stable
+    '''
+
+    def __init__(self, qij, pij, update_interval, tol=None, chunk_rows=None):
+        '''
+        :param qij: Buffer of the soft assignments Q, one row per sample
+        :param pij: Buffer of the target distribution P, same shape as qij - the minibatch targets are gathered from it
+        :param update_interval: Number of train iterations between two refreshes of P
+        :param tol: The assignments are stable once less than this fraction of them changed, None to never stop
+        :param chunk_rows: Process Q and P chunk_rows rows at a time (see DCJC.calculateP), None for all rows at once
+        '''
+        self.qij = qij
+        self.pij = pij
+        self.update_interval = update_interval
+        self.tol = tol
+        self.chunk_rows = chunk_rows
+        # Number of train iterations done, and the iteration at which P was last refreshed
+        self.iteration = 0
+        self.refreshed_iteration = None
+        # Whether qij holds the soft assignments of the current params
+        self.q_is_current = False
+        self.assignments = None
+        self.changed = None
+        self.converged = False
+
+    def isDue(self):
+        return self.iteration % self.update_interval == 0 and self.refreshed_iteration != self.iteration
+
+    def step(self):
+        # Called for every train step, the step makes Q stale
+        self.iteration += 1
+        self.q_is_current = False
+
+    def refresh(self):
+        '''
+        Recomputes P from the current Q and compares the hard assignments with the ones of the previous refresh
+        :return: True if less than tol of the assignments changed
+        '''
+        DCJC.calculateP(self.qij, self.pij, self.chunk_rows)
+        chunk_rows = self.chunk_rows or max(len(self.qij), 1)
+        assignments = np.concatenate([np.asarray(self.qij[start_idx:start_idx + chunk_rows]).argmax(axis=1)
+                                      for start_idx in range(0, len(self.qij), chunk_rows)])
+        if self.assignments is not None:
+            self.changed = np.mean(assignments != self.assignments)
+            self.converged = self.tol is not None and self.changed < self.tol
+        self.assignments = assignments
+        self.refreshed_iteration = self.iteration
+        return self.converged
+
+    def getState(self):
+        '''
+        :return: Dictionary of the arrays making up the state between two refreshes (P, the hard assignments of the
+                 last refresh, the iteration counters, whether the assignments are stable), saved with the checkpoints
+                 of the clustering stage
+        '''
+        state = {'target_pij': np.asarray(self.pij), 'target_iteration': np.array(self.iteration),
+                 'target_refreshed_iteration': np.array(-1 if self.refreshed_iteration is None else self.refreshed_iteration),
+                 'target_converged': np.array(self.converged)}
+        if self.assignments is not None:
+            state['target_assignments'] = self.assignments
+        return state
+
+    def setState(self, state):
+        '''
+        Restores a state saved with getState, Q is stale afterwards
+        :param state: Dictionary holding the arrays of getState, possibly among others
+        :return: False if the state holds no target distribution, P has to be refreshed then
+        '''
+        if 'target_pij' not in state:
+            return False
+        self.pij[...] = state['target_pij']
+        self.iteration = int(state['target_iteration'])
+        refreshed_iteration = int(state['target_refreshed_iteration'])
+        self.refreshed_iteration = None if refreshed_iteration < 0 else refreshed_iteration
+        self.assignments = state.get('target_assignments')
+        self.converged = bool(state.get('target_converged', False))
+        self.q_is_current = False
+        return True
+
+
 class NetworkBuilder(object):
     '''
     Class that handles parsing the architecture dictionary and creating an autoencoder out of it
@@ -339,10 +937,15 @@ class NetworkBuilder(object):
         self.network_type = self.network_description['network_type']
         self.batch_norm = bool(self.network_description["use_batch_norm"])
         self.layer_list = []
+        self.layer_indices = {}
 
     def getBatchSize(self):
         return self.network_description["batch_size"]
 
+    def getInferenceBatchSize(self):
+        # Batch size for encoding whole datasets - only limited by memory, not by optimization concerns
+        return self.network_description["inference_batch_size"]
+
     def getInputAndTargetVars(self):
         return self.t_input, self.t_target
 
@@ -354,10 +957,30 @@ class NetworkBuilder(object):
         :return: Lasagne autoencoder network based on the network decription dictionary
         '''
         network = None
-        for layer in self.network_description['layers']:
+        for index, layer in enumerate(self.network_description['layers']):
             network = self.processLayer(network, layer)
+            # Remember which entry of the description created each lasagne layer (e.g. a convolution and its batch norm)
+            for lasagne_layer in get_all_layers(network):
+                self.layer_indices.setdefault(lasagne_layer, index)
+            if layer['is_encode']:
+                self.encode_index = index
         return network
 
+    def getParamNames(self, network):
+        '''
+        :param network: Network built by buildNetwork
+        :return: List of (param, name, attributes) for all params of the network, in the order of lasagne. The name is
+                 layers.<index of the layer in the description>.<param>, e.g. layers.1.W or layers.1.mean, the
+                 attributes hold the layer index and whether the layer is part of the encoder and the param trainable
+        '''
+        params = []
+        for layer in get_all_layers(network):
+            index = self.layer_indices[layer]
+            for param, tags in layer.params.items():
+                params.append((param, 'layers.%d.%s' % (index, param.name.split('.')[-1]),
+                               {'layer': index, 'encoder': index <= self.encode_index, 'trainable': 'trainable' in tags}))
+        return params
+
     def getEncodeLayerAndSize(self):
         '''
         :return: The encode layer - layer between encoder and decoder (bottleneck)
@@ -444,6 +1067,8 @@ class NetworkBuilder(object):
         self.populateDecoder(network_description['layers'])
         if 'use_batch_norm' not in network_description:
             network_description['use_batch_norm'] = False
+        if 'inference_batch_size' not in network_description:
+            network_description['inference_batch_size'] = max(500, network_description['batch_size'])
         for layer in network_description['layers']:
             if 'is_encode' not in layer:
                 layer['is_encode'] = False
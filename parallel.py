@@ -0,0 +1,198 @@
+'''
+Created on Oct 18, 2026
+
+Data parallel training on a single host: forked worker processes each run the compiled train function of their copy
+of the network on a disjoint shard of the (memory mapped) dataset, and average their params and optimizer state
+through shared memory every few steps
+'''
+import multiprocessing
+import signal
+import time
+import traceback
+
+import numpy as np
+
+from logsetup import rootLogger
+
+
+class ProcessBarrier(object):
+    '''
+    Reusable barrier for a fixed number of processes (python 2 multiprocessing has none). A process that fails aborts
+    the barrier, so that the others raise instead of waiting forever
+    '''
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.condition = multiprocessing.Condition()
+        self.count = multiprocessing.RawValue('i', 0)
+        self.generation = multiprocessing.RawValue('i', 0)
+        self.aborted = multiprocessing.RawValue('i', 0)
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            while generation == self.generation.value and not self.aborted.value:
+                self.condition.wait(1.0)
+            if self.aborted.value:
+                raise RuntimeError('A training process failed')
+
+    def abort(self):
+        with self.condition:
+            self.aborted.value = 1
+            self.condition.notify_all()
+
+
+class DataParallelTrainer(object):
+    '''
+    Trains a network with several worker processes. The workers are forked from the process that compiled the train
+    function, so they share its compiled code and the pages of the dataset. Every epoch the workers start from the state
+    of the parent process (params, optimizer buffers and learning rate, so schedules, checkpoints and early stopping of
+    the parent keep working), train on disjoint shards of a shuffled order of the dataset, average their states every
+    sync_interval steps and at the end of the epoch, and hand the averaged state back to the parent
+    '''
+
+    def __init__(self, train_function, shared_variables, dataset, input_type, batch_size, workers, sync_interval=10,
+                 prefetch=2, seed=None):
+        '''
+        :param train_function: Compiled train function of an (inputs, targets) batch, returning the loss
+        :param shared_variables: Shared variables making up the training state (see DCJC.getTrainingState)
+        :param dataset: DatasetHelper of the loaded dataset
+        :param input_type: IMAGE or FLAT
+        :param batch_size: Size of the minibatches of each worker
+        :param workers: Number of worker processes
+        :param sync_interval: Number of train steps between two averagings of the worker states
+        :param prefetch: Number of minibatches prepared ahead in each worker (see MinibatchPrefetcher)
+        :param seed: Seed of the shuffled orders, drawn from the numpy RNG if not given
+        '''
+        self.train_function = train_function
+        self.shared_variables = shared_variables
+        self.dataset = dataset
+        self.input_type = input_type
+        self.batch_size = batch_size
+        self.workers = workers
+        self.sync_interval = sync_interval
+        self.prefetch = prefetch
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        # Every worker trains on the same number of batches, so that they all take part in every averaging
+        self.steps_per_epoch = dataset.input.shape[0] // (batch_size * workers)
+        if self.steps_per_epoch == 0:
+            raise ValueError('%d samples are not enough for %d workers with batches of %d' % (dataset.input.shape[0], workers, batch_size))
+        self.shapes = [variable.get_value(borrow=True).shape for variable in shared_variables]
+        size = sum(int(np.prod(shape)) for shape in self.shapes)
+        # Slot 0 holds the state of the parent, slots 1..workers the states of the workers
+        self.states = np.frombuffer(multiprocessing.RawArray('d', (workers + 1) * size), dtype=np.float64).reshape((workers + 1, size))
+        # Summed loss and number of steps of every worker in the last epoch
+        self.results = np.frombuffer(multiprocessing.RawArray('d', 2 * workers), dtype=np.float64).reshape((workers, 2))
+        # Epoch the workers train next, -1 to stop them
+        self.control = multiprocessing.RawValue('i', 0)
+        self.epoch_barrier = ProcessBarrier(workers + 1)
+        self.sync_barrier = ProcessBarrier(workers)
+        self.processes = []
+
+    def start(self):
+        for worker in range(self.workers):
+            process = multiprocessing.Process(target=self.runWorker, args=(worker,))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def trainEpoch(self, epoch, telemetry=None):
+        '''
+        Trains one epoch with all workers and sets the averaged state in the parent
+        :param epoch: Zero based index of the epoch, selects the shuffled order
+        :param telemetry: EpochTelemetry to which the time of the epoch is added as train time
+        :return: Summed loss, number of batches - over all workers
+        '''
+        start_time = time.time()
+        self.states[0] = self.getState()
+        self.control.value = epoch
+        try:
+            # Start of the epoch, then its end
+            self.epoch_barrier.wait()
+            self.epoch_barrier.wait()
+        except RuntimeError:
+            self.terminate()
+            raise
+        self.setState(self.states[0])
+        if telemetry is not None:
+            telemetry.add('train', time.time() - start_time)
+        return self.results[:, 0].sum(), int(self.results[:, 1].sum())
+
+    def close(self):
+        # Stops the workers after the last epoch
+        self.control.value = -1
+        try:
+            self.epoch_barrier.wait()
+        except RuntimeError:
+            pass
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+        self.processes = []
+
+    def getState(self):
+        return np.concatenate([variable.get_value(borrow=True).ravel() for variable in self.shared_variables])
+
+    def setState(self, state):
+        offset = 0
+        for variable, shape in zip(self.shared_variables, self.shapes):
+            size = int(np.prod(shape))
+            value = variable.get_value(borrow=True)
+            variable.set_value(state[offset:offset + size].reshape(shape).astype(value.dtype))
+            offset += size
+
+    def average(self, worker):
+        # Every worker publishes its state and continues from the mean of all states
+        self.states[worker + 1] = self.getState()
+        self.sync_barrier.wait()
+        mean_state = self.states[1:].mean(axis=0)
+        # No worker publishes its next state before all of them have read this one
+        self.sync_barrier.wait()
+        self.setState(mean_state)
+        return mean_state
+
+    def getShard(self, epoch, worker):
+        # Disjoint shards of the same shuffled order in all workers
+        order = np.random.RandomState((self.seed + epoch) % (2 ** 31)).permutation(self.dataset.input.shape[0])
+        return order[worker::self.workers][:self.steps_per_epoch * self.batch_size]
+
+    def runWorker(self, worker):
+        # Interrupts are handled by the parent
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            while True:
+                self.epoch_barrier.wait()
+                epoch = self.control.value
+                if epoch < 0:
+                    return
+                self.setState(self.states[0])
+                batches = self.dataset.iterate_minibatches(self.input_type, self.batch_size, prefetch=self.prefetch,
+                                                           indices=self.getShard(epoch, worker))
+                error = 0.0
+                steps = 0
+                for inputs, targets in batches:
+                    error += self.train_function(inputs, targets)
+                    steps += 1
+                    if steps % self.sync_interval == 0 and steps < self.steps_per_epoch:
+                        self.average(worker)
+                mean_state = self.average(worker)
+                if worker == 0:
+                    self.states[0] = mean_state
+                self.results[worker] = (error, steps)
+                self.epoch_barrier.wait()
+        except RuntimeError:
+            # Another process failed
+            pass
+        except Exception:
+            rootLogger.error(traceback.format_exc())
+            self.sync_barrier.abort()
+            self.epoch_barrier.abort()
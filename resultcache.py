@@ -0,0 +1,59 @@
+'''
+Created on Oct 18, 2026
+'''
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from fileio import atomicSave
+
+
+def arrayDigest(array, chunk_rows=10000):
+    '''
+    Content hash of an array, computed chunk by chunk so that memory mapped arrays are not loaded at once
+    :param array: Numpy array (or memory map)
+    :param chunk_rows: Number of rows hashed at a time
+    :return: Hex digest of the shape, type and values of the array
+    '''
+    digest = hashlib.sha1(json.dumps([list(array.shape), str(array.dtype)]))
+    for start_idx in range(0, len(array), chunk_rows):
+        digest.update(np.ascontiguousarray(array[start_idx:start_idx + chunk_rows]).tobytes())
+    return digest.hexdigest()
+
+
+def getCacheKey(*parts):
+    '''
+    :param parts: Digests and json serializable settings that identify a result
+    :return: Key of the result in a ResultCache
+    '''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Folder of .npz files holding results of expensive computations (embeddings, clusterings) on data identified by
+    its content hash, so that they are computed only once for a given input and settings
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def getPath(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        '''
+        :return: Dictionary of the arrays saved under key, None if there are none
+        '''
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return dict((name, f[name]) for name in f.files)
+
+    def save(self, key, **arrays):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atomicSave(self.getPath(key), lambda tmp_path: np.savez(tmp_path, **arrays))
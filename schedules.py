@@ -0,0 +1,136 @@
+'''
+Created on Oct 18, 2026
+'''
+import time
+
+import numpy as np
+
+
+class ReduceLROnPlateau(object):
+    '''
+    Learning rate schedule that multiplies the learning rate by factor whenever the training loss did not improve for
+    patience epochs, down to min_lr
+    '''
+
+    def __init__(self, learning_rate, factor=0.5, patience=5, min_delta=1e-4, min_lr=1e-5):
+        '''
+        :param learning_rate: Theano shared variable holding the learning rate
+        :param factor: Factor the learning rate is multiplied by on a plateau
+        :param patience: Number of epochs without improvement after which the learning rate is reduced
+        :param min_delta: Minimum relative decrease of the loss that counts as an improvement
+        :param min_lr: Lower bound of the learning rate
+        '''
+        self.learning_rate = learning_rate
+        self.factor = factor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_lr = min_lr
+        self.best_loss = np.inf
+        self.bad_epochs = 0
+
+    def update(self, loss):
+        '''
+        :param loss: Training loss of the epoch that just finished
+        :return: True if the learning rate was reduced
+        '''
+        if loss < self.best_loss * (1 - self.min_delta):
+            self.best_loss = loss
+            self.bad_epochs = 0
+            return False
+        self.bad_epochs += 1
+        learning_rate = self.learning_rate.get_value()
+        if self.bad_epochs < self.patience or learning_rate <= self.min_lr:
+            return False
+        self.learning_rate.set_value(np.asarray(max(learning_rate * self.factor, self.min_lr), dtype=learning_rate.dtype))
+        self.bad_epochs = 0
+        return True
+
+    def getState(self):
+        # Arrays making up the state of the schedule, saved with the checkpoints of the pretraining
+        return {'plateau_best_loss': np.array(self.best_loss), 'plateau_bad_epochs': np.array(self.bad_epochs)}
+
+    def setState(self, state):
+        # Restores a state saved with getState, state may hold other arrays as well or lack them (older checkpoints)
+        if 'plateau_best_loss' in state:
+            self.best_loss = float(state['plateau_best_loss'])
+            self.bad_epochs = int(state['plateau_bad_epochs'])
+
+
+class EarlyStopping(object):
+    '''
+    Non interactive stopping policy of a training stage: stops once the loss did not improve for patience epochs, once
+    the next epoch would exceed the wall clock budget, or once the loss reached a target. The best loss is tracked so
+    that the weights of the best epoch can be kept
+    '''
+
+    def __init__(self, patience=None, budget_minutes=None, target_loss=None, min_delta=1e-4):
+        '''
+        :param patience: Stop after this many epochs without improvement, None to disable
+        :param budget_minutes: Stop before the stage would run longer than this many minutes, None to disable
+        :param target_loss: Stop once the loss is at most this value, None to disable
+        :param min_delta: Minimum relative decrease of the loss that counts as an improvement
+        '''
+        self.patience = patience
+        self.budget_minutes = budget_minutes
+        self.target_loss = target_loss
+        self.min_delta = min_delta
+        self.start_time = time.time()
+        self.epochs = 0
+        self.best_loss = np.inf
+        self.best_epoch = None
+        self.bad_epochs = 0
+        # Why the stage should stop, None while it should go on
+        self.reason = None
+
+    @property
+    def enabled(self):
+        return self.patience is not None or self.budget_minutes is not None or self.target_loss is not None
+
+    def update(self, epoch, loss):
+        '''
+        :param epoch: Zero based index of the epoch that just finished
+        :param loss: Training loss of the epoch
+        :return: True if the loss improved on the best loss so far
+        '''
+        self.epochs += 1
+        improved = loss < self.best_loss * (1 - self.min_delta)
+        if improved:
+            self.best_loss = loss
+            self.best_epoch = epoch
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        elapsed = time.time() - self.start_time
+        if self.target_loss is not None and loss <= self.target_loss:
+            self.reason = 'target loss %.4f reached' % self.target_loss
+        elif self.patience is not None and self.bad_epochs >= self.patience:
+            self.reason = 'no improvement for %d epochs' % self.bad_epochs
+        elif self.budget_minutes is not None and elapsed + elapsed / self.epochs > 60 * self.budget_minutes:
+            self.reason = 'time budget of %g minutes' % self.budget_minutes
+        return improved
+
+    def getState(self):
+        '''
+        :return: Dictionary of the arrays making up the state of the policy (epochs, best loss and epoch, epochs without
+                 improvement, time spent so far, reason), saved with the checkpoints of the pretraining
+        '''
+        return {'stop_epochs': np.array(self.epochs), 'stop_best_loss': np.array(self.best_loss),
+                'stop_best_epoch': np.array(-1 if self.best_epoch is None else self.best_epoch),
+                'stop_bad_epochs': np.array(self.bad_epochs), 'stop_elapsed': np.array(time.time() - self.start_time),
+                'stop_reason': np.array(self.reason or '')}
+
+    def setState(self, state):
+        '''
+        Restores a state saved with getState, the time budget counts the time spent before the checkpoint
+        :param state: Dictionary holding the arrays of getState, possibly among others. Nothing is restored if they are
+                      missing (older checkpoints)
+        '''
+        if 'stop_epochs' not in state:
+            return
+        self.epochs = int(state['stop_epochs'])
+        self.best_loss = float(state['stop_best_loss'])
+        best_epoch = int(state['stop_best_epoch'])
+        self.best_epoch = None if best_epoch < 0 else best_epoch
+        self.bad_epochs = int(state['stop_bad_epochs'])
+        self.start_time = time.time() - float(state['stop_elapsed'])
+        self.reason = str(state['stop_reason']) or None
@@ -0,0 +1,258 @@
+'''
+Created on Oct 18, 2026
+
+Nearest neighbour search over the saved latent spaces (z_, pc_z_, pc_km_z_). The points are grouped into inverted
+lists by a coarse kmeans, a query only scans the lists of its nprobe nearest coarse centers, and all distances are
+computed as blocked matrix products
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from fileio import ARCH_FILES, atomicSave, loadArchitectures
+from misc import fitKMeansChunked, getSourceStamp
+
+# Number of rows of the indexed points / of the queries processed at a time
+BLOCK_ROWS = 8192
+
+
+def getSquaredDistances(queries, points, points_norm=None):
+    '''
+    :param queries: Query points (Q x D)
+    :param points: Indexed points (N x D)
+    :param points_norm: Precomputed squared norms of the points, computed if not given
+    :return: Q x N matrix of squared euclidean distances, |q|^2 - 2 q.p^T + |p|^2 clamped at 0
+    '''
+    if points_norm is None:
+        points_norm = (points * points).sum(axis=1)
+    distances = np.dot(queries, points.T)
+    distances *= -2
+    distances += (queries * queries).sum(axis=1)[:, None]
+    distances += points_norm[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def mergeTopK(best_distances, best_ids, distances, ids, k):
+    '''
+    Merges a block of candidates into the running top k of each query
+    :param best_distances: Q x k squared distances of the best candidates so far (inf where there is none yet)
+    :param best_ids: Q x k ids of the best candidates so far
+    :param distances: Q x M squared distances of the new candidates
+    :param ids: M ids of the new candidates (shared by all queries), or Q x M
+    :return: The merged best distances and ids, sorted by distance
+    '''
+    ids = np.broadcast_to(ids, distances.shape)
+    distances = np.concatenate([best_distances, distances], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    if distances.shape[1] > k:
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(distances, axis=1, kind='mergesort')
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class LatentIndex(object):
+    '''
+    Inverted file index of a latent space. The points are stored reordered by coarse cluster, so that every inverted
+    list is a contiguous block that is scanned with one matrix product per block of queries
+    '''
+
+    def __init__(self, centers, offsets, ids, vectors, meta=None):
+        '''
+        :param centers: Coarse cluster centers (L x D)
+        :param offsets: Start of each inverted list in ids/vectors, L + 1 entries
+        :param ids: Row of each stored point in the latent space file
+        :param vectors: The points, ordered by inverted list
+        :param meta: Json serializable description of the indexed file
+        '''
+        self.centers = centers
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.meta = meta or {}
+        self.norms = (vectors * vectors).sum(axis=1)
+        self.centers_norm = (centers * centers).sum(axis=1)
+        # Position of every point of the latent space in the reordered vectors
+        self.positions = np.empty_like(ids)
+        self.positions[ids] = np.arange(len(ids))
+
+    @staticmethod
+    def build(Z, num_lists=None, chunk_rows=BLOCK_ROWS, meta=None):
+        '''
+        :param Z: Latent space (array or memory map), read chunk by chunk
+        :param num_lists: Number of inverted lists, about sqrt(N) by default
+        :param chunk_rows: Number of rows of Z read at a time
+        :param meta: Json serializable description of the indexed file, saved with the index
+        :return: LatentIndex of Z
+        '''
+        num_lists = min(num_lists or int(np.sqrt(len(Z))), len(Z))
+        kmeans = fitKMeansChunked(Z, num_lists, n_init=1, chunk_rows=chunk_rows, passes=1)
+        ids = np.argsort(kmeans.labels_, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(kmeans.labels_, minlength=num_lists))])
+        positions = np.empty_like(ids)
+        positions[ids] = np.arange(len(ids))
+        vectors = np.empty((len(Z), Z.shape[1]), dtype=np.float32)
+        for start_idx in range(0, len(Z), chunk_rows):
+            # Scattered in order of the rows of Z, so that Z is read sequentially
+            vectors[positions[start_idx:start_idx + chunk_rows]] = Z[start_idx:start_idx + chunk_rows]
+        return LatentIndex(kmeans.cluster_centers_.astype(np.float32), offsets, ids, vectors, meta)
+
+    @staticmethod
+    def buildFromFile(latent_path, num_lists=None):
+        '''
+        :param latent_path: Saved latent space (.npy), memory mapped
+        :param num_lists: Number of inverted lists, about sqrt(N) by default
+        :return: LatentIndex of the file, stamped with the size and modification time of the file (see load)
+        '''
+        # Stamped before reading, so that a file rewritten while it is indexed is never taken as indexed
+        meta = {'latent_space': latent_path, 'source': getSourceStamp([latent_path])}
+        return LatentIndex.build(np.load(latent_path, mmap_mode='r'), num_lists, meta=meta)
+
+    def save(self, path):
+        atomicSave(path, lambda tmp_path: np.savez(tmp_path, centers=self.centers, offsets=self.offsets, ids=self.ids,
+                                                   vectors=self.vectors, meta=np.array(json.dumps(self.meta))))
+
+    @staticmethod
+    def load(path, latent_path=None):
+        '''
+        :param path: Index saved by save
+        :param latent_path: Latent space file the index has to be up to date with, None to skip the check. An index
+                            is stale once the file was written again (e.g. by a new clustering run) after it was built
+        :return: LatentIndex saved at path, raises ValueError if it is stale
+        '''
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if latent_path is not None and meta.get('source') != getSourceStamp([latent_path]):
+                raise ValueError('%s is out of date, %s changed since it was indexed' % (path, latent_path))
+            return LatentIndex(f['centers'], f['offsets'], f['ids'], f['vectors'], meta)
+
+    def search(self, queries, k=10, nprobe=8):
+        '''
+        :param queries: Query points in the latent space (Q x D), e.g. new samples encoded with NumpyEncoder
+        :param k: Number of neighbours per query
+        :param nprobe: Number of inverted lists scanned per query (those of the nearest coarse centers), None to scan
+                       all points (exact search)
+        :return: Q x k squared distances and Q x k rows of the latent space of the nearest points, sorted by distance.
+                 If the probed lists hold fewer than k points the missing neighbours have distance inf and row -1
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape((-1, self.vectors.shape[1]))
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        ids = np.empty((len(queries), k), dtype=self.ids.dtype)
+        for start_idx in range(0, len(queries), BLOCK_ROWS):
+            block = queries[start_idx:start_idx + BLOCK_ROWS]
+            if nprobe is None or nprobe >= len(self.centers):
+                result = self.searchExhaustive(block, k)
+            else:
+                result = self.searchProbed(block, k, nprobe)
+            distances[start_idx:start_idx + len(block)], ids[start_idx:start_idx + len(block)] = result
+        return distances, ids
+
+    def searchItems(self, items, k=10, nprobe=8):
+        '''
+        Neighbours of points of the indexed latent space, without the points themselves
+        :param items: Rows of the latent space
+        :return: See search
+        '''
+        items = np.asarray(items).reshape(-1)
+        distances, ids = self.search(self.vectors[self.positions[items]], k + 1, nprobe)
+        # Each point is normally its own nearest neighbour, but of equal points any one may come first
+        keep = ids != items[:, None]
+        keep[keep.all(axis=1), -1] = False
+        return distances[keep].reshape((len(items), k)), ids[keep].reshape((len(items), k))
+
+    def searchExhaustive(self, queries, k):
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=self.ids.dtype)
+        for start_idx in range(0, len(self.vectors), BLOCK_ROWS):
+            distances = getSquaredDistances(queries, self.vectors[start_idx:start_idx + BLOCK_ROWS], self.norms[start_idx:start_idx + BLOCK_ROWS])
+            best_distances, best_ids = mergeTopK(best_distances, best_ids, distances, self.ids[start_idx:start_idx + BLOCK_ROWS], k)
+        return self.padTopK(best_distances, best_ids, k)
+
+    def searchProbed(self, queries, k, nprobe):
+        # Every probed list is scanned once for all queries that probe it
+        probes = np.argpartition(getSquaredDistances(queries, self.centers, self.centers_norm), nprobe - 1, axis=1)[:, :nprobe]
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=self.ids.dtype)
+        lists = probes.ravel()
+        query_rows = np.repeat(np.arange(len(queries)), nprobe)
+        order = np.argsort(lists, kind='mergesort')
+        lists, query_rows = lists[order], query_rows[order]
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(lists)) + 1, [len(lists)]])
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            start_idx, end_idx = self.offsets[lists[begin]], self.offsets[lists[begin] + 1]
+            if start_idx == end_idx:
+                continue
+            rows = query_rows[begin:end]
+            distances = getSquaredDistances(queries[rows], self.vectors[start_idx:end_idx], self.norms[start_idx:end_idx])
+            best_distances[rows], best_ids[rows] = mergeTopK(best_distances[rows], best_ids[rows], distances, self.ids[start_idx:end_idx], k)
+        return best_distances, best_ids
+
+    def padTopK(self, distances, ids, k):
+        # Fewer points than k in the index
+        if distances.shape[1] == k:
+            return distances, ids
+        missing = k - distances.shape[1]
+        return (np.concatenate([distances, np.full((len(distances), missing), np.inf, dtype=distances.dtype)], axis=1),
+                np.concatenate([ids, np.full((len(ids), missing), -1, dtype=ids.dtype)], axis=1))
+
+
+def getIndexPath(dataset_name, prefix, arch_name):
+    # The index of saved_params/MNIST/pc_z_<arch>.npy is saved as saved_params/MNIST/pc_z_<arch>.index.npz
+    return 'saved_params/%s/%s%s.index.npz' % (dataset_name, prefix, arch_name)
+
+
+if __name__ == '__main__':
+    '''
+    usage: similarity.py [-h] -d {COIL20,MNIST} -a ARCHITECTURE
+                         [--latent {z_,pc_z_,pc_km_z_}] [--build] [--lists LISTS]
+                         [--items ITEMS [ITEMS ...]] [--input INPUT] [--scale SCALE]
+                         [--stage {km,kld,pretrain}] [-k K] [--nprobe NPROBE]
+    '''
+    parser = argparse.ArgumentParser()
+    requiredArgs = parser.add_argument_group('required arguments')
+    requiredArgs.add_argument("-d", "--dataset", choices=sorted(ARCH_FILES), help="Dataset the latent space belongs to", required=True)
+    requiredArgs.add_argument("-a", "--architecture", type=int, help="Index of architecture of autoencoder in the json file (archs/)", required=True)
+    parser.add_argument("--latent", choices=['z_', 'pc_z_', 'pc_km_z_'], default='pc_z_', help="Latent space file that is indexed")
+    parser.add_argument("--build", action='store_true', help="(Re)build the index, it is built on first use otherwise")
+    parser.add_argument("--lists", type=int, help="Number of inverted lists (default sqrt(N))")
+    parser.add_argument("--items", type=int, nargs='+', help="Rows of the latent space whose neighbours are searched")
+    parser.add_argument("--input", help=".npy file of new samples, encoded with the numpy encoder of --stage and searched")
+    parser.add_argument("--scale", type=float, help="Factor converting the samples of --input to network inputs")
+    parser.add_argument("--stage", choices=['pretrain', 'kld', 'km'], default='kld', help="Training stage whose encoder encodes --input")
+    parser.add_argument("-k", type=int, default=10, help="Number of neighbours")
+    parser.add_argument("--nprobe", type=int, default=8, help="Number of inverted lists scanned per query, 0 for exact search")
+    args = parser.parse_args()
+    arch = loadArchitectures(args.dataset)[args.architecture]
+    index_path = getIndexPath(args.dataset, args.latent, arch['name'])
+    latent_path = 'saved_params/%s/%s%s.npy' % (args.dataset, args.latent, arch['name'])
+    index = None
+    if not args.build and os.path.exists(index_path):
+        try:
+            index = LatentIndex.load(index_path, latent_path)
+        except ValueError as e:
+            print("%s, rebuilding it" % e)
+    if index is None:
+        start_time = time.time()
+        index = LatentIndex.buildFromFile(latent_path, args.lists)
+        index.save(index_path)
+        print("Indexed %d points in %d lists in %.2fs" % (len(index.ids), len(index.centers), time.time() - start_time))
+    queries = None
+    if args.input:
+        from inference import NumpyEncoder
+        queries = NumpyEncoder.load(arch, args.dataset, args.stage).predict(np.load(args.input, mmap_mode='r'), scale=args.scale)[0]
+    start_time = time.time()
+    if queries is not None:
+        distances, ids = index.search(queries, args.k, args.nprobe or None)
+        names = range(len(queries))
+    elif args.items:
+        distances, ids = index.searchItems(args.items, args.k, args.nprobe or None)
+        names = args.items
+    else:
+        parser.error('Give --items or --input to search')
+    print("Searched %d queries in %.1fms" % (len(ids), 1000 * (time.time() - start_time)))
+    for name, row_distances, row_ids in zip(names, distances, ids):
+        print("%6s: %s" % (name, ' '.join('%d (%.3f)' % (i, np.sqrt(d)) for i, d in zip(row_ids, row_distances))))
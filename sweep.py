@@ -0,0 +1,198 @@
+'''
+Created on Oct 18, 2026
+
+Runs pretraining, clustering and metrics for several architectures and seeds in a bounded pool of worker processes.
+This module must not import numpy (or anything importing it): the BLAS/OpenMP thread counts are read from the
+environment when numpy and theano are first loaded, which has to happen in the workers, after the environment of
+each worker has been set
+'''
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from fileio import ARCH_FILES, loadArchitectures
+from logsetup import rootLogger, setupLogging
+
+# Environment variables limiting the threads of the numerical libraries of a worker
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def initWorker(threads):
+    # Pool initializer - runs in each worker before it imports numpy
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+
+
+def prepareDataset(dataset_name):
+    '''
+    Builds the on-disk dataset cache once before the runs start, the workers then memory map the same files and share
+    their pages through the page cache instead of each parsing the original files
+    '''
+    from misc import DatasetHelper
+    DatasetHelper(dataset_name).loadDataset()
+
+
+def getRunName(arch_name, seed):
+    # Saved params, checkpoints and logs of a sweep run are named after the architecture and the seed
+    return '%s_seed%d' % (arch_name, seed)
+
+
+def runSweepJob(job):
+    '''
+    Pretrains the autoencoder of one architecture with one seed, refines it with the clustering loss and clusters the
+    latent spaces of both stages with kmeans
+    :param job: Dictionary with dataset, arch, seed, pretrain_epochs, cluster_epochs, method and dcjc_options
+    :return: Dictionary with the clustering metrics and the wall time of each stage, or the error if the run failed
+    '''
+    arch = copy.deepcopy(job['arch'])
+    result = {'arch': arch['name'], 'seed': job['seed']}
+    arch['name'] = getRunName(arch['name'], job['seed'])
+    setupLogging(arch['name'])
+    try:
+        import numpy as np
+        import lasagne
+        from clustermetrics import clusteringScores
+        from misc import DatasetHelper, fitKMeans
+        from network import DCJC
+        np.random.seed(job['seed'])
+        lasagne.random.set_rng(np.random.RandomState(job['seed']))
+        start_time = time.time()
+        dataset = DatasetHelper(job['dataset'])
+        dataset.loadDataset()
+        dcjc = DCJC(arch, **job['dcjc_options'])
+        stages = [('pretrain', 'saved_params/%s/z_%s.npy', job['pretrain_epochs'], dcjc.pretrainWithData)]
+        if job['cluster_epochs'] and job['method'] == 'KLD':
+            stages.append(('cluster', 'saved_params/%s/pc_z_%s.npy', job['cluster_epochs'],
+                           lambda dataset, epochs: dcjc.doClusteringWithKLdivLoss(dataset, True, epochs)))
+        elif job['cluster_epochs']:
+            stages.append(('cluster', 'saved_params/%s/pc_km_z_%s.npy', job['cluster_epochs'], dcjc.doClusteringWithKMeansLoss))
+        for stage, latent_space_file, epochs, train in stages:
+            stage_start_time = time.time()
+            train(dataset, epochs)
+            result[stage + '_seconds'] = time.time() - stage_start_time
+            Z = np.load(latent_space_file % (dataset.name, arch['name']))
+            scores = clusteringScores(dataset.labels, fitKMeans(Z, dataset.getClusterCount()).labels_)
+            result[stage + '_acc'] = scores['acc']
+            result[stage + '_nmi'] = scores['nmi']
+        result['seconds'] = time.time() - start_time
+    except Exception:
+        rootLogger.error(traceback.format_exc())
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    return result
+
+
+def getArchitectures(archs, specs):
+    '''
+    :param archs: Architectures of the json file of the dataset
+    :param specs: Indices or names of architectures, 'all' for every architecture of the file
+    :return: List of the selected architectures
+    '''
+    if specs == ['all']:
+        return archs
+    selected = []
+    names = [arch['name'] for arch in archs]
+    for spec in specs:
+        if spec.isdigit():
+            selected.append(archs[int(spec)])
+        elif spec in names:
+            selected.append(archs[names.index(spec)])
+        else:
+            raise ValueError('Unknown architecture %s' % spec)
+    return selected
+
+
+def formatResult(result, stages):
+    # Row of the consolidated table
+    row = '%-50s %6s' % (result['arch'], result['seed'])
+    if 'error' in result:
+        return row + '     failed: ' + result['error']
+    for stage in stages:
+        row += '     %8.3f %8.3f %9.1fs' % (result[stage + '_acc'], result[stage + '_nmi'], result[stage + '_seconds'])
+    return row
+
+
+def formatSummary(arch_name, results, stages):
+    # Mean over the seeds of an architecture, and the spread of its final accuracy
+    row = '%-50s %6s' % (arch_name, 'mean')
+    for stage in stages:
+        row += '     %8.3f %8.3f %9.1fs' % tuple(meanAndStd([result[stage + field] for result in results])[0]
+                                              for field in ('_acc', '_nmi', '_seconds'))
+    return row + '     (%d seeds, %s ACC std %.3f)' % (len(results), stages[-1], meanAndStd([result[stages[-1] + '_acc'] for result in results])[1])
+
+
+def meanAndStd(values):
+    # Computed without numpy, see the module docstring
+    mean = sum(values) / float(len(values))
+    return mean, (sum((value - mean) ** 2 for value in values) / len(values)) ** 0.5
+
+
+if __name__ == '__main__':
+    '''
+    usage: sweep.py [-h] -d DATASET -a ARCHITECTURES [ARCHITECTURES ...]
+                    [--seeds SEEDS [SEEDS ...]] --pretrain PRETRAIN
+                    [--cluster CLUSTER] [--method {KLD,KM}] [--jobs JOBS]
+                    [--threads THREADS] [--prefetch PREFETCH]
+                    [--eval-mode {full,warm,minibatch}] [--eval-every EVAL_EVERY]
+                    [--output OUTPUT]
+    '''
+    parser = argparse.ArgumentParser()
+    requiredArgs = parser.add_argument_group('required arguments')
+    requiredArgs.add_argument("-d", "--dataset", choices=sorted(ARCH_FILES), help="Dataset on which the autoencoders are trained", required=True)
+    requiredArgs.add_argument("-a", "--architectures", nargs='+', help="Indices or names of architectures in the json file of the dataset (archs/), or all", required=True)
+    requiredArgs.add_argument("--pretrain", type=int, help="Number of pretraining epochs", required=True)
+    parser.add_argument("--seeds", type=int, nargs='+', default=[0], help="Random seeds, every architecture is trained once per seed")
+    parser.add_argument("--cluster", type=int, default=0, help="Number of epochs of training with the clustering loss, 0 to only pretrain")
+    parser.add_argument("--method", choices=['KLD', 'KM'], default='KLD', help="Clustering loss - KL divergence or kmeans loss")
+    parser.add_argument("--jobs", type=int, help="Number of runs in parallel (default: number of cores / threads)")
+    parser.add_argument("--threads", type=int, help="BLAS/OpenMP threads per run (default: number of cores / jobs)")
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of training minibatches prepared ahead on a background thread, 0 disables prefetching")
+    parser.add_argument("--eval-mode", choices=['full', 'warm', 'minibatch'], default='full', help="KMeans used for monitoring the latent space while training")
+    parser.add_argument("--eval-every", type=int, help="Evaluate the latent space every EVAL_EVERY epochs while training")
+    parser.add_argument("--output", help="Append the results as json lines to this file")
+    args = parser.parse_args()
+    setupLogging('sweep')
+    archs = getArchitectures(loadArchitectures(args.dataset), args.architectures)
+    cores = multiprocessing.cpu_count()
+    jobs_count = args.jobs or max(1, cores // (args.threads or 1))
+    threads = args.threads or max(1, cores // jobs_count)
+    if not os.path.exists('saved_params/%s' % args.dataset):
+        os.makedirs('saved_params/%s' % args.dataset)
+    dcjc_options = {'prefetch': args.prefetch, 'eval_mode': args.eval_mode, 'eval_interval': args.eval_every}
+    jobs = [{'dataset': args.dataset, 'arch': arch, 'seed': seed, 'pretrain_epochs': args.pretrain, 'cluster_epochs': args.cluster,
+             'method': args.method, 'dcjc_options': dcjc_options} for arch in archs for seed in args.seeds]
+    rootLogger.info("Sweep of %d runs, %d in parallel with %d threads each" % (len(jobs), jobs_count, threads))
+    # The dataset cache is built by a worker as well, the main process never loads numpy
+    preparation_pool = multiprocessing.Pool(1, initWorker, (threads,))
+    preparation_pool.apply(prepareDataset, (args.dataset,))
+    preparation_pool.close()
+    preparation_pool.join()
+    # A fresh process per run, so that the memory and the theano state of a run are released when it ends
+    pool = multiprocessing.Pool(jobs_count, initWorker, (threads,), maxtasksperchild=1)
+    results = []
+    for result in pool.imap_unordered(runSweepJob, jobs):
+        rootLogger.info("Finished %s seed %d%s" % (result['arch'], result['seed'], ' (failed)' if 'error' in result else ''))
+        results.append(result)
+    pool.close()
+    pool.join()
+    stages = ['pretrain'] + (['cluster'] if args.cluster else [])
+    rootLogger.info(120 * '_')
+    rootLogger.info('%-50s %6s' % ('arch', 'seed') + ''.join('     %8s %8s %10s' % (stage[:3] + ' ACC', stage[:3] + ' NMI', 'time') for stage in stages))
+    rootLogger.info(120 * '_')
+    order = [arch['name'] for arch in archs]
+    results.sort(key=lambda result: (order.index(result['arch']), result['seed']))
+    for arch_name in order:
+        arch_results = [result for result in results if result['arch'] == arch_name]
+        for result in arch_results:
+            rootLogger.info(formatResult(result, stages))
+        succeeded = [result for result in arch_results if 'error' not in result]
+        if len(succeeded) > 1:
+            rootLogger.info(formatSummary(arch_name, succeeded, stages))
+    rootLogger.info(120 * '_')
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(result, dataset=args.dataset)) + '\n')
@@ -0,0 +1,76 @@
+'''
+Created on Oct 18, 2026
+'''
+from contextlib import contextmanager
+import json
+import resource
+import time
+
+
+def currentRSS():
+    # Resident set size of this process in MB
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / float(1024 ** 2)
+
+
+class EpochTelemetry(object):
+    '''
+    Writes one json record per training epoch to a json-lines file, with the throughput of the epoch and a breakdown
+    of its wall time into phases (data loading, train function calls, encoding passes, P/Q computation, kmeans
+    evaluation and checkpoint i/o), plus the resident memory of the process
+    '''
+    PHASES = ('data', 'train', 'encode', 'pq', 'kmeans', 'checkpoint')
+
+    def __init__(self, path, stage, run_info):
+        '''
+        :param path: json-lines file the records are appended to
+        :param stage: Name of the training stage (pretrain, kld, km)
+        :param run_info: Dictionary of fields identifying the run (architecture, dataset ...) added to every record
+        '''
+        self.path = path
+        self.stage = stage
+        self.run_info = run_info
+        self.startEpoch()
+
+    def startEpoch(self):
+        self.epoch_start_time = time.time()
+        self.phase_times = dict((phase, 0.0) for phase in self.PHASES)
+
+    def add(self, phase, seconds):
+        self.phase_times[phase] += seconds
+
+    @contextmanager
+    def phase(self, phase):
+        '''
+        Context manager that adds the time spent inside it to the given phase
+        '''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[phase] += time.time() - start_time
+
+    def endEpoch(self, epoch, samples, loss):
+        '''
+        Writes the record of the finished epoch and starts timing the next one
+        :param epoch: Zero based index of the epoch
+        :param samples: Number of samples the train function was called on
+        :param loss: Mean training loss of the epoch
+        '''
+        seconds = time.time() - self.epoch_start_time
+        record = dict(self.run_info)
+        record.update({
+            'stage': self.stage,
+            'epoch': epoch + 1,
+            'timestamp': time.time(),
+            'seconds': seconds,
+            'samples': samples,
+            'samples_per_sec': samples / seconds if seconds > 0 else 0.0,
+            'loss': float(loss),
+            'phases': self.phase_times,
+            'other': max(seconds - sum(self.phase_times.values()), 0.0),
+            'rss_mb': currentRSS()
+        })
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.startEpoch()
@@ -0,0 +1,9 @@
+'''
+Created on Oct 18, 2026
+
+The modules of the project are flat files in the repository root, make them importable from the tests
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+'''
+Created on Oct 18, 2026
+
+The clustering layer and the clustering losses derive the batch dimension symbolically: a function compiled once has
+to give the same results for any batch size as for a single batch holding all the samples
+'''
+import lasagne
+import numpy as np
+import theano
+import theano.tensor as T
+
+from customlayers import ClusteringLayer, getSoftAssignments
+from network import DCJC
+
+BATCH_SIZES = (1, 5, 10, 37)
+NUM_SAMPLES = 74
+NUM_CLUSTERS = 4
+LATENT_SPACE_DIM = 6
+
+
+def getLatentSpace():
+    rng = np.random.RandomState(0)
+    Z = rng.randn(NUM_SAMPLES, LATENT_SPACE_DIM).astype(theano.config.floatX)
+    cluster_centers = rng.randn(NUM_CLUSTERS, LATENT_SPACE_DIM).astype(theano.config.floatX)
+    return Z, cluster_centers
+
+
+def getBatches(Z, batch_size):
+    # Ends with a tail batch unless batch_size divides the number of samples
+    return [Z[start:start + batch_size] for start in range(0, len(Z), batch_size)]
+
+
+def getKMeansLoss(latent_space, soft_assignments, cluster_centers, soft_loss):
+    # getKMeansLoss does not use the network, a bare DCJC saves building and compiling one
+    return DCJC.__new__(DCJC).getKMeansLoss(latent_space, soft_assignments, cluster_centers, soft_loss)
+
+
+def test_soft_assignments_any_batch_size():
+    Z, cluster_centers = getLatentSpace()
+    z = T.matrix('z')
+    softAssignments = theano.function([z], getSoftAssignments(z, theano.shared(cluster_centers)))
+    expected = softAssignments(Z)
+    for batch_size in BATCH_SIZES:
+        Q = np.concatenate([softAssignments(batch) for batch in getBatches(Z, batch_size)])
+        np.testing.assert_allclose(Q, expected, rtol=1e-5, atol=1e-7, err_msg='batch size %d' % batch_size)
+
+
+def test_clustering_layer_any_batch_size():
+    Z, cluster_centers = getLatentSpace()
+    z = T.matrix('z')
+    input_layer = lasagne.layers.InputLayer(shape=(None, LATENT_SPACE_DIM), input_var=z)
+    clustering_layer = ClusteringLayer(input_layer, NUM_CLUSTERS, cluster_centers, name='cluster')
+    assert clustering_layer.output_shape == (None, NUM_CLUSTERS)
+    softAssignments = theano.function([z], lasagne.layers.get_output(clustering_layer, deterministic=True))
+    expected = softAssignments(Z)
+    np.testing.assert_allclose(expected.sum(axis=1), 1, rtol=1e-5)
+    for batch_size in BATCH_SIZES:
+        Q = np.concatenate([softAssignments(batch) for batch in getBatches(Z, batch_size)])
+        np.testing.assert_allclose(Q, expected, rtol=1e-5, atol=1e-7, err_msg='batch size %d' % batch_size)
+
+
+def test_kmeans_loss_any_batch_size():
+    Z, cluster_centers = getLatentSpace()
+    z = T.matrix('z')
+    t_cluster_centers = theano.shared(cluster_centers)
+    soft_assignments = getSoftAssignments(z, t_cluster_centers)
+    for soft_loss in (False, True):
+        kmeansLoss = theano.function([z], getKMeansLoss(z, soft_assignments, t_cluster_centers, soft_loss))
+        expected = kmeansLoss(Z)
+        for batch_size in BATCH_SIZES:
+            batches = getBatches(Z, batch_size)
+            # The loss is a mean over the batch, the batch means weighted by the batch sizes give the mean of all samples
+            loss = sum(kmeansLoss(batch) * len(batch) for batch in batches) / NUM_SAMPLES
+            np.testing.assert_allclose(loss, expected, rtol=1e-5,
+                                       err_msg='batch size %d, soft loss %s' % (batch_size, soft_loss))
@@ -0,0 +1,27 @@
+'''
+Created on Oct 18, 2026
+
+sklearn, matplotlib and PIL dominate the import time of the helper modules, they are only imported by the functions
+that use them. Each module is imported in a fresh interpreter, the tests themselves import sklearn
+'''
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('sklearn', 'matplotlib', 'PIL')
+
+
+def getImportedModules(module_name):
+    # Names of all the modules loaded by importing module_name
+    output = subprocess.check_output([sys.executable, '-c', 'import sys, %s; print("\\n".join(sys.modules))' % module_name],
+                                     cwd=REPO_ROOT)
+    return output.decode().split()
+
+
+@pytest.mark.parametrize('module_name', ['clustermetrics', 'misc'])
+def test_no_heavy_imports(module_name):
+    heavy = set(name.split('.')[0] for name in getImportedModules(module_name)) & set(HEAVY_MODULES)
+    assert not heavy, '%s imports %s' % (module_name, ', '.join(sorted(heavy)))
@@ -0,0 +1,77 @@
+'''
+Created on Oct 18, 2026
+
+The numpy encoder has to give the same latent space as the theano network it was trained as, in particular for the
+batch norm architectures, whose scale and shift are folded from the params (W, beta, gamma) and statistics (mean,
+inv_std) of the layers
+'''
+import copy
+
+import lasagne
+import numpy as np
+import pytest
+
+from inference import NumpyEncoder
+from network import DCJC
+
+# Small versions of the MNIST architectures: convolutions with batch norm in valid and same mode, max pooling, and
+# a convolution (c-5-6_p_c-5-16_p_c-4-120) or dense layers (c-3-32_p_c-3-64_p_fc-32) as encode layer
+ARCHS = [
+    {'name': 'c-3-4_p_c-3-6_p_c-3-8', 'use_batch_norm': 1, 'batch_size': 10,
+     'layers': [{'type': 'Input', 'output_shape': [1, 14, 14]},
+                {'type': 'Conv2D', 'num_filters': 4, 'filter_size': [3, 3], 'non_linearity': 'rectify'},
+                {'type': 'MaxPool2D*', 'filter_size': [2, 2]},
+                {'type': 'Conv2D', 'num_filters': 6, 'filter_size': [3, 3], 'non_linearity': 'rectify', 'conv_mode': 'same'},
+                {'type': 'MaxPool2D*', 'filter_size': [2, 2]},
+                {'type': 'Conv2D', 'num_filters': 8, 'filter_size': [3, 3], 'non_linearity': 'linear'}]},
+    {'name': 'c-3-4_p_c-3-6_p_fc-54_fc-5', 'use_batch_norm': 1, 'batch_size': 10,
+     'layers': [{'type': 'Input', 'output_shape': [1, 12, 12]},
+                {'type': 'Conv2D', 'num_filters': 4, 'filter_size': [3, 3], 'non_linearity': 'rectify', 'conv_mode': 'same'},
+                {'type': 'MaxPool2D', 'filter_size': [2, 2]},
+                {'type': 'Conv2D', 'num_filters': 6, 'filter_size': [3, 3], 'non_linearity': 'rectify', 'conv_mode': 'same'},
+                {'type': 'MaxPool2D', 'filter_size': [2, 2]},
+                {'type': 'Dense', 'num_units': 54, 'non_linearity': 'rectify'},
+                {'type': 'Dense', 'num_units': 5, 'non_linearity': 'linear'}]}
+]
+
+
+class NamedDataset(object):
+    # Only the name of a dataset is needed for saving params
+    name = 'TEST'
+
+
+def getTrainedNetwork(arch):
+    '''
+    :return: DCJC of the architecture with random params and batch norm statistics - the initial values (gamma and
+             inv_std 1, beta and mean 0) would hide a mix up of their order - and a batch of random inputs
+    '''
+    # The network builder completes the description in place, keep the original for the numpy encoder
+    dcjc = DCJC(copy.deepcopy(arch), function_cache_dir=None)
+    rng = np.random.RandomState(0)
+    for param, name, attributes in dcjc.param_names:
+        shape = param.get_value(borrow=True).shape
+        if name.endswith(('.gamma', '.inv_std')):
+            value = rng.uniform(0.5, 2, size=shape)
+        else:
+            value = 0.3 * rng.randn(*shape)
+        param.set_value(value.astype(param.dtype))
+    inputs = rng.rand(*([7] + arch['layers'][0]['output_shape'])).astype(np.float32)
+    return dcjc, inputs
+
+
+@pytest.mark.parametrize('arch', ARCHS, ids=[arch['name'] for arch in ARCHS])
+def test_encode_matches_theano(arch):
+    dcjc, inputs = getTrainedNetwork(arch)
+    encoder = NumpyEncoder(arch, [param.get_value() for param in lasagne.layers.get_all_params(dcjc.network, trainable=True)],
+                           [param.get_value() for param in lasagne.layers.get_all_params(dcjc.network, trainable=False)])
+    np.testing.assert_allclose(encoder.encode(inputs), dcjc.predictEncoding(inputs), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('arch', ARCHS, ids=[arch['name'] for arch in ARCHS])
+def test_load_matches_theano(arch, tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    tmpdir.mkdir('saved_params').mkdir(NamedDataset.name)
+    dcjc, inputs = getTrainedNetwork(arch)
+    dcjc.saveParams(NamedDataset(), 'pretrain')
+    encoder = NumpyEncoder.load(arch, NamedDataset.name, 'pretrain')
+    np.testing.assert_allclose(encoder.encode(inputs), dcjc.predictEncoding(inputs), rtol=1e-4, atol=1e-5)